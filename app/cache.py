@@ -0,0 +1,180 @@
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple
+from typing import Iterable, List, Optional, Tuple
+
+from app import series as time_slot_series
+
+TimeSlotRow = namedtuple("TimeSlotRow", ["id", "start_at", "end_at"])
+
+
+class UserIntervals:
+    # slots of one user never overlap, so sorted by start_at their end_at is sorted as well
+    __slots__ = ("starts", "ends", "ids", "series", "version", "loaded_at")
+
+    # version is the user's time_slot_version read with the rows, the ETag of their list
+    def __init__(self, rows: Iterable[Tuple[int, int, int]], series: Iterable = (), version: int = 0):
+        rows = sorted(rows, key=lambda row: row[1])
+        self.ids = [row[0] for row in rows]
+        self.starts = [row[1] for row in rows]
+        self.ends = [row[2] for row in rows]
+        self.series = list(series)
+        self.version = version
+        self.loaded_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def overlaps(self, start_at: int, end_at: int) -> bool:
+        idx = bisect_right(self.ends, start_at)
+        if idx < len(self.starts) and self.starts[idx] < end_at:
+            return True
+        return any(time_slot_series.overlaps(series, start_at, end_at) for series in self.series)
+
+    def add(self, target_id: int, start_at: int, end_at: int):
+        idx = bisect_left(self.starts, start_at)
+        self.ids.insert(idx, target_id)
+        self.starts.insert(idx, start_at)
+        self.ends.insert(idx, end_at)
+
+    def remove(self, target_id: int) -> bool:
+        try:
+            idx = self.ids.index(target_id)
+        except ValueError:
+            return False
+        del self.ids[idx], self.starts[idx], self.ends[idx]
+        return True
+
+    def list(self, before_timestamp: int = None, after_timestamp: int = None) -> List[TimeSlotRow]:
+        # same filters as TimeSlotController.list, both are on end_at
+        lo = bisect_right(self.ends, after_timestamp) if after_timestamp else 0
+        hi = bisect_left(self.ends, before_timestamp) if before_timestamp else len(self.ends)
+        rows = [TimeSlotRow(self.ids[idx], self.starts[idx], self.ends[idx]) for idx in range(lo, hi)]
+        return list(time_slot_series.merge(rows, self.series, before_timestamp, after_timestamp))
+
+
+# Per-user intervals kept in process memory and evicted LRU once max_intervals are cached.
+# Only writes made through this process update the cache, entries older than ttl seconds are
+# reloaded so writes from other workers become visible within ttl. A write passes the version it
+# bumped the user to, an entry which missed a version in between is dropped instead of updated.
+class IntervalCache:
+
+    def __init__(self, max_intervals: int, ttl: float = 60.0):
+        self.max_intervals = max_intervals
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        self._users = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    # callers hold self._lock
+    def _get(self, user_id: int) -> Optional[UserIntervals]:
+        intervals = self._users.get(user_id)
+        if intervals is not None and time.monotonic() - intervals.loaded_at > self.ttl:
+            self._discard(user_id)
+            intervals = None
+        if intervals is None:
+            self.misses += 1
+            return None
+        self._users.move_to_end(user_id)
+        self.hits += 1
+        return intervals
+
+    # call before querying the user's slots, put is dropped if the user was written in between
+    def begin_load(self, user_id: int) -> object:
+        token = object()
+        with self._lock:
+            self._loading[user_id] = token
+        return token
+
+    def put(self, user_id: int, intervals: UserIntervals, token: object):
+        with self._lock:
+            if self._loading.get(user_id) is not token:
+                return
+            del self._loading[user_id]
+            if len(intervals) > self.max_intervals:
+                return
+            self._discard(user_id)
+            self._users[user_id] = intervals
+            self._size += len(intervals)
+            self._evict()
+
+    # callers hold self._lock, the entry of user_id when version directly follows it
+    def _advance(self, user_id: int, version: int) -> Optional[UserIntervals]:
+        self._loading.pop(user_id, None)
+        intervals = self._users.get(user_id)
+        if intervals is None or version <= intervals.version:
+            # loaded after the write, the entry has it already
+            return None
+        if version > intervals.version + 1:
+            # a write of another worker came in between
+            self._discard(user_id)
+            return None
+        intervals.version = version
+        return intervals
+
+    def add(self, user_id: int, target_id: int, start_at: int, end_at: int, version: int):
+        self.add_many(user_id, [(target_id, start_at, end_at)], version)
+
+    # (id, start_at, end_at) rows created by one write
+    def add_many(self, user_id: int, rows: Iterable[Tuple[int, int, int]], version: int):
+        with self._lock:
+            intervals = self._advance(user_id, version)
+            if intervals is None:
+                return
+            for target_id, start_at, end_at in rows:
+                intervals.add(target_id, start_at, end_at)
+                self._size += 1
+            self._evict()
+
+    def remove(self, user_id: int, target_id: int, version: int):
+        with self._lock:
+            intervals = self._advance(user_id, version)
+            if intervals is not None and intervals.remove(target_id):
+                self._size -= 1
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._loading.pop(user_id, None)
+            self._discard(user_id)
+
+    # lookups return None on a miss, the caller loads the user and puts it
+    def overlaps(self, user_id: int, start_at: int, end_at: int) -> Optional[bool]:
+        with self._lock:
+            intervals = self._get(user_id)
+            return None if intervals is None else intervals.overlaps(start_at, end_at)
+
+    def version(self, user_id: int) -> Optional[int]:
+        with self._lock:
+            intervals = self._get(user_id)
+            return None if intervals is None else intervals.version
+
+    def list(self, user_id: int, before_timestamp: int = None, after_timestamp: int = None) -> Optional[list]:
+        with self._lock:
+            intervals = self._get(user_id)
+            return None if intervals is None else intervals.list(before_timestamp, after_timestamp)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "users": len(self._users),
+                "intervals": self._size,
+            }
+
+    def _discard(self, user_id: int):
+        intervals = self._users.pop(user_id, None)
+        if intervals is not None:
+            self._size -= len(intervals)
+
+    def _evict(self):
+        while self._size > self.max_intervals and self._users:
+            _, intervals = self._users.popitem(last=False)
+            self._size -= len(intervals)
+            self.evictions += 1
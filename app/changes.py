@@ -0,0 +1,210 @@
+import asyncio
+import itertools
+import logging
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set
+
+import orjson
+from sqlalchemy import Text, case, cast, func, literal_column, select
+from sqlalchemy.engine import Engine
+
+from app import errors
+from app.metrics import CHANGE_FEED_RESYNCS, CHANGE_FEED_SUBSCRIBERS
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "time_slot_changes"
+# NOTIFY payloads are limited to 8000 bytes, bulk changes are split into events of at most this many items
+MAX_EVENT_ITEMS = 100
+
+HEARTBEAT = object()
+# the subscriber may have missed events and has to reload, e.g. after it fell behind or the listener reconnected
+RESYNC = {"event": "resync"}
+
+
+# NOTIFY statements for one change of user_id, sent by Postgres to the listeners when the transaction commits
+def notify_statements(user_id: int, event: str, items: Iterable[dict]) -> list:
+    items = list(items)
+    return [
+        select(func.pg_notify(CHANNEL, orjson.dumps({
+            "user_id": user_id, "event": event, "data": items[idx:idx + MAX_EVENT_ITEMS]
+        }).decode()))
+        for idx in range(0, len(items), MAX_EVENT_ITEMS)
+    ]
+
+
+# The rows of changed, a data-modifying CTE returning user_id, id and item_columns, sending one event of at
+# most MAX_EVENT_ITEMS items per user with them, so a write and its events are one statement. With bumped,
+# the versions CTE of the same statement, every row also carries the new version of its user.
+def notifying_select(changed, event: str, item_columns: Iterable[str], bumped=None):
+    numbered = select(
+        changed,
+        ((func.row_number().over(partition_by=changed.c.user_id, order_by=changed.c.id) - 1) / MAX_EVENT_ITEMS)
+        .label("event_chunk")
+    ).subquery("numbered")
+    chunk = (numbered.c.user_id, numbered.c.event_chunk)
+    items = func.json_agg(func.json_build_object(*itertools.chain.from_iterable(
+        (literal_column(f"'{name}'"), numbered.c[name]) for name in item_columns
+    ))).over(partition_by=chunk)
+    payload = func.json_build_object(
+        literal_column("'user_id'"), numbered.c.user_id, literal_column("'event'"), literal_column(f"'{event}'"),
+        literal_column("'data'"), items
+    )
+    notify = func.pg_notify(literal_column(f"'{CHANNEL}'"), cast(payload, Text))
+    notified = case((func.row_number().over(partition_by=chunk) == 1, notify)).label("notified")
+    columns = [numbered.c[column.key] for column in changed.c]
+    if bumped is None:
+        return select(*columns, notified)
+    return select(*columns, bumped.c.version, notified).join_from(
+        numbered, bumped, bumped.c.user_id == numbered.c.user_id
+    )
+
+
+# one event without items per user of a subquery with a user_id column, for changes too large to list
+def notify_users_statement(users, event: str):
+    user_ids = select(users.c.user_id).distinct().subquery()
+    payload = func.json_build_object("user_id", user_ids.c.user_id, "event", event, "data", func.json_build_array())
+    return select(func.pg_notify(CHANNEL, cast(payload, Text))).select_from(user_ids)
+
+
+def slot_items(rows: Iterable) -> List[dict]:
+    return [{"id": row.id, "start_at": row.start_at, "end_at": row.end_at} for row in rows]
+
+
+class Subscription:
+    __slots__ = ("user_id", "queue")
+
+    def __init__(self, user_id: int, queue_size: int):
+        self.user_id = user_id
+        self.queue = asyncio.Queue(queue_size)
+
+    def put(self, event):
+        if self.queue.full():
+            # a slow client is not allowed to hold memory, it drops what is queued and reloads instead
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            CHANGE_FEED_RESYNCS.inc()
+            event = RESYNC
+        self.queue.put_nowait(event)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+# One LISTEN connection per worker process, read from the event loop without a thread. Subscribers are
+# a queue each, indexed by user, so an idle subscriber costs no database work and no timer: a single
+# heartbeat task wakes all of them.
+class ChangeFeed:
+    def __init__(
+        self, engine: Engine, heartbeat: float = 15.0, queue_size: int = 100, reconnect_delay: float = 1.0
+    ):
+        self.engine = engine
+        self.heartbeat = heartbeat
+        self.queue_size = queue_size
+        self.reconnect_delay = reconnect_delay
+        self._subscriptions: Dict[int, Set[Subscription]] = defaultdict(set)
+        self._conn = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def subscribers(self) -> int:
+        return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    async def start(self):
+        if self._loop is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        try:
+            await self._connect()
+        except Exception as e:
+            self._loop = None
+            raise errors.ChangeFeedError(f"listening on {CHANNEL} failed: {e}") from e
+        self._tasks.append(asyncio.create_task(self._send_heartbeats()))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._disconnect()
+        self._loop = None
+
+    async def subscribe(self, user_id: int) -> Subscription:
+        await self.start()
+        subscription = Subscription(user_id, self.queue_size)
+        self._subscriptions[user_id].add(subscription)
+        CHANGE_FEED_SUBSCRIBERS.inc()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscriptions.get(subscription.user_id)
+        if subscriptions is None or subscription not in subscriptions:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscriptions[subscription.user_id]
+        CHANGE_FEED_SUBSCRIBERS.dec()
+
+    def publish(self, event: dict):
+        for subscription in self._subscriptions.get(event["user_id"], ()):
+            subscription.put(event)
+
+    def _broadcast(self, event):
+        for subscriptions in self._subscriptions.values():
+            for subscription in subscriptions:
+                subscription.put(event)
+
+    async def _connect(self):
+        # a dedicated DBAPI connection, LISTEN must not be handed back to the pool
+        cargs, cparams = self.engine.dialect.create_connect_args(self.engine.url)
+        dbapi = self.engine.dialect.dbapi
+        conn = await self._loop.run_in_executor(None, lambda: dbapi.connect(*cargs, **cparams))
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL}")
+        self._conn = conn
+        self._loop.add_reader(conn.fileno(), self._read)
+
+    def _disconnect(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        try:
+            self._loop.remove_reader(conn.fileno())
+            conn.close()
+        except Exception as e:
+            logger.warning(f"Closing the change feed connection failed: {e}")
+
+    def _read(self):
+        try:
+            self._conn.poll()
+        except Exception as e:
+            logger.warning(f"Change feed connection lost: {e}")
+            self._disconnect()
+            self._tasks.append(asyncio.create_task(self._reconnect()))
+            return
+        notifies, self._conn.notifies[:] = self._conn.notifies[:], []
+        for notify in notifies:
+            try:
+                event = orjson.loads(notify.payload)
+            except orjson.JSONDecodeError:
+                logger.warning(f"Malformed change event: {notify.payload!r}")
+                continue
+            self.publish(event)
+
+    async def _reconnect(self):
+        while self._loop is not None:
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await self._connect()
+            except Exception as e:
+                logger.warning(f"Reconnecting the change feed failed: {e}")
+                continue
+            # whatever was committed while disconnected is lost
+            self._broadcast(RESYNC)
+            return
+
+    async def _send_heartbeats(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            self._broadcast(HEARTBEAT)
@@ -0,0 +1,64 @@
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from app import schemas, errors, series
+from app.metrics import count_rejections
+from .base import BaseController
+from .time_slot import (
+    TimeSlotController, _delete_statement, _insert_statement, _is_overlap_violation, _listing_params, _split_listing
+)
+
+
+class AsyncTimeSlotController(BaseController):
+    # db must be a sessionmaker with class_=AsyncSession
+
+    _check_basic = TimeSlotController._check_basic
+
+    async def _execute(self, sess, statement, params: dict = None):
+        if self.plan_sampler.should_sample():
+            await self.plan_sampler.async_explain(sess, statement, params)
+        return await sess.execute(statement, params)
+
+    async def get(self, user_id: int, **kwargs):
+        pass
+
+    # slots merged with the occurrences of the user's series, like TimeSlotController.list_rows
+    async def list(self, user_id: int, before_timestamp: int = None, after_timestamp: int = None):
+        async with self.db() as sess:
+            result = await self._execute(sess, *_listing_params([user_id], before_timestamp, after_timestamp))
+            all_series, time_slots = _split_listing(result)
+        if not all_series:
+            return time_slots
+        return list(series.merge(time_slots, all_series, before_timestamp, after_timestamp))
+
+    @count_rejections
+    async def create(self, time_slot: schemas.TimeSlotCreate, now: int = None):
+        if now is None:
+            now = int(datetime.utcnow().timestamp())
+        self._check_basic(time_slot, now)
+        async with self.db() as sess:
+            # one statement bumping the version, inserting and notifying, like in TimeSlotController.create
+            try:
+                statement, params = _insert_statement([time_slot])
+                db_time_slot = (await self._execute(sess, statement, params)).first()
+                if db_time_slot is None:
+                    # run once more in case it read an outdated snapshot, see TimeSlotController._execute_fresh
+                    db_time_slot = (await self._execute(sess, statement, params)).first()
+                if db_time_slot is not None:
+                    await sess.commit()
+            except IntegrityError as e:
+                if not _is_overlap_violation(e):
+                    raise
+                db_time_slot = None
+        if db_time_slot is None:
+            raise errors.TimeOverlapError
+        return db_time_slot
+
+    async def delete(self, user_id: int, target_id: int, *args) -> bool:
+        async with self.db() as sess:
+            result = await self._execute(sess, *_delete_statement(user_id, target_id))
+            deleted = result.first()
+            if deleted is not None:
+                await sess.commit()
+        return deleted is not None
@@ -1,13 +1,51 @@
 import abc
+from contextlib import contextmanager
+from typing import Callable, Iterator
 
 from pydantic import BaseModel
 
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+
+from app.profiling import QueryPlanSampler
+from app.settings import settings
+from app.unit_of_work import current_unit_of_work
 
 
 class BaseController(abc.ABC):
-    def __init__(self, db: sessionmaker):
+    def __init__(self, db: sessionmaker, plan_sampler: QueryPlanSampler = None):
         self.db = db
+        if plan_sampler is None:
+            plan_sampler = QueryPlanSampler(settings.query_plan_sample_rate)
+        self.plan_sampler = plan_sampler
+
+    # Inside a request the session comes from its unit of work and is committed once at the end of the
+    # request, outside of one (tests, scripts) every call opens and commits its own.
+    @contextmanager
+    def _session(self, db: sessionmaker = None) -> Iterator[Session]:
+        db = db or self.db
+        uow = current_unit_of_work()
+        if uow is not None:
+            yield uow.session(db)
+            return
+        with db() as sess:
+            yield sess
+
+    def _commit(self, sess: Session):
+        if current_unit_of_work() is None:
+            sess.commit()
+
+    def _after_commit(self, callback: Callable[[], None]):
+        uow = current_unit_of_work()
+        if uow is None:
+            callback()
+        else:
+            uow.after_commit(callback)
+
+    # params go with statements built once at module level, e.g. bump_statement
+    def _execute(self, sess: Session, statement, params: dict = None):
+        if self.plan_sampler.should_sample():
+            self.plan_sampler.explain(sess, statement, params)
+        return sess.execute(statement, params)
 
     @abc.abstractmethod
     def get(self, user_id: int, **kwargs):
@@ -0,0 +1,18 @@
+from typing import Dict
+
+from .base import BaseController
+
+
+# controllers are built once at startup and shared by all requests, they keep no per-request state
+class ControllerRegistry:
+    def __init__(self):
+        self._controllers: Dict[str, BaseController] = {}
+
+    def register(self, name: str, controller: BaseController):
+        self._controllers[name] = controller
+
+    def get(self, name: str) -> BaseController:
+        try:
+            return self._controllers[name]
+        except KeyError:
+            raise Exception("Controller not exist")
@@ -1,75 +1,923 @@
+import functools
+import itertools
+from bisect import bisect_right
 from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
-from psycopg2.extras import NumericRange
+import numpy as np
+from sqlalchemy import (
+    BigInteger, Column, Integer, MetaData, Table, Text, and_, bindparam, case, cast, delete, exists, func, insert,
+    literal, literal_column, null, or_, select, true, tuple_, union_all, update
+)
 from sqlalchemy.dialects.postgresql import ARRAY
-from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, sessionmaker
 
-from app import models, schemas, errors
+from app import models, schemas, errors, series
+from app.cache import IntervalCache, TimeSlotRow, UserIntervals
+from app.changes import notify_users_statement, notifying_select
+from app.group_commit import GroupCommitWriter
+from app.intervals import free_gaps, merge_intervals
+from app.metrics import count_rejections
+from app.profiling import QueryPlanSampler
+from app.replicas import ReplicaRouter
+from app.unit_of_work import current_unit_of_work
+from app.versions import (
+    BUMPED, bump_params, bump_select_statement, bump_statement, bumped_from_snapshot, version_query, versions_query
+)
 from .base import BaseController
 
+EXCLUSION_VIOLATION = "23P01"
+MAX_SLOT_DURATION = 86400
+DELETE_CHUNK_SIZE = 1000
+# kind of a row of _listing_statement
+_VERSION_ROW, _SERIES_ROW, _SLOT_ROW = -1, 0, 1
+
+_SERIES_COLUMNS = (
+    models.TimeSlotSeries.id, models.TimeSlotSeries.user_id, models.TimeSlotSeries.start_at,
+    models.TimeSlotSeries.end_at, models.TimeSlotSeries.every, models.TimeSlotSeries.occurrences
+)
+
+
+# rows of an import, created per transaction and dropped with its commit
+_import_staging = Table(
+    "time_slot_import", MetaData(),
+    Column("line", Integer, primary_key=True),
+    Column("user_id", Integer, nullable=False),
+    Column("start_at", Integer, nullable=False),
+    Column("end_at", Integer, nullable=False),
+    Column("reason", Text),
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP",
+)
+
+
+# file-like object for COPY ... FROM STDIN WITH (FORMAT csv) reading (line, user_id, start_at, end_at) rows
+class _CopyRows:
+    def __init__(self, rows: Iterable[Tuple[int, int, int, int]]):
+        self._lines = (f"{line},{user_id},{start_at},{end_at}\n" for line, user_id, start_at, end_at in rows)
+        self._buffer = ""
+
+    def read(self, size: int = -1) -> str:
+        parts = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            parts.append(line)
+            length += len(line)
+        data = "".join(parts)
+        if size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
+
+    readline = read
+
+
+def _is_overlap_violation(e: IntegrityError) -> bool:
+    return getattr(e.orig, "pgcode", None) == EXCLUSION_VIOLATION
+
+
+# Writes bump the version, change the rows and send their change events in one statement. The bump is
+# the first CTE, its version row lock orders the write after a concurrent create_series of the same user.
+def _insert_slots():
+    # slots overlapping a series are left out of the insert and missing from RETURNING, the exclusion
+    # constraint only covers slots against slots
+    table = models.TimeSlot.__table__
+    new_slots = series.without_series_overlap()
+    new_slots = new_slots.where(bumped_from_snapshot(new_slots.selected_columns.user_id))
+    changed = insert(table).from_select(["user_id", "start_at", "end_at"], new_slots).returning(
+        table.c.id, table.c.user_id, table.c.created_at, table.c.start_at, table.c.end_at
+    ).cte("changed")
+    return notifying_select(changed, "created", ("id", "start_at", "end_at"), BUMPED)
+
+
+def _delete_slot():
+    table = models.TimeSlot.__table__
+    changed = delete(table).where(
+        table.c.user_id == bindparam("user_id"), table.c.id == bindparam("target_id")
+    ).returning(table.c.id, table.c.user_id).cte("changed")
+    return notifying_select(changed, "deleted", ("id",), BUMPED)
+
+
+def _insert_series():
+    table = models.TimeSlotSeries.__table__
+    changed = insert(table).values(
+        user_id=bindparam("user_id"), start_at=bindparam("start_at"), end_at=bindparam("end_at"),
+        every=bindparam("every"), occurrences=bindparam("occurrences")
+    ).returning(*(table.c[column.key] for column in _SERIES_COLUMNS)).cte("changed")
+    # create_series bumped the version before its checks
+    return notifying_select(changed, "series_created", ("id", "start_at", "end_at", "every", "occurrences"))
+
+
+def _delete_series():
+    table = models.TimeSlotSeries.__table__
+    changed = delete(table).where(
+        table.c.user_id == bindparam("user_id"), table.c.id == bindparam("series_id")
+    ).returning(table.c.id, table.c.user_id).cte("changed")
+    return notifying_select(changed, "series_deleted", ("id",), BUMPED)
+
+
+# built once, a write only passes its values instead of building and walking the statement again
+_INSERT_SLOTS = _insert_slots()
+_DELETE_SLOT = _delete_slot()
+_INSERT_SERIES = _insert_series()
+_DELETE_SERIES = _delete_series()
+
+
+def _insert_statement(time_slots: List[schemas.TimeSlotCreate]) -> tuple:
+    params = series.new_slot_params(time_slots)
+    params.update(bump_params(time_slot.user_id for time_slot in time_slots))
+    return _INSERT_SLOTS, params
+
+
+def _int_any(name: str, values: List[int] = None):
+    # any_() has no cache key in this SQLAlchemy version, func.any renders the same SQL and is cached
+    return func.any(bindparam(name, values, type_=ARRAY(Integer)))
+
+
+def _user_ids_filter(user_ids: List[int]):
+    # one array parameter whatever the number of users
+    return models.TimeSlot.user_id == _int_any("user_ids", user_ids)
+
+
+def _series_query(user_ids: List[int], before_timestamp: int = None, after_timestamp: int = None):
+    return select(*_SERIES_COLUMNS).filter(
+        models.TimeSlotSeries.user_id == _int_any("series_user_ids", user_ids),
+        *series.span_filter(before_timestamp, after_timestamp)
+    )
+
+
+# Slots and series of the users in one round trip, series rows first so they are known before the slots
+# they are merged with. Built once per combination of filters, the values come with _listing_params. A page
+# only reads the slots after its cursor, at most page_limit of them, the series are expanded from the cursor.
+# With versions the version of each user comes first, in the id column, read in the snapshot of the rows.
+@functools.lru_cache(maxsize=None)
+def _listing_statement(
+        before: bool, after: bool, cursor: bool = False, limited: bool = False, versions: bool = False
+):
+    slot = models.TimeSlot
+    recurring = models.TimeSlotSeries
+    before_timestamp = bindparam("before_timestamp", type_=Integer)
+    after_timestamp = bindparam("after_timestamp", type_=Integer)
+    slots = select(
+        literal_column(str(_SLOT_ROW)).label("kind"), slot.user_id, slot.id, slot.start_at, slot.end_at,
+        null().label("every"), null().label("occurrences")
+    ).filter(slot.user_id == _int_any("user_ids"))
+    all_series = select(
+        literal_column(str(_SERIES_ROW)).label("kind"), recurring.user_id, recurring.id, recurring.start_at,
+        recurring.end_at, recurring.every, recurring.occurrences
+    ).filter(recurring.user_id == _int_any("user_ids"))
+    # the filters of _timestamp_filter and series.span_filter
+    if before:
+        slots = slots.filter(slot.end_at < before_timestamp, slot.start_at < before_timestamp)
+        all_series = all_series.filter(recurring.end_at < before_timestamp)
+    if after:
+        slots = slots.filter(slot.end_at > after_timestamp, slot.start_at > after_timestamp - MAX_SLOT_DURATION)
+        all_series = all_series.filter(recurring.last_end_at > after_timestamp)
+    if cursor:
+        cursor_start_at = bindparam("cursor_start_at", type_=Integer)
+        # the plain start_at bound lets the (user_id, start_at, end_at) index range scan to the cursor
+        slots = slots.filter(slot.start_at >= cursor_start_at, tuple_(
+            slot.start_at, literal_column(str(_SLOT_ROW)), slot.id
+        ) > tuple_(cursor_start_at, bindparam("cursor_kind", type_=Integer), bindparam("cursor_id", type_=Integer)))
+        all_series = all_series.filter(recurring.last_end_at > cursor_start_at)
+    if limited:
+        slots = slots.order_by(slot.start_at, slot.id).limit(bindparam("page_limit", type_=Integer))
+    listing = union_all(all_series, slots)
+    if versions:
+        listing = union_all(select(
+            literal_column(str(_VERSION_ROW)).label("kind"), models.TimeSlotVersion.user_id,
+            models.TimeSlotVersion.version.label("id"), null().label("start_at"), null().label("end_at"),
+            null().label("every"), null().label("occurrences")
+        ).filter(models.TimeSlotVersion.user_id == _int_any("user_ids")), all_series, slots)
+    columns = listing.selected_columns
+    return listing.order_by(columns.kind, columns.user_id, columns.start_at, columns.id)
+
+
+def _listing_params(
+        user_ids: List[int], before_timestamp: int = None, after_timestamp: int = None,
+        cursor: Tuple[int, int, int] = None, limit: int = None, versions: bool = False
+) -> tuple:
+    params = {"user_ids": user_ids, "before_timestamp": before_timestamp, "after_timestamp": after_timestamp}
+    if cursor:
+        params.update(cursor_start_at=cursor[0], cursor_kind=cursor[1], cursor_id=cursor[2])
+    if limit is not None:
+        params["page_limit"] = limit
+    statement = _listing_statement(
+        bool(before_timestamp), bool(after_timestamp), bool(cursor), limit is not None, versions
+    )
+    return statement, params
+
+
+# position of a listed row in the order of list_page, occurrences of a series are keyed by its id
+def _page_key(row) -> Tuple[int, int, int]:
+    if row.id is None:
+        return row.start_at, _SERIES_ROW, row.series_id
+    return row.start_at, _SLOT_ROW, row.id
+
+
+# splits rows of _listing_statement into the series and the (id, start_at, end_at) rows of the slots
+def _split_listing(rows: Iterable) -> Tuple[list, list]:
+    all_series, slots = [], []
+    for row in rows:
+        if row[0] == _SERIES_ROW:
+            all_series.append(row)
+        else:
+            slots.append(TimeSlotRow(row[2], row[3], row[4]))
+    return all_series, slots
+
+
+def _window_filter(start_at: int, end_at: int):
+    # slots last at most MAX_SLOT_DURATION, which bounds start_at on both sides for the btree index
+    return (
+        models.TimeSlot.start_at > start_at - MAX_SLOT_DURATION,
+        models.TimeSlot.start_at < end_at,
+        models.TimeSlot.end_at > start_at,
+    )
+
+
+# whether a stored slot or series occurrence of the user overlaps [start_at, end_at), one indexed probe each
+def _overlap_probe():
+    user_id = bindparam("user_id", type_=Integer)
+    start_at, end_at = bindparam("start_at", type_=Integer), bindparam("end_at", type_=Integer)
+    slots = exists().where(and_(models.TimeSlot.user_id == user_id, *_window_filter(start_at, end_at)))
+    return select(or_(slots, series.overlapping(user_id, start_at, end_at)))
+
+
+_OVERLAP_PROBE = _overlap_probe()
+
+
+# (start_at, end_at) of the stored slots and series occurrences of user_ids overlapping [lower, upper)
+def _busy_query(user_ids: List[int], lower: int, upper: int):
+    slots = select(
+        cast(models.TimeSlot.start_at, BigInteger).label("start_at"), cast(models.TimeSlot.end_at, BigInteger)
+    ).filter(_user_ids_filter(user_ids), *_window_filter(lower, upper))
+    # occurrences k of a series from the first ending after lower to the last starting before upper
+    recurring = models.TimeSlotSeries
+    behind = cast(lower, BigInteger) - recurring.end_at
+    first = case((behind < 0, 0), else_=behind / recurring.every + 1)
+    last = func.least(recurring.occurrences - 1, (cast(upper, BigInteger) - 1 - recurring.start_at) / recurring.every)
+    ks = func.generate_series(first, last).table_valued("k").render_derived(name="ks")
+    k = ks.c.k
+    occurrences = select(
+        recurring.start_at + k * recurring.every, recurring.end_at + k * recurring.every
+    ).select_from(models.TimeSlotSeries.__table__.join(ks, true())).filter(
+        recurring.user_id == _int_any("series_user_ids", user_ids),
+        recurring.start_at < upper, recurring.last_end_at > lower
+    )
+    return union_all(slots, occurrences)
+
+
+# the occurrences of the series of user_ids, of all users when None, in the columns of iter_export
+def _export_occurrences(user_ids: List[int] = None):
+    recurring = models.TimeSlotSeries
+    ks = func.generate_series(0, recurring.occurrences - 1).table_valued("k").render_derived(name="ks")
+    offset = ks.c.k * recurring.every
+    query = select(
+        null().label("id"), recurring.user_id, (cast(recurring.start_at, BigInteger) + offset).label("start_at"),
+        (cast(recurring.end_at, BigInteger) + offset).label("end_at"), recurring.created_at,
+        recurring.id.label("series_id")
+    ).select_from(models.TimeSlotSeries.__table__.join(ks, true())).order_by(recurring.id, ks.c.k)
+    if user_ids is not None:
+        query = query.filter(recurring.user_id == _int_any("series_user_ids", user_ids))
+    return query
+
+
+def _series_insert_statement(user_id: int, time_slot_series: schemas.TimeSlotSeriesBase) -> tuple:
+    return _INSERT_SERIES, {
+        "user_id": user_id, "start_at": time_slot_series.start_at, "end_at": time_slot_series.end_at,
+        "every": time_slot_series.every, "occurrences": time_slot_series.occurrences,
+    }
+
+
+# the bump of a delete matching nothing is rolled back, callers only commit when a row was deleted
+def _delete_statement(user_id: int, target_id: int) -> tuple:
+    return _DELETE_SLOT, {"user_id": user_id, "target_id": target_id, **bump_params([user_id])}
+
+
+def _series_delete_statement(user_id: int, series_id: int) -> tuple:
+    return _DELETE_SERIES, {"user_id": user_id, "series_id": series_id, **bump_params([user_id])}
+
+
+def _overlaps_in_batch(time_slots: List[schemas.TimeSlotCreate]) -> set:
+    # sort and sweep: every group of transitively overlapping slots with more than one member is rejected
+    order = sorted(range(len(time_slots)), key=lambda i: time_slots[i].start_at)
+    overlapped = set()
+    group, group_end = [], None
+    for idx in order:
+        if group and time_slots[idx].start_at < group_end:
+            group.append(idx)
+            group_end = max(group_end, time_slots[idx].end_at)
+            continue
+        if len(group) > 1:
+            overlapped.update(group)
+        group, group_end = [idx], time_slots[idx].end_at
+    if len(group) > 1:
+        overlapped.update(group)
+    return overlapped
+
+
+def _overlaps_stored(starts: List[int], ends: List[int], time_slot: schemas.TimeSlotCreate) -> bool:
+    # stored slots never overlap each other, so sorted by start_at their end_at is sorted as well
+    idx = bisect_right(ends, time_slot.start_at)
+    return idx < len(starts) and starts[idx] < time_slot.end_at
+
 
 class TimeSlotController(BaseController):
+    def __init__(
+        self,
+        db: sessionmaker,
+        plan_sampler: QueryPlanSampler = None,
+        cache: IntervalCache = None,
+        writer: GroupCommitWriter = None,
+        router: ReplicaRouter = None,
+    ):
+        super().__init__(db, plan_sampler)
+        self.cache = cache
+        self.writer = writer
+        self.router = router
+
+    # Reads of the given users may go to a replica, writes, versions and cache loads always use self.db. The
+    # controller is shared, a choice is only kept in the request's unit of work until its next write.
+    def _read_db(self, *user_ids: int) -> sessionmaker:
+        if self.router is None:
+            return self.db
+        uow = current_unit_of_work()
+        if uow is None:
+            return self.router.for_read(*user_ids)
+        db = uow.read_dbs.get(user_ids)
+        if db is None:
+            db = self.router.for_read(*user_ids)
+            if db is not self.router.primary and self._replica_behind(db, uow.versions, user_ids):
+                db = self.router.primary
+            uow.read_dbs[user_ids] = db
+        return db
+
+    # Whether the replica has not replayed a version of user_ids the request read from the primary, e.g. of a
+    # write made through another worker, which the router of this process does not know about
+    def _replica_behind(self, db: sessionmaker, versions: Dict[int, int], user_ids: Tuple[int, ...]) -> bool:
+        known = {user_id: versions[user_id] for user_id in user_ids if user_id in versions}
+        if not known:
+            return False
+        with self._session(db) as sess:
+            replayed = dict(self._execute(sess, versions_query(known)).all())
+        return any(replayed.get(user_id, 0) < version for user_id, version in known.items())
+
+    def _wrote(self, user_id: int):
+        if self.router is not None:
+            self.router.mark_write(user_id)
+            uow = current_unit_of_work()
+            if uow is not None:
+                uow.read_dbs.clear()
+
+    # Runs one of the inserts checking against the snapshot, see bumped_from_snapshot. Nothing returned may
+    # also mean a write of the same user committed while the statement waited for the version row lock, it
+    # is run once more holding the lock.
+    def _execute_fresh(self, sess: Session, statement, params: dict) -> list:
+        rows = self._execute(sess, statement, params).all()
+        if not rows:
+            rows = self._execute(sess, statement, params).all()
+        return rows
 
     def _check_basic(self, time_slot: schemas.TimeSlotCreate, now: int):
         if time_slot.start_at >= time_slot.end_at:
             raise errors.TimeFormatError("start_at must less than end_at")
         if time_slot.start_at <= now:
             raise errors.TimeFormatError("start_at must greater than now")
-        if (time_slot.end_at - time_slot.start_at) > 86400:
+        if (time_slot.end_at - time_slot.start_at) > MAX_SLOT_DURATION:
             raise errors.TimeFormatError("range start_at and end_at must in 24 hours")
 
-    def _check_overlap(self, sess: Session, time_slot: schemas.TimeSlotCreate):
-        query = sess.execute(
-            """
-            SELECT * 
-            FROM time_slot 
-            WHERE user_id=:user_id AND int8range(start_at, end_at) && int8range(:start_at, :end_at) 
-            """,
-            {"user_id": time_slot.user_id, "start_at": time_slot.start_at, "end_at": time_slot.end_at}
-        )
-        c = sess.execute(
-            """
-            EXPLAIN
-            SELECT * 
-            FROM time_slot 
-            WHERE user_id=:user_id AND int8range(start_at, end_at) && int8range(:start_at, :end_at) 
-            """,
-             {"user_id": time_slot.user_id, "start_at": time_slot.start_at, "end_at": time_slot.end_at}
-        )
-
-        print(c.first())
-        a = query.first()
-        print(a)
-        if a:
-            raise errors.TimeOverlapError
-
     def get(self, user_id: int, **kwargs):
         pass
 
-    def list(self, user_id: int, before_timestamp: int = None, after_timestamp: int = None):
-        with self.db() as sess:
-            query = sess.query(models.TimeSlot).filter_by(user_id=user_id).order_by(models.TimeSlot.start_at)
-            if before_timestamp:
-                query = query.filter(models.TimeSlot.end_at < before_timestamp)
-            if after_timestamp:
-                query = query.filter(models.TimeSlot.end_at > after_timestamp)
-            return query.all()
+    # the implied start_at bounds let a table partitioned by start_at skip partitions outside the range
+    def _timestamp_filter(self, query, before_timestamp: int = None, after_timestamp: int = None):
+        if before_timestamp:
+            query = query.filter(
+                models.TimeSlot.end_at < before_timestamp, models.TimeSlot.start_at < before_timestamp
+            )
+        if after_timestamp:
+            query = query.filter(
+                models.TimeSlot.end_at > after_timestamp,
+                models.TimeSlot.start_at > after_timestamp - MAX_SLOT_DURATION
+            )
+        return query
 
-    def create(self, time_slot: schemas.TimeSlotCreate, now: int = int(datetime.utcnow().timestamp())):
+    # its own session, a cached entry must not include uncommitted writes of the request
+    def _load_intervals(self, user_id: int) -> UserIntervals:
+        token = self.cache.begin_load(user_id)
         with self.db() as sess:
-            self._check_basic(time_slot, now)
-            self._check_overlap(sess, time_slot)
-            db_time_slot = models.TimeSlot(
-                user_id=time_slot.user_id,
-                start_at=time_slot.start_at,
-                end_at=time_slot.end_at
+            rows = self._execute(sess, *_listing_params([user_id], versions=True)).all()
+        version = 0
+        if rows and rows[0].kind == _VERSION_ROW:
+            version, rows = rows[0].id, rows[1:]
+        all_series, slots = _split_listing(rows)
+        intervals = UserIntervals(slots, all_series, version)
+        self.cache.put(user_id, intervals, token)
+        return intervals
+
+    def _list_cached(self, user_id: int, before_timestamp: int = None, after_timestamp: int = None) -> list:
+        time_slots = self.cache.list(user_id, before_timestamp, after_timestamp)
+        if time_slots is not None:
+            return time_slots
+        return self._load_intervals(user_id).list(before_timestamp, after_timestamp)
+
+    # version of the user's slots, bumped by every write, 0 before the first one. With the interval cache it
+    # is the version of the cached entry, which tags exactly the list served from it. Read from the primary, the
+    # request's later reads only go to a replica which replayed it, see _read_db.
+    def version(self, user_id: int) -> Optional[int]:
+        if self.cache is not None:
+            version = self.cache.version(user_id)
+            return self._load_intervals(user_id).version if version is None else version
+        with self._session() as sess:
+            version = self._execute(sess, version_query(user_id)).scalar() or 0
+        uow = current_unit_of_work()
+        if uow is not None:
+            uow.versions[user_id] = version
+        return version
+
+    # (id, start_at, end_at) rows of the slots merged with the occurrences of the user's series, like list_rows
+    def list(self, user_id: int, before_timestamp: int = None, after_timestamp: int = None):
+        return self.list_rows(user_id, before_timestamp, after_timestamp)
+
+    # (id, start_at, end_at) rows from one Core select of slots and series, skipping ORM instances and the
+    # identity map
+    def list_rows(self, user_id: int, before_timestamp: int = None, after_timestamp: int = None) -> list:
+        if self.cache is not None:
+            return self._list_cached(user_id, before_timestamp, after_timestamp)
+        with self._session(self._read_db(user_id)) as sess:
+            rows = self._execute(sess, *_listing_params([user_id], before_timestamp, after_timestamp))
+            all_series, time_slots = _split_listing(rows)
+        if not all_series:
+            return time_slots
+        return list(series.merge(time_slots, all_series, before_timestamp, after_timestamp))
+
+    # one query for all users, every requested user gets an entry even without slots
+    def list_many(
+            self, user_ids: List[int], before_timestamp: int = None, after_timestamp: int = None
+    ) -> Dict[int, list]:
+        time_slots = {user_id: [] for user_id in user_ids}
+        series_of = {}
+        with self._session(self._read_db(*user_ids)) as sess:
+            rows = self._execute(sess, *_listing_params(user_ids, before_timestamp, after_timestamp))
+            for row in rows:
+                if row.kind == _SERIES_ROW:
+                    series_of.setdefault(row.user_id, []).append(row)
+                else:
+                    time_slots[row.user_id].append(TimeSlotRow(row.id, row.start_at, row.end_at))
+        for user_id, user_series in series_of.items():
+            time_slots[user_id] = list(
+                series.merge(time_slots[user_id], user_series, before_timestamp, after_timestamp)
+            )
+        return time_slots
+
+    # Keyset pagination over the slots merged with the occurrences of the user's series, like list_rows, on
+    # (start_at, kind, id or series_id). next_key is None on the last page.
+    def list_page(
+            self, user_id: int, limit: int, cursor: Tuple[int, int, int] = None,
+            before_timestamp: int = None, after_timestamp: int = None
+    ) -> Tuple[list, Optional[Tuple[int, int, int]]]:
+        with self._session(self._read_db(user_id)) as sess:
+            rows = self._execute(
+                sess, *_listing_params([user_id], before_timestamp, after_timestamp, cursor, limit + 1)
             )
-            sess.add(db_time_slot)
-            sess.commit()
-            sess.refresh(db_time_slot)
+            all_series, time_slots = _split_listing(rows)
+        if all_series:
+            # occurrences after the cursor start after its start_at, so they end after it as well
+            lower = max(after_timestamp or cursor[0], cursor[0]) if cursor else after_timestamp
+            merged = series.merge(time_slots, all_series, before_timestamp, lower)
+            if cursor:
+                merged = (row for row in merged if _page_key(row) > cursor)
+            time_slots = list(itertools.islice(merged, limit + 1))
+        if len(time_slots) <= limit:
+            return time_slots, None
+        time_slots = time_slots[:limit]
+        return time_slots, _page_key(time_slots[-1])
+
+    # Yields lists of at most chunk_size rows fetched through a server-side cursor. The cursor has its own
+    # session, a streamed response is still read after the request's unit of work was settled.
+    def iter_list(
+            self, user_id: int, before_timestamp: int = None, after_timestamp: int = None, chunk_size: int = 500
+    ) -> Iterator:
+        statement, params = _listing_params([user_id], before_timestamp, after_timestamp)
+        with self._read_db(user_id)() as sess:
+            result = self._execute(sess, statement.execution_options(stream_results=True), params)
+            rows = itertools.chain.from_iterable(result.partitions(chunk_size))
+            # the series come first, all of them are read before the first slot
+            all_series = []
+            for row in rows:
+                if row.kind != _SERIES_ROW:
+                    rows = itertools.chain([row], rows)
+                    break
+                all_series.append(row)
+            time_slots = (TimeSlotRow(row.id, row.start_at, row.end_at) for row in rows)
+            if all_series:
+                time_slots = series.merge(time_slots, all_series, before_timestamp, after_timestamp)
+            while True:
+                chunk = list(itertools.islice(time_slots, chunk_size))
+                if not chunk:
+                    return
+                yield chunk
+
+    # Yields lists of (id, user_id, start_at, end_at, created_at, series_id) rows through a server-side cursor,
+    # of all users when user_ids is None. The occurrences of series come first, ordered by series and without
+    # an id, then the slots ordered by id. checkpoint is the last id a client received, an export started from
+    # it continues right after that row and skips the occurrences received before it.
+    def iter_export(
+            self, user_ids: List[int] = None, checkpoint: int = None, chunk_size: int = 1000
+    ) -> Iterator[list]:
+        slots = select(
+            models.TimeSlot.id, models.TimeSlot.user_id, models.TimeSlot.start_at, models.TimeSlot.end_at,
+            models.TimeSlot.created_at, null().label("series_id")
+        ).order_by(models.TimeSlot.id)
+        if user_ids is not None:
+            slots = slots.filter(_user_ids_filter(user_ids))
+        if checkpoint is not None:
+            slots = slots.filter(models.TimeSlot.id > checkpoint)
+        queries = [slots] if checkpoint is not None else [_export_occurrences(user_ids), slots]
+        # a long read, its own session on a replica when there is one, like iter_list
+        with self._read_db(*(user_ids or ()))() as sess:
+            for query in queries:
+                query = query.execution_options(stream_results=True, max_row_buffer=chunk_size)
+                yield from self._execute(sess, query).partitions(chunk_size)
+
+    @count_rejections
+    def create(self, time_slot: schemas.TimeSlotCreate, now: int = int(datetime.utcnow().timestamp())):
+        self._check_basic(time_slot, now)
+        if self.cache is not None and self.cache.overlaps(time_slot.user_id, time_slot.start_at, time_slot.end_at):
+            # the overlapping slot may have been deleted by another worker since, a cached free answer needs no
+            # check, the insert guards against overlaps itself
+            if self._overlaps_stored(time_slot):
+                raise errors.TimeOverlapError
+            self.cache.invalidate(time_slot.user_id)
+        if self.writer is not None:
+            db_time_slot = self._create_grouped(time_slot)
+            if db_time_slot is not None:
+                return db_time_slot
+        with self._session() as sess:
+            # Overlaps with slots are rejected by the exclusion constraint on (user_id, time_range), overlaps
+            # with series by the insert itself
+            try:
+                db_time_slot = next(iter(self._execute_fresh(sess, *_insert_statement([time_slot]))), None)
+                if db_time_slot is not None:
+                    self._commit(sess)
+            except IntegrityError as e:
+                if not _is_overlap_violation(e):
+                    raise
+                db_time_slot = None
+            if db_time_slot is None:
+                if self.cache is not None:
+                    self.cache.invalidate(time_slot.user_id)
+                raise errors.TimeOverlapError
+        self._wrote(time_slot.user_id)
+        if self.cache is not None:
+            self._after_commit(lambda: self.cache.add(
+                db_time_slot.user_id, db_time_slot.id, db_time_slot.start_at, db_time_slot.end_at, db_time_slot.version
+            ))
         return db_time_slot
 
-    def delete(self, user_id: int, target_id: int, *args):
+    def _overlaps_stored(self, time_slot: schemas.TimeSlotCreate) -> bool:
+        with self._session() as sess:
+            return self._execute(sess, _OVERLAP_PROBE, {
+                "user_id": time_slot.user_id, "start_at": time_slot.start_at, "end_at": time_slot.end_at
+            }).scalar()
+
+    # The writer commits on its own, outside of the request's unit of work. Its rows carry no version, the
+    # cached entry of the user is dropped instead of updated.
+    def _create_grouped(self, time_slot: schemas.TimeSlotCreate):
+        try:
+            db_time_slot = self.writer.create(time_slot)
+        except errors.TimeOverlapError:
+            if self.cache is not None:
+                self.cache.invalidate(time_slot.user_id)
+            raise
+        except IntegrityError as e:
+            # the partition boundary check raises instead of skipping the row, which fails the whole
+            # batch, its slots are retried one by one
+            if not _is_overlap_violation(e):
+                raise
+            return None
+        self._wrote(time_slot.user_id)
+        if self.cache is not None:
+            self.cache.invalidate(time_slot.user_id)
+        return db_time_slot
+
+    # returns one entry per input item, either the created row or the error rejecting that item
+    @count_rejections
+    def create_many(self, user_id: int, time_slots: List[schemas.TimeSlotBase], now: int = None) -> list:
+        if now is None:
+            now = int(datetime.utcnow().timestamp())
+        results = [None] * len(time_slots)
+        candidates = {}
+        for idx, time_slot in enumerate(time_slots):
+            slot = schemas.TimeSlotCreate(user_id=user_id, start_at=time_slot.start_at, end_at=time_slot.end_at)
+            try:
+                self._check_basic(slot, now)
+            except errors.TimeFormatError as e:
+                results[idx] = e
+                continue
+            candidates[idx] = slot
+
+        indexes = list(candidates)
+        for pos in _overlaps_in_batch([candidates[idx] for idx in indexes]):
+            results[indexes[pos]] = errors.TimeOverlapError()
+            candidates.pop(indexes[pos])
+        if not candidates:
+            return results
+
+        with self._session() as sess:
+            # checked without the version row lock, a slot committed after this query fails the insert below
+            lower = min(slot.start_at for slot in candidates.values())
+            upper = max(slot.end_at for slot in candidates.values())
+            stored = self._execute(
+                sess,
+                select(models.TimeSlot.start_at, models.TimeSlot.end_at).filter(
+                    models.TimeSlot.user_id == user_id,
+                    models.TimeSlot.time_range.overlaps(func.int8range(lower, upper))
+                ).order_by(models.TimeSlot.start_at)
+            ).all()
+            starts = [row.start_at for row in stored]
+            ends = [row.end_at for row in stored]
+            for idx, slot in list(candidates.items()):
+                if _overlaps_stored(starts, ends, slot):
+                    results[idx] = errors.TimeOverlapError()
+                    candidates.pop(idx)
+            if not candidates:
+                return results
+
+            try:
+                rows = self._execute_fresh(sess, *_insert_statement(list(candidates.values())))
+                self._commit(sess)
+            except IntegrityError as e:
+                # a concurrent request inserted a conflicting slot after the range query
+                if not _is_overlap_violation(e):
+                    raise
+                raise errors.TimeOverlapError
+
+        self._wrote(user_id)
+        if self.cache is not None and rows:
+            self._after_commit(lambda: self.cache.add_many(
+                user_id, [(row.id, row.start_at, row.end_at) for row in rows], rows[0].version
+            ))
+        # accepted slots of one user never overlap, so start_at identifies the row, missing ones overlap a series
+        by_start_at = {row.start_at: row for row in rows}
+        for idx, slot in candidates.items():
+            results[idx] = by_start_at.get(slot.start_at) or errors.TimeOverlapError()
+        return results
+
+    @count_rejections
+    def create_series(self, user_id: int, time_slot_series: schemas.TimeSlotSeriesBase, now: int = None):
+        if now is None:
+            now = int(datetime.utcnow().timestamp())
+        first = schemas.TimeSlotCreate(
+            user_id=user_id, start_at=time_slot_series.start_at, end_at=time_slot_series.end_at
+        )
+        self._check_basic(first, now)
+        if time_slot_series.every < time_slot_series.end_at - time_slot_series.start_at:
+            raise errors.TimeFormatError("every must not be less than end_at - start_at")
+        if not 1 <= time_slot_series.occurrences <= series.MAX_OCCURRENCES:
+            raise errors.TimeFormatError(f"occurrences must be between 1 and {series.MAX_OCCURRENCES}")
+
+        last_end_at = series.last_end_at(time_slot_series)
+        with self._session() as sess:
+            # the version row lock keeps concurrent creates of this user from slipping past the checks below
+            self._execute(sess, *bump_statement([user_id]))
+            stored = self._execute(
+                sess,
+                select(models.TimeSlot.start_at, models.TimeSlot.end_at).filter(
+                    models.TimeSlot.user_id == user_id,
+                    models.TimeSlot.time_range.overlaps(func.int8range(time_slot_series.start_at, last_end_at))
+                )
+            ).all()
+            if any(series.overlaps(time_slot_series, row.start_at, row.end_at) for row in stored):
+                raise errors.TimeOverlapError
+            stored_series = self._execute(
+                sess,
+                _series_query([user_id], after_timestamp=time_slot_series.start_at).filter(
+                    models.TimeSlotSeries.start_at < last_end_at
+                )
+            ).all()
+            if any(series.series_overlap(time_slot_series, other) for other in stored_series):
+                raise errors.TimeOverlapError
+            db_series = self._execute(sess, *_series_insert_statement(user_id, time_slot_series)).one()
+            self._commit(sess)
+        self._wrote(user_id)
+        if self.cache is not None:
+            self._after_commit(lambda: self.cache.invalidate(user_id))
+        return db_series
+
+    # True when a series was removed
+    def delete_series(self, user_id: int, series_id: int) -> bool:
+        with self._session() as sess:
+            deleted = self._execute(sess, *_series_delete_statement(user_id, series_id)).first()
+            if deleted is not None:
+                self._commit(sess)
+        if deleted is None:
+            return False
+        self._wrote(user_id)
+        if self.cache is not None:
+            self._after_commit(lambda: self.cache.invalidate(user_id))
+        return True
+
+    # Deletes the slots of user_id matching all given filters, ids and the list window, and returns how
+    # many were deleted. Every chunk_size rows are deleted and committed in their own transaction, so row
+    # locks are held briefly however many slots match, also within a request's unit of work. Without ids
+    # the occurrences of series in the window go as well and are counted like slots.
+    def delete_many(
+        self, user_id: int, ids: List[int] = None, before_timestamp: int = None, after_timestamp: int = None,
+        chunk_size: int = DELETE_CHUNK_SIZE
+    ) -> int:
+        table = models.TimeSlot.__table__
+        chosen = self._timestamp_filter(
+            select(models.TimeSlot.id, models.TimeSlot.start_at).filter_by(user_id=user_id),
+            before_timestamp, after_timestamp
+        )
+        if ids is not None:
+            chosen = chosen.filter(models.TimeSlot.id == _int_any("ids", ids))
+        # (id, start_at) is the primary key of every partition
+        changed = delete(table).where(
+            table.c.user_id == user_id, tuple_(table.c.id, table.c.start_at).in_(chosen.limit(chunk_size))
+        ).returning(table.c.id, table.c.user_id).cte("changed")
+        statement = notifying_select(changed, "deleted", ("id",), BUMPED)
+
+        deleted = 0
+        if ids is None:
+            deleted += self._delete_series_window(user_id, before_timestamp, after_timestamp)
+        while True:
+            with self.db() as sess:
+                count = len(self._execute(sess, statement, bump_params([user_id])).all())
+                if count:
+                    sess.commit()
+            deleted += count
+            if count < chunk_size:
+                break
+        if deleted:
+            self._wrote(user_id)
+            if self.cache is not None:
+                self.cache.invalidate(user_id)
+        return deleted
+
+    # Series with occurrences in the window are replaced by what is left of them before and after it, in
+    # one transaction. Returns the number of removed occurrences.
+    def _delete_series_window(self, user_id: int, before_timestamp: int = None, after_timestamp: int = None) -> int:
+        removed = 0
         with self.db() as sess:
-            sess.query(models.TimeSlot).filter_by(user_id=user_id, id=target_id).delete()
-            sess.commit()
+            stored_series = self._execute(
+                sess, _series_query([user_id], before_timestamp, after_timestamp).with_for_update()
+            ).all()
+            for stored in stored_series:
+                count, left = series.trim(stored, before_timestamp, after_timestamp)
+                if not count:
+                    continue
+                removed += count
+                self._execute(sess, *_series_delete_statement(user_id, stored.id))
+                for rest in left:
+                    self._execute(sess, *_series_insert_statement(user_id, rest))
+            if removed:
+                sess.commit()
+        return removed
+
+    # Imports (line, user_id, start_at, end_at) rows with set-based statements instead of one create per
+    # row. They are COPYed into a staging table, checked there against the rules of _check_basic, against
+    # each other and against stored slots and series, and the valid ones are moved into time_slot with one
+    # INSERT. Returns the number of imported slots and the (line, reason) of every rejected row.
+    def import_rows(
+            self, rows: Iterable[Tuple[int, int, int, int]], now: int = None
+    ) -> Tuple[int, List[Tuple[int, str]]]:
+        if now is None:
+            now = int(datetime.utcnow().timestamp())
+        staging = _import_staging.c
+        valid = staging.reason.is_(None)
+        with self._session() as sess:
+            conn = sess.connection()
+            _import_staging.create(conn)
+            with conn.connection.cursor() as cursor:
+                cursor.copy_expert(
+                    "COPY time_slot_import (line, user_id, start_at, end_at) FROM STDIN WITH (FORMAT csv)",
+                    _CopyRows(rows)
+                )
+            # the version rows of all users are locked before checking, like creates do, so no slot of
+            # theirs can be added until the import commits
+            self._execute(sess, bump_select_statement(_import_staging))
+            self._execute(sess, update(_import_staging).values(reason=case(
+                (staging.start_at >= staging.end_at, "start_at must less than end_at"),
+                (staging.start_at <= now, "start_at must greater than now"),
+                (staging.end_at - staging.start_at > MAX_SLOT_DURATION, "range start_at and end_at must in 24 hours"),
+            )))
+
+            # every member of a group of overlapping rows is rejected, like in create_many
+            order = dict(partition_by=staging.user_id, order_by=(staging.start_at, staging.line))
+            neighbours = select(
+                staging.line,
+                (func.max(staging.end_at).over(rows=(None, -1), **order) > staging.start_at).label("overlaps_before"),
+                (func.lead(staging.start_at).over(**order) < staging.end_at).label("overlaps_after"),
+            ).where(valid).subquery()
+            self._execute(sess, update(_import_staging).values(reason="time range overlap").where(
+                staging.line == neighbours.c.line, or_(neighbours.c.overlaps_before, neighbours.c.overlaps_after)
+            ))
+            stored = exists().where(and_(
+                models.TimeSlot.user_id == staging.user_id, *_window_filter(staging.start_at, staging.end_at)
+            ))
+            self._execute(sess, update(_import_staging).values(reason="time range overlap").where(
+                valid, or_(stored, series.overlapping(staging.user_id, staging.start_at, staging.end_at))
+            ))
+
+            try:
+                imported = self._execute(sess, insert(models.TimeSlot.__table__).from_select(
+                    ["user_id", "start_at", "end_at"],
+                    select(staging.user_id, staging.start_at, staging.end_at).where(valid).order_by(
+                        staging.user_id, staging.start_at
+                    )
+                )).rowcount
+            except IntegrityError as e:
+                # only a writer not taking the version lock first can get in between
+                if not _is_overlap_violation(e):
+                    raise
+                raise errors.TimeOverlapError
+            imported_users = select(staging.user_id).where(valid).subquery()
+            sess.execute(notify_users_statement(imported_users, "imported"))
+            user_ids = self._execute(sess, select(imported_users.c.user_id).distinct()).scalars().all()
+            rejected = self._execute(
+                sess, select(staging.line, staging.reason).where(~valid).order_by(staging.line)
+            ).all()
+            self._commit(sess)
+
+        for user_id in user_ids:
+            self._wrote(user_id)
+        if self.cache is not None:
+            def invalidate_cache():
+                for user_id in user_ids:
+                    self.cache.invalidate(user_id)
+            self._after_commit(invalidate_cache)
+        return imported, [tuple(row) for row in rejected]
+
+    # The first limit gaps of at least duration seconds inside [start_at, end_at) where none of user_ids is
+    # busy, as (start_at, end_at) pairs. A slot of that duration fits at the start of every gap and passes
+    # _check_basic. Gaps are found in one query: ordered by start, a gap opens wherever a busy interval
+    # starts after the latest end of all intervals before it, which also merges overlapping intervals of
+    # different users.
+    def free_windows(
+            self, user_ids: List[int], start_at: int, end_at: int, duration: int, limit: int = 10, now: int = None
+    ) -> List[Tuple[int, int]]:
+        if now is None:
+            now = int(datetime.utcnow().timestamp())
+        if not 0 < duration <= MAX_SLOT_DURATION:
+            raise errors.TimeFormatError("duration must be between 1 second and 24 hours")
+        lower = max(start_at, now + 1)
+        if end_at - lower < duration:
+            return []
+
+        # the sentinels make the gaps at both ends of the window
+        busy = union_all(
+            select(literal(-2 ** 31, BigInteger).label("start_at"), literal(lower, BigInteger).label("end_at")),
+            _busy_query(user_ids, lower, end_at),
+            select(literal(end_at, BigInteger), literal(end_at, BigInteger)),
+        ).subquery()
+        latest_end = func.max(busy.c.end_at).over(order_by=(busy.c.start_at, busy.c.end_at), rows=(None, -1))
+        gaps = select(latest_end.label("start_at"), busy.c.start_at.label("end_at")).subquery()
+        query = select(gaps.c.start_at, gaps.c.end_at).filter(
+            gaps.c.end_at - gaps.c.start_at >= duration
+        ).order_by(gaps.c.start_at).limit(limit)
+        with self._session(self._read_db(*user_ids)) as sess:
+            return [tuple(row) for row in self._execute(sess, query)]
+
+    # merged busy intervals of all users and the free gaps between them, both clipped to the window
+    def free_busy(self, user_ids: List[int], start_at: int, end_at: int) -> Tuple[np.ndarray, np.ndarray]:
+        with self._session(self._read_db(*user_ids)) as sess:
+            rows = self._execute(
+                sess,
+                select(models.TimeSlot.start_at, models.TimeSlot.end_at).filter(
+                    _user_ids_filter(user_ids), *_window_filter(start_at, end_at)
+                )
+            ).all()
+            all_series = self._execute(
+                sess,
+                _series_query(user_ids, after_timestamp=start_at).filter(models.TimeSlotSeries.start_at < end_at)
+            ).all()
+        for user_series in all_series:
+            occurrences = itertools.takewhile(
+                lambda occurrence: occurrence.start_at < end_at, series.expand(user_series, after_timestamp=start_at)
+            )
+            rows.extend((occurrence.start_at, occurrence.end_at) for occurrence in occurrences)
+        slots = np.array(rows, dtype=np.int64).reshape(-1, 2)
+        busy_starts, busy_ends = merge_intervals(slots[:, 0], slots[:, 1])
+        busy_starts = np.clip(busy_starts, start_at, end_at)
+        busy_ends = np.clip(busy_ends, start_at, end_at)
+        free_starts, free_ends = free_gaps(busy_starts, busy_ends, start_at, end_at)
+        return np.column_stack((busy_starts, busy_ends)), np.column_stack((free_starts, free_ends))
+
+    # True when a slot was removed
+    def delete(self, user_id: int, target_id: int, *args) -> bool:
+        with self._session() as sess:
+            deleted = self._execute(sess, *_delete_statement(user_id, target_id)).first()
+            if deleted is not None:
+                self._commit(sess)
+        if deleted is None:
+            return False
+        self._wrote(user_id)
+        if self.cache is not None:
+            self._after_commit(lambda: self.cache.remove(user_id, target_id, deleted.version))
+        return True
@@ -1,12 +1,114 @@
-from sqlalchemy import create_engine
+import asyncio
+import time
+
+from sqlalchemy import create_engine, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+
+from app.settings import Settings, settings
+
+
+class TimedPoolMixin:
+    # pool events only fire once a connection is handed out, this also reports how long checkout waited
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_wait_listeners = []
+
+    def _saturated(self) -> bool:
+        return self._max_overflow > -1 and self.checkedout() >= self.size() + self._max_overflow
+
+    # A saturated pool is rejected right away instead of holding the request for pool_timeout, which only
+    # remains for checkouts racing for the last connection
+    def _do_get(self):
+        if self._saturated():
+            raise exc.TimeoutError(
+                f"QueuePool limit of size {self.size()} overflow {self._max_overflow} reached", code="3o7r"
+            )
+        started = time.perf_counter()
+        conn = super()._do_get()
+        waited = time.perf_counter() - started
+        for listener in self.checkout_wait_listeners:
+            listener(waited)
+        return conn
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.checkout_wait_listeners = self.checkout_wait_listeners
+        return pool
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def engine_options(config: Settings, poolclass) -> dict:
+    if config.db_external_pooler:
+        return {"poolclass": NullPool}
+    return {
+        "poolclass": poolclass,
+        "pool_size": config.db_pool_size,
+        "max_overflow": config.db_max_overflow,
+        "pool_timeout": config.db_pool_timeout,
+        "pool_recycle": config.db_pool_recycle,
+        "pool_pre_ping": config.db_pool_pre_ping,
+    }
+
+
+def async_engine_options(config: Settings) -> dict:
+    options = engine_options(config, TimedAsyncAdaptedQueuePool)
+    if config.db_external_pooler:
+        # prepared statements do not survive a transaction-mode pooler switching server connections
+        options["connect_args"] = {"prepared_statement_cache_size": 0, "statement_cache_size": 0}
+    return options
+
+
+def prewarm(engine: Engine, size: int):
+    if isinstance(engine.pool, NullPool):
+        return
+    conns = [engine.connect() for _ in range(min(size, engine.pool.size()))]
+    for conn in conns:
+        conn.close()
+
+
+async def async_prewarm(engine: AsyncEngine, size: int):
+    pool = engine.sync_engine.pool
+    if isinstance(pool, NullPool):
+        return
+    conns = await asyncio.gather(*(engine.connect().start() for _ in range(min(size, pool.size()))))
+    await asyncio.gather(*(conn.close() for conn in conns))
 
-SQLALCHEMY_DATABASE_URL = "postgresql+psycopg2://postgres:example@db/db"
 
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL
+    settings.database_url,
+    **engine_options(settings, TimedQueuePool)
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+replica_engines = [
+    create_engine(
+        url, connect_args={"connect_timeout": settings.replica_connect_timeout},
+        **engine_options(settings, TimedQueuePool)
+    )
+    for url in settings.replica_database_urls
+]
+ReplicaSessionLocals = [
+    sessionmaker(autocommit=False, autoflush=False, bind=replica_engine) for replica_engine in replica_engines
+]
+
+async_engine = create_async_engine(
+    settings.async_database_url,
+    **async_engine_options(settings)
+)
+AsyncSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=async_engine, class_=AsyncSession
+)
+
+Base = declarative_base()
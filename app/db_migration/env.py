@@ -5,10 +5,12 @@ from sqlalchemy import pool
 
 from alembic import context
 from app.models import TimeSlot
+from app.settings import settings
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
+config.set_main_option("sqlalchemy.url", settings.database_url)
 
 
 # Interpret the config file for Python logging.
@@ -0,0 +1,42 @@
+"""Store time range and exclude overlapping slots
+
+Revision ID: 3f6b2a9c7e41
+Revises: d1c30b15d8f5
+Create Date: 2021-06-02 10:41:27.513208
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '3f6b2a9c7e41'
+down_revision = 'd1c30b15d8f5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'time_slot',
+        sa.Column(
+            'time_range',
+            postgresql.INT8RANGE(),
+            sa.Computed('int8range(start_at, end_at)', persisted=True),
+            nullable=False
+        )
+    )
+    # fails if the table already holds overlapping slots, they have to be cleaned up by hand first
+    op.execute(
+        """
+        ALTER TABLE time_slot
+        ADD CONSTRAINT time_slot__user_id__time_range__excl
+        EXCLUDE USING gist (int4range(user_id, user_id, '[]') WITH =, time_range WITH &&)
+        """
+    )
+
+
+def downgrade():
+    op.drop_constraint('time_slot__user_id__time_range__excl', 'time_slot')
+    op.drop_column('time_slot', 'time_range')
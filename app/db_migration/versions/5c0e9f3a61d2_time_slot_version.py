@@ -0,0 +1,28 @@
+"""Per-user version of time slots
+
+Revision ID: 5c0e9f3a61d2
+Revises: b84e1d07c2a5
+Create Date: 2021-06-14 11:22:07.905131
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c0e9f3a61d2'
+down_revision = 'b84e1d07c2a5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('time_slot_version',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('time_slot_version')
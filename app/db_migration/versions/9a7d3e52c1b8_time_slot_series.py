@@ -0,0 +1,36 @@
+"""Recurring time slot series
+
+Revision ID: 9a7d3e52c1b8
+Revises: 5c0e9f3a61d2
+Create Date: 2021-06-16 09:41:25.118402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a7d3e52c1b8'
+down_revision = '5c0e9f3a61d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('time_slot_series',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('start_at', sa.Integer(), nullable=False),
+    sa.Column('end_at', sa.Integer(), nullable=False),
+    sa.Column('every', sa.Integer(), nullable=False),
+    sa.Column('occurrences', sa.Integer(), nullable=False),
+    sa.Column('last_end_at', sa.BigInteger(), sa.Computed('end_at + (occurrences - 1)::bigint * every', persisted=True), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('time_slot_series__user_id__start_at', 'time_slot_series', ['user_id', 'start_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('time_slot_series__user_id__start_at', table_name='time_slot_series')
+    op.drop_table('time_slot_series')
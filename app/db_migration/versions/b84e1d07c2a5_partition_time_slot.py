@@ -0,0 +1,188 @@
+"""Partition time_slot by start_at
+
+Revision ID: b84e1d07c2a5
+Revises: 3f6b2a9c7e41
+Create Date: 2021-06-10 16:03:52.270114
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b84e1d07c2a5'
+down_revision = '3f6b2a9c7e41'
+branch_labels = None
+depends_on = None
+
+# keep in sync with app.retention.PARTITION_WIDTH and app.controllers.time_slot.MAX_SLOT_DURATION
+PARTITION_WIDTH = 7 * 86400
+MAX_SLOT_DURATION = 86400
+PARTITIONS_AHEAD = 8
+
+
+def upgrade():
+    op.execute("ALTER TABLE time_slot RENAME TO time_slot_unpartitioned")
+    op.execute("ALTER SEQUENCE time_slot_id_seq OWNED BY NONE")
+    op.execute(
+        """
+        CREATE TABLE time_slot (
+            id integer NOT NULL DEFAULT nextval('time_slot_id_seq'),
+            user_id integer NOT NULL,
+            created_at timestamp without time zone NOT NULL DEFAULT now(),
+            start_at integer NOT NULL,
+            end_at integer NOT NULL,
+            time_range int8range GENERATED ALWAYS AS (int8range(start_at, end_at)) STORED NOT NULL
+        ) PARTITION BY RANGE (start_at)
+        """
+    )
+    # slots too far ahead for the created partitions land here until time_slot_create_partition moves them
+    op.execute("CREATE TABLE time_slot_default PARTITION OF time_slot DEFAULT")
+    op.execute(
+        """
+        ALTER TABLE time_slot_default
+        ADD CONSTRAINT time_slot_default__user_id__time_range__excl
+        EXCLUDE USING gist (int4range(user_id, user_id, '[]') WITH =, time_range WITH &&)
+        """
+    )
+    # exclusion constraints can not be declared on the partitioned table, every partition gets its own
+    op.execute(
+        f"""
+        CREATE FUNCTION time_slot_create_partition(lower integer) RETURNS boolean AS $$
+        DECLARE
+            name text := 'time_slot_p' || lower;
+            upper integer := lower + {PARTITION_WIDTH};
+            occupied boolean;
+        BEGIN
+            IF to_regclass(name) IS NOT NULL THEN
+                RETURN false;
+            END IF;
+            SELECT EXISTS (
+                SELECT 1 FROM time_slot_default WHERE start_at >= lower AND start_at < upper
+            ) INTO occupied;
+            IF occupied THEN
+                ALTER TABLE time_slot DETACH PARTITION time_slot_default;
+            END IF;
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF time_slot FOR VALUES FROM (%s) TO (%s)', name, lower, upper
+            );
+            EXECUTE format(
+                'ALTER TABLE %I ADD CONSTRAINT %I EXCLUDE USING gist '
+                '(int4range(user_id, user_id, ''[]'') WITH =, time_range WITH &&)',
+                name, name || '__user_id__time_range__excl'
+            );
+            IF occupied THEN
+                WITH moved AS (
+                    DELETE FROM time_slot_default WHERE start_at >= lower AND start_at < upper
+                    RETURNING id, user_id, created_at, start_at, end_at
+                )
+                INSERT INTO time_slot (id, user_id, created_at, start_at, end_at) SELECT * FROM moved;
+                ALTER TABLE time_slot ATTACH PARTITION time_slot_default DEFAULT;
+            END IF;
+            RETURN true;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        f"""
+        SELECT time_slot_create_partition(lower)
+        FROM generate_series(
+            (SELECT coalesce(min(start_at), extract(epoch FROM now())::integer) FROM time_slot_unpartitioned)
+                / {PARTITION_WIDTH} * {PARTITION_WIDTH},
+            (extract(epoch FROM now())::integer / {PARTITION_WIDTH} + {PARTITIONS_AHEAD}) * {PARTITION_WIDTH},
+            {PARTITION_WIDTH}
+        ) AS lower
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO time_slot (id, user_id, created_at, start_at, end_at)
+        SELECT id, user_id, created_at, start_at, end_at FROM time_slot_unpartitioned
+        """
+    )
+    op.execute("DROP TABLE time_slot_unpartitioned")
+    op.execute("ALTER SEQUENCE time_slot_id_seq OWNED BY time_slot.id")
+
+    op.execute("ALTER TABLE time_slot ADD CONSTRAINT time_slot_pkey PRIMARY KEY (id, start_at)")
+    op.create_index('ix_time_slot_id', 'time_slot', ['id'], unique=False)
+    op.create_index('ix_time_slot_user_id', 'time_slot', ['user_id'], unique=False)
+    op.create_index('user_id__id', 'time_slot', ['user_id', 'id'], unique=False)
+    op.create_index('user_id__start_at__end_at', 'time_slot', ['user_id', 'start_at', 'end_at'], unique=False)
+
+    # A slot crossing a partition boundary can overlap a slot stored in the next partition, which no
+    # exclusion constraint sees. Inserts near a boundary take a per-user lock and check both sides, the
+    # lock makes the check see every committed slot under READ COMMITTED. It runs after the insert so
+    # earlier rows of a multi-row INSERT are visible as well.
+    op.execute(
+        f"""
+        CREATE FUNCTION time_slot_check_boundary_overlap() RETURNS trigger AS $$
+        DECLARE
+            lower integer := NEW.start_at / {PARTITION_WIDTH} * {PARTITION_WIDTH};
+        BEGIN
+            IF NEW.end_at <= lower + {PARTITION_WIDTH} AND NEW.start_at >= lower + {MAX_SLOT_DURATION} THEN
+                RETURN NULL;
+            END IF;
+            PERFORM pg_advisory_xact_lock('time_slot'::regclass::integer, NEW.user_id);
+            IF EXISTS (
+                SELECT 1 FROM time_slot
+                WHERE user_id = NEW.user_id
+                    AND start_at > NEW.start_at - {MAX_SLOT_DURATION}
+                    AND start_at < NEW.end_at
+                    AND end_at > NEW.start_at
+                    AND id <> NEW.id
+            ) THEN
+                RAISE EXCEPTION 'time slot % overlaps a slot of user %', NEW.time_range, NEW.user_id
+                    USING ERRCODE = 'exclusion_violation', CONSTRAINT = 'time_slot__user_id__time_range__excl';
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER time_slot__boundary_overlap AFTER INSERT ON time_slot
+        FOR EACH ROW EXECUTE FUNCTION time_slot_check_boundary_overlap()
+        """
+    )
+
+
+def downgrade():
+    op.execute("ALTER TABLE time_slot RENAME TO time_slot_partitioned")
+    op.execute("ALTER SEQUENCE time_slot_id_seq OWNED BY NONE")
+    op.execute(
+        """
+        CREATE TABLE time_slot (
+            id integer NOT NULL DEFAULT nextval('time_slot_id_seq'),
+            user_id integer NOT NULL,
+            created_at timestamp without time zone NOT NULL DEFAULT now(),
+            start_at integer NOT NULL,
+            end_at integer NOT NULL,
+            time_range int8range GENERATED ALWAYS AS (int8range(start_at, end_at)) STORED NOT NULL
+        )
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO time_slot (id, user_id, created_at, start_at, end_at)
+        SELECT id, user_id, created_at, start_at, end_at FROM time_slot_partitioned
+        """
+    )
+    op.execute("DROP TABLE time_slot_partitioned")
+    op.execute("DROP FUNCTION time_slot_check_boundary_overlap()")
+    op.execute("DROP FUNCTION time_slot_create_partition(integer)")
+    op.execute("ALTER SEQUENCE time_slot_id_seq OWNED BY time_slot.id")
+
+    op.execute("ALTER TABLE time_slot ADD CONSTRAINT time_slot_pkey PRIMARY KEY (id)")
+    op.create_index('ix_time_slot_id', 'time_slot', ['id'], unique=False)
+    op.create_index('ix_time_slot_user_id', 'time_slot', ['user_id'], unique=False)
+    op.create_index('user_id__id', 'time_slot', ['user_id', 'id'], unique=False)
+    op.create_index('user_id__id__end_at', 'time_slot', ['user_id', 'id', 'end_at'], unique=False)
+    op.create_index('user_id__id__start_at__end_at', 'time_slot', ['user_id', 'start_at', 'end_at'], unique=False)
+    op.execute(
+        """
+        ALTER TABLE time_slot
+        ADD CONSTRAINT time_slot__user_id__time_range__excl
+        EXCLUDE USING gist (int4range(user_id, user_id, '[]') WITH =, time_range WITH &&)
+        """
+    )
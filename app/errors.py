@@ -4,3 +4,11 @@ class TimeOverlapError(Exception):
 
 class TimeFormatError(Exception):
     pass
+
+
+class InvalidCursorError(Exception):
+    pass
+
+
+class ChangeFeedError(Exception):
+    pass
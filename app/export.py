@@ -0,0 +1,38 @@
+import csv
+import io
+import zlib
+from typing import Iterable, Iterator
+
+import orjson
+
+# rows of TimeSlotController.iter_export
+FIELDS = ("id", "user_id", "start_at", "end_at", "created_at", "series_id")
+
+
+def ndjson_chunks(chunks: Iterable[list]) -> Iterator[bytes]:
+    for rows in chunks:
+        yield b"".join(orjson.dumps(dict(zip(FIELDS, row))) + b"\n" for row in rows)
+
+
+def csv_chunks(chunks: Iterable[list]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    # the header on its own, an empty export still has it
+    writer.writerow(FIELDS)
+    yield buffer.getvalue().encode()
+    buffer.seek(0)
+    buffer.truncate()
+    for rows in chunks:
+        for row in rows:
+            writer.writerow((*row[:4], row[4].isoformat(), *row[5:]))
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+# compresses as it goes, every chunk is flushed so the client receives data while the export runs
+def gzip_chunks(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
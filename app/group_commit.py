@@ -0,0 +1,129 @@
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from itertools import groupby
+from operator import attrgetter
+from concurrent.futures import Future
+from typing import List, Tuple
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import sessionmaker
+
+from app import errors, models, schemas, series
+from app.changes import notify_statements, slot_items
+from app.metrics import GROUP_COMMIT_BATCH_SIZE
+from app.versions import bump_statement
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def _insert_skipping_overlaps():
+    # without a conflict target DO NOTHING also covers the exclusion constraint, a row overlapping a stored
+    # slot, an earlier row of the same statement or a series is skipped and missing from RETURNING
+    table = models.TimeSlot.__table__
+    return insert(table).from_select(
+        ["user_id", "start_at", "end_at"], series.without_series_overlap()
+    ).on_conflict_do_nothing().returning(
+        table.c.id, table.c.user_id, table.c.created_at, table.c.start_at, table.c.end_at
+    )
+
+
+_INSERT_SKIPPING_OVERLAPS = _insert_skipping_overlaps()
+
+
+def _insert_statement(time_slots: List[schemas.TimeSlotCreate]) -> tuple:
+    return _INSERT_SKIPPING_OVERLAPS, series.new_slot_params(time_slots)
+
+
+# Coalesces creates from concurrent callers into one multi-row INSERT and one commit. A batch is flushed
+# once max_batch slots are queued or max_delay seconds after its first slot arrived. Rows are inserted in
+# arrival order, so within one user the earlier of two overlapping requests wins like without batching.
+class GroupCommitWriter:
+    def __init__(self, db: sessionmaker, max_batch: int = 100, max_delay: float = 0.005):
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self._thread.start()
+
+    # flushes what is already queued and stops the flusher thread
+    def close(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+
+    def submit(self, time_slot: schemas.TimeSlotCreate) -> Future:
+        self.start()
+        future = Future()
+        self._queue.put((time_slot, future))
+        return future
+
+    # blocks until the batch holding time_slot is committed, raises TimeOverlapError when it was skipped and
+    # the error of the INSERT when the whole batch failed
+    def create(self, time_slot: schemas.TimeSlotCreate):
+        return self.submit(time_slot).result()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch: List[Tuple[schemas.TimeSlotCreate, Future]]):
+        GROUP_COMMIT_BATCH_SIZE.observe(len(batch))
+        # the sort is stable so arrival order holds within a user, and row locks are taken in user order
+        batch = sorted(batch, key=lambda item: item[0].user_id)
+        try:
+            with self.db() as sess:
+                # bumped first to order the batch against series created concurrently, see TimeSlotController.create
+                sess.execute(*bump_statement(time_slot.user_id for time_slot, _ in batch))
+                rows = sess.execute(*_insert_statement([time_slot for time_slot, _ in batch])).all()
+                by_user = attrgetter("user_id")
+                for user_id, user_rows in groupby(sorted(rows, key=by_user), key=by_user):
+                    for statement in notify_statements(user_id, "created", slot_items(user_rows)):
+                        sess.execute(statement)
+                sess.commit()
+        except Exception as e:
+            logger.warning(f"Group commit of {len(batch)} time slots failed: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        # identical slots can be queued twice, only the first one in arrival order was inserted
+        waiting = defaultdict(deque)
+        for time_slot, future in batch:
+            waiting[(time_slot.user_id, time_slot.start_at, time_slot.end_at)].append(future)
+        for row in rows:
+            waiting[(row.user_id, row.start_at, row.end_at)].popleft().set_result(row)
+        for futures in waiting.values():
+            for future in futures:
+                future.set_exception(errors.TimeOverlapError())
@@ -0,0 +1,107 @@
+"""Bulk import of time slots from NDJSON or CSV.
+
+    python -m app.importer slots.csv
+    python -m app.importer slots.ndjson --report rejected.csv
+
+Every record needs user_id, start_at and end_at, other fields such as the id and created_at of an
+export are ignored. The series occurrences of an export are imported as plain slots. Rows are COPYed
+into a staging table, validated there in a few set-based statements and moved into time_slot in one
+transaction. Rows breaking the rules of a single create are left out and reported with their line
+number and reason.
+"""
+import argparse
+import codecs
+import csv
+import logging
+import sys
+from typing import Iterable, Iterator, List, Tuple
+
+import orjson
+
+from app import database, schemas
+from app.controllers.time_slot import TimeSlotController
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ("user_id", "start_at", "end_at")
+MALFORMED = "malformed record"
+# the columns are integer, a value out of its range would fail the whole COPY
+INT_RANGE = range(-2 ** 31, 2 ** 31)
+
+
+def _values(record) -> tuple:
+    values = tuple(int(record[field]) for field in FIELDS)
+    if not all(value in INT_RANGE for value in values):
+        raise ValueError(f"out of range {values}")
+    return values
+
+
+# the lines of a body arriving in chunks, split like str.splitlines(keepends=True) of the whole body. The
+# last piece of a chunk is held back as a line ending or a multi-byte character may continue in the next one.
+def decode_lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).splitlines(keepends=True)
+        pending = lines.pop() if lines else ""
+        yield from lines
+    yield from (pending + decoder.decode(b"", final=True)).splitlines(keepends=True)
+
+
+# (line, user_id, start_at, end_at) of the well formed records, the line of the others goes to rejected
+def parse_ndjson(lines: Iterable[str], rejected: List[Tuple[int, str]]) -> Iterator[Tuple[int, int, int, int]]:
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = orjson.loads(line)
+            yield (number, *_values(record))
+        except (orjson.JSONDecodeError, KeyError, TypeError, ValueError):
+            rejected.append((number, MALFORMED))
+
+
+def parse_csv(lines: Iterable[str], rejected: List[Tuple[int, str]]) -> Iterator[Tuple[int, int, int, int]]:
+    reader = csv.DictReader(lines)
+    for record in reader:
+        try:
+            yield (reader.line_num, *_values(record))
+        except (KeyError, TypeError, ValueError):
+            rejected.append((reader.line_num, MALFORMED))
+
+
+def import_lines(
+        controller: TimeSlotController, lines: Iterable[str], import_format: schemas.FileFormat, now: int = None
+) -> schemas.ImportReport:
+    rejected = []
+    parse = parse_csv if import_format == schemas.FileFormat.csv else parse_ndjson
+    imported, invalid = controller.import_rows(parse(lines, rejected), now=now)
+    rejected = sorted(rejected + invalid)
+    return schemas.ImportReport(
+        imported=imported, rejected=[schemas.ImportRejection(line=line, reason=reason) for line, reason in rejected]
+    )
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path")
+    parser.add_argument(
+        "--format", choices=[item.value for item in schemas.FileFormat], help="by default from the file suffix"
+    )
+    parser.add_argument("--report", help="write the rejected lines as CSV to this file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    import_format = schemas.FileFormat(args.format or ("csv" if args.path.endswith(".csv") else "ndjson"))
+    with open(args.path, newline="") as lines:
+        report = import_lines(TimeSlotController(database.SessionLocal), lines, import_format)
+    logger.info(f"Imported {report.imported} time slots, rejected {len(report.rejected)}")
+    if args.report:
+        with open(args.report, "w", newline="") as out:
+            writer = csv.writer(out)
+            writer.writerow(("line", "reason"))
+            writer.writerows((rejection.line, rejection.reason) for rejection in report.rejected)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
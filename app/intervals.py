@@ -0,0 +1,28 @@
+from typing import Tuple
+
+import numpy as np
+
+
+def merge_intervals(starts: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    if not len(starts):
+        return starts, ends
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+    running_end = np.maximum.accumulate(ends)
+    # a block begins where an interval starts after every earlier interval has ended, touching ones are merged
+    block_begin = np.empty(len(starts), dtype=bool)
+    block_begin[0] = True
+    block_begin[1:] = starts[1:] > running_end[:-1]
+    first = np.flatnonzero(block_begin)
+    last = np.append(first[1:] - 1, len(starts) - 1)
+    return starts[first], running_end[last]
+
+
+def free_gaps(
+        busy_starts: np.ndarray, busy_ends: np.ndarray, window_start: int, window_end: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    # busy intervals must be merged and sorted, the gaps are taken between them inside the window
+    gap_starts = np.append(window_start, np.clip(busy_ends, window_start, window_end))
+    gap_ends = np.append(np.clip(busy_starts, window_start, window_end), window_end)
+    keep = gap_ends > gap_starts
+    return gap_starts[keep], gap_ends[keep]
@@ -1,44 +1,257 @@
+import asyncio
 import datetime
+import itertools
 import logging
 
-from fastapi import Depends, FastAPI, HTTPException
+import orjson
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.logger import logger
-from typing import List
+from fastapi.responses import JSONResponse, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from sqlalchemy import exc
+from starlette.concurrency import run_in_threadpool
+from typing import AsyncIterator, Dict, Iterator, List, Optional
 
-from app import schemas, errors
+from app import export, importer, schemas, errors
+from app.cache import IntervalCache
+from app.changes import HEARTBEAT, ChangeFeed
+from app.controllers.async_time_slot import AsyncTimeSlotController
 from app.controllers.time_slot import TimeSlotController
 from app.controllers.base import BaseController
-from app.database import SessionLocal
+from app.controllers.registry import ControllerRegistry
+from app.database import (
+    AsyncSessionLocal, ReplicaSessionLocals, SessionLocal, async_engine, async_prewarm, engine, prewarm, replica_engines
+)
+from app.group_commit import GroupCommitWriter
+from app.metrics import MetricsMiddleware, instrument_engine
+from app.pagination import decode_cursor, encode_cursor
+from app.replicas import Replica, ReplicaRouter
+from app.settings import settings
+from app.timing import TimingMiddleware, instrument_timing
+from app.unit_of_work import UnitOfWorkMiddleware
+from app.versions import etag_matches, format_etag
+
+MAX_BATCH_SIZE = 1000
+MAX_PAGE_SIZE = 1000
+# page size of a cursor sent without limit, the cursor came from a paged response and continues paging
+DEFAULT_PAGE_SIZE = 100
+MAX_USERS_PER_QUERY = 1000
 
 logging.basicConfig(format="%(asctime)s loglevel=%(levelname)-6s msg=\"%(message)s\" logger=%(name)s %(funcName)s() L%(lineno)-4d ", level=logging.INFO)
 app = FastAPI()
+# added first so it runs inside the metrics middleware, which then sees a failed commit as a 500
+app.add_middleware(UnitOfWorkMiddleware)
+instrument_engine("primary", engine)
+instrument_engine("async", async_engine.sync_engine)
+for idx, replica_engine in enumerate(replica_engines):
+    instrument_engine(f"replica{idx}", replica_engine)
+# outside the unit of work, so the commit is part of the reported SQL time
+if settings.server_timing or settings.slow_query_threshold:
+    app.add_middleware(TimingMiddleware, header=settings.server_timing)
+    for timed_engine in [engine, async_engine.sync_engine, *replica_engines]:
+        instrument_timing(timed_engine, settings.slow_query_threshold)
+app.add_middleware(MetricsMiddleware)
+
+
+@app.on_event("startup")
+async def prewarm_pools():
+    if settings.db_pool_prewarm:
+        await run_in_threadpool(prewarm, engine, settings.db_pool_prewarm)
+        await async_prewarm(async_engine, settings.db_pool_prewarm)
+        logger.info(f"Opened {settings.db_pool_prewarm} connections per pool")
+
+
+@app.exception_handler(exc.TimeoutError)
+async def pool_saturated_handler(request, e: exc.TimeoutError):
+    logger.warning(f"Connection pool saturated on {request.url.path}")
+    return JSONResponse(status_code=503, content={"detail": "service busy"}, headers={"Retry-After": "1"})
+
+
+interval_cache = None
+if settings.interval_cache_max_intervals:
+    interval_cache = IntervalCache(settings.interval_cache_max_intervals, ttl=settings.interval_cache_ttl)
+
+group_commit_writer = None
+if settings.group_commit_max_batch:
+    group_commit_writer = GroupCommitWriter(
+        SessionLocal, max_batch=settings.group_commit_max_batch, max_delay=settings.group_commit_max_delay
+    )
+
+replica_router = None
+if ReplicaSessionLocals:
+    replica_router = ReplicaRouter(
+        SessionLocal,
+        [Replica(f"replica{idx}", db) for idx, db in enumerate(ReplicaSessionLocals)],
+        max_lag=settings.replica_max_lag,
+        read_after_write=settings.replica_read_after_write,
+        lag_check_interval=settings.replica_lag_check_interval,
+    )
+
+
+change_feed = ChangeFeed(
+    engine, heartbeat=settings.change_feed_heartbeat, queue_size=settings.change_feed_queue_size
+)
+
+
+@app.on_event("shutdown")
+def stop_group_commit():
+    if group_commit_writer is not None:
+        group_commit_writer.close()
+
+
+@app.on_event("startup")
+def start_replica_router():
+    if replica_router is not None:
+        replica_router.start()
 
 
-# Dependency
+@app.on_event("shutdown")
+def stop_replica_router():
+    if replica_router is not None:
+        replica_router.close()
+
+
+@app.on_event("shutdown")
+async def stop_change_feed():
+    await change_feed.close()
+
+
+controllers = ControllerRegistry()
+controllers.register(
+    "time_slot",
+    TimeSlotController(SessionLocal, cache=interval_cache, writer=group_commit_writer, router=replica_router)
+)
+async_controllers = ControllerRegistry()
+async_controllers.register("time_slot", AsyncTimeSlotController(AsyncSessionLocal))
+
+
+# Dependency, a coroutine so looking up the shared controller does not take a trip through the threadpool
 class ControllerMaker:
+    registry = controllers
+
     def __init__(self, controller_type: str):
         self.type = controller_type
 
-    def __call__(self):
-        if self.type == "time_slot":
-            controller = TimeSlotController(SessionLocal)
-        else:
-            raise Exception("Controller not exist")
-        yield controller
+    async def __call__(self):
+        return self.registry.get(self.type)
+
+
+class AsyncControllerMaker(ControllerMaker):
+    registry = async_controllers
 
 
 Controller = ControllerMaker("time_slot")
+AsyncController = AsyncControllerMaker("time_slot")
+
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def _time_slot_dict(row) -> dict:
+    if row[0] is None:
+        # an occurrence of a series, (None, start_at, end_at, series_id)
+        return {"id": None, "start_at": row[1], "end_at": row[2], "series_id": row[3]}
+    return {"id": row[0], "start_at": row[1], "end_at": row[2]}
+
+
+def _dump_time_slots(rows: list) -> bytes:
+    # rows are (id, start_at, end_at), serialized directly instead of validating through schemas.ListedTimeSlot
+    return orjson.dumps([_time_slot_dict(row) for row in rows])
+
 
+def _stream_time_slots(chunks: Iterator[list]):
+    yield b"["
+    separator = b""
+    for rows in chunks:
+        # strip the brackets of each chunk's array and join them into one array
+        yield separator + _dump_time_slots(rows)[1:-1]
+        separator = b","
+    yield b"]"
 
-@app.get("/users/{user_id}/time-slots", response_model=List[schemas.TimeSlot])
+
+# If-None-Match: * once the slots were read and found, a missing list is a 404 whatever the header
+def _matches_existing(if_none_match: Optional[str], headers: dict) -> bool:
+    return bool(if_none_match and "ETag" in headers and etag_matches(if_none_match, headers["ETag"], exists=True))
+
+
+@app.get("/users/{user_id}/time-slots", response_model=List[schemas.ListedTimeSlot])
 def get_user_time_slots(
         user_id: int, before_timestamp: int = None, after_timestamp: int = None,
-        controller: BaseController = Depends(Controller)
+        limit: int = Query(None, ge=1, le=MAX_PAGE_SIZE), cursor: str = None, stream: bool = False,
+        if_none_match: str = Header(None), controller: BaseController = Depends(Controller)
 ):
-    time_slots = controller.list(user_id, before_timestamp=before_timestamp, after_timestamp=after_timestamp)
+    # the version is read before the slots, a write in between only makes the ETag older than the body
+    version = controller.version(user_id)
+    headers = {}
+    if version is not None:
+        headers["ETag"] = format_etag(version)
+        if if_none_match and etag_matches(if_none_match, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+
+    if stream:
+        chunks = controller.iter_list(user_id, before_timestamp=before_timestamp, after_timestamp=after_timestamp)
+        first = next(chunks, None)
+        if not first:
+            raise HTTPException(status_code=404, detail="result not found")
+        if _matches_existing(if_none_match, headers):
+            chunks.close()
+            return Response(status_code=304, headers=headers)
+        return StreamingResponse(
+            _stream_time_slots(itertools.chain([first], chunks)), media_type="application/json", headers=headers
+        )
+
+    next_key = None
+    if limit is None and cursor:
+        limit = DEFAULT_PAGE_SIZE
+    if limit is None:
+        time_slots = controller.list_rows(user_id, before_timestamp=before_timestamp, after_timestamp=after_timestamp)
+    else:
+        try:
+            key = decode_cursor(cursor, size=3) if cursor else None
+        except errors.InvalidCursorError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        time_slots, next_key = controller.list_page(
+            user_id, limit, cursor=key, before_timestamp=before_timestamp, after_timestamp=after_timestamp
+        )
     if not time_slots:
         raise HTTPException(status_code=404, detail="result not found")
-    return time_slots
+    if _matches_existing(if_none_match, headers):
+        return Response(status_code=304, headers=headers)
+    response = Response(_dump_time_slots(time_slots), media_type="application/json", headers=headers)
+    if next_key:
+        response.headers["X-Next-Cursor"] = encode_cursor(*next_key)
+    return response
+
+
+def _dump_event(event) -> bytes:
+    if event is HEARTBEAT:
+        return b": heartbeat\n\n"
+    return b"event: " + event["event"].encode() + b"\ndata: " + orjson.dumps(event) + b"\n\n"
+
+
+async def _stream_events(subscription):
+    try:
+        while True:
+            yield _dump_event(await subscription.get())
+    finally:
+        change_feed.unsubscribe(subscription)
+
+
+# Server-Sent Events for every committed change of the user's slots and series. A resync event means
+# events were missed, the client reloads the list and keeps reading.
+@app.get("/users/{user_id}/time-slots/events")
+async def get_user_time_slot_events(user_id: int):
+    try:
+        subscription = await change_feed.subscribe(user_id)
+    except errors.ChangeFeedError as e:
+        logger.warning(f"Change feed unavailable: {e}")
+        raise HTTPException(status_code=503, detail="change feed unavailable")
+    return StreamingResponse(
+        _stream_events(subscription), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 @app.post("/users/{user_id}/time-slots", response_model=schemas.TimeSlot)
@@ -62,6 +275,216 @@ def create_user_time_slot(
     return obj
 
 
-@app.delete("/users/{user_id}/time-slots/{time_slot_id}")
+@app.post("/users/{user_id}/time-slots/batch", response_model=List[schemas.TimeSlotBatchResult])
+def create_user_time_slots(
+        user_id: int, time_slots: List[schemas.TimeSlotBase], controller: BaseController = Depends(Controller)
+):
+    if len(time_slots) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"at most {MAX_BATCH_SIZE} time slots per batch")
+    now = int(datetime.datetime.utcnow().timestamp())
+    try:
+        results = controller.create_many(user_id, time_slots, now=now)
+    except errors.TimeOverlapError:
+        logger.warning(f"User {user_id} sent a batch overlapping a concurrently created time range")
+        raise HTTPException(status_code=400, detail="time range overlap")
+
+    response = []
+    for idx, result in enumerate(results):
+        if isinstance(result, errors.TimeOverlapError):
+            response.append(schemas.TimeSlotBatchResult(index=idx, error="time range overlap"))
+        elif isinstance(result, errors.TimeFormatError):
+            response.append(schemas.TimeSlotBatchResult(index=idx, error=str(result)))
+        else:
+            response.append(schemas.TimeSlotBatchResult(index=idx, time_slot=schemas.TimeSlot.from_orm(result)))
+    return response
+
+
+@app.get(
+    "/time-slots", response_model=Dict[int, List[schemas.ListedTimeSlot]], response_model_exclude_unset=True
+)
+def get_users_time_slots(
+        before_timestamp: int = None, after_timestamp: int = None, user_ids: List[int] = Query(...),
+        controller: BaseController = Depends(Controller)
+):
+    if len(user_ids) > MAX_USERS_PER_QUERY:
+        raise HTTPException(status_code=400, detail=f"at most {MAX_USERS_PER_QUERY} user_ids per query")
+    return controller.list_many(
+        sorted(set(user_ids)), before_timestamp=before_timestamp, after_timestamp=after_timestamp
+    )
+
+
+# Streams the slots of the given users, or of everybody, ordered by id with constant memory, after the
+# occurrences of their series. A broken export is resumed by passing the id of the last row received as
+# checkpoint.
+@app.get("/time-slots/export")
+def export_time_slots(
+        user_ids: List[int] = Query(None), checkpoint: int = None,
+        export_format: schemas.FileFormat = Query(schemas.FileFormat.ndjson, alias="format"),
+        compress: bool = Query(False, alias="gzip"), controller: BaseController = Depends(Controller)
+):
+    if user_ids is not None and len(user_ids) > MAX_USERS_PER_QUERY:
+        raise HTTPException(status_code=400, detail=f"at most {MAX_USERS_PER_QUERY} user_ids per query")
+    chunks = controller.iter_export(sorted(set(user_ids)) if user_ids else None, checkpoint=checkpoint)
+    if export_format == schemas.FileFormat.csv:
+        body, media_type = export.csv_chunks(chunks), "text/csv"
+    else:
+        body, media_type = export.ndjson_chunks(chunks), "application/x-ndjson"
+    headers = {"Content-Disposition": f'attachment; filename="time_slots.{export_format.value}"'}
+    if compress:
+        body = export.gzip_chunks(body)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(body, media_type=media_type, headers=headers)
+
+
+# the chunks of an async stream for a worker thread, each one is received on the event loop
+def _sync_chunks(stream: AsyncIterator[bytes], loop: asyncio.AbstractEventLoop) -> Iterator[bytes]:
+    async def _next():
+        try:
+            return await stream.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    while True:
+        chunk = asyncio.run_coroutine_threadsafe(_next(), loop).result()
+        if chunk is None:
+            return
+        yield chunk
+
+
+# the body holds NDJSON or CSV records of user_id, start_at and end_at, e.g. an export. It is parsed and
+# COPYed while it arrives, so only a chunk of the upload is held at a time.
+@app.post("/time-slots/import", response_model=schemas.ImportReport)
+async def import_time_slots(
+        request: Request, import_format: schemas.FileFormat = Query(schemas.FileFormat.ndjson, alias="format"),
+        controller: BaseController = Depends(Controller)
+):
+    lines = importer.decode_lines(_sync_chunks(request.stream(), asyncio.get_running_loop()))
+    now = int(datetime.datetime.utcnow().timestamp())
+    try:
+        report = await run_in_threadpool(importer.import_lines, controller, lines, import_format, now)
+    except errors.TimeOverlapError:
+        logger.warning("Import overlapping a concurrently created time range")
+        raise HTTPException(status_code=400, detail="time range overlap")
+    logger.info(f"Imported {report.imported} time slots, rejected {len(report.rejected)}")
+    return report
+
+
+@app.get("/time-slots/free-busy", response_model=schemas.FreeBusy)
+def get_free_busy(
+        start_at: int, end_at: int, user_ids: List[int] = Query(...),
+        controller: BaseController = Depends(Controller)
+):
+    if start_at >= end_at:
+        raise HTTPException(status_code=400, detail="start_at must less than end_at")
+    if len(user_ids) > MAX_USERS_PER_QUERY:
+        raise HTTPException(status_code=400, detail=f"at most {MAX_USERS_PER_QUERY} user_ids per query")
+    busy, free = controller.free_busy(sorted(set(user_ids)), start_at, end_at)
+    return schemas.FreeBusy(
+        busy=[schemas.Interval(start_at=s, end_at=e) for s, e in busy.tolist()],
+        free=[schemas.Interval(start_at=s, end_at=e) for s, e in free.tolist()],
+    )
+
+
+# the first free gaps long enough for a slot of duration seconds, instead of trying candidates one by one
+@app.get("/time-slots/free-windows", response_model=List[schemas.Interval])
+def get_free_windows(
+        start_at: int, end_at: int, duration: int, user_ids: List[int] = Query(...),
+        limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE), controller: BaseController = Depends(Controller)
+):
+    if start_at >= end_at:
+        raise HTTPException(status_code=400, detail="start_at must less than end_at")
+    if len(user_ids) > MAX_USERS_PER_QUERY:
+        raise HTTPException(status_code=400, detail=f"at most {MAX_USERS_PER_QUERY} user_ids per query")
+    try:
+        windows = controller.free_windows(sorted(set(user_ids)), start_at, end_at, duration, limit=limit)
+    except errors.TimeFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return [schemas.Interval(start_at=s, end_at=e) for s, e in windows]
+
+
+@app.delete("/users/{user_id}/time-slots", response_model=schemas.DeleteResult)
+def delete_user_time_slots(
+        user_id: int, ids: List[int] = Query(None), before_timestamp: int = None, after_timestamp: int = None,
+        delete_all: bool = Query(False, alias="all"), controller: BaseController = Depends(Controller)
+):
+    # without any filter every slot of the user is deleted, which has to be asked for explicitly
+    if ids is None and not before_timestamp and not after_timestamp and not delete_all:
+        raise HTTPException(status_code=400, detail="ids, before_timestamp, after_timestamp or all is required")
+    if ids is not None and len(ids) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"at most {MAX_BATCH_SIZE} ids per request")
+    deleted = controller.delete_many(
+        user_id, ids=ids, before_timestamp=before_timestamp, after_timestamp=after_timestamp
+    )
+    return schemas.DeleteResult(deleted=deleted)
+
+
+@app.delete("/users/{user_id}/time-slots/{time_slot_id}", status_code=204)
 def delete_user_time_slot(user_id: int, time_slot_id: int, controller: BaseController = Depends(Controller)):
-    return controller.delete(user_id, time_slot_id)
+    if not controller.delete(user_id, time_slot_id):
+        raise HTTPException(status_code=404, detail="result not found")
+    return Response(status_code=204)
+
+
+@app.post("/users/{user_id}/time-slot-series", response_model=schemas.TimeSlotSeries)
+def create_user_time_slot_series(
+        user_id: int, time_slot_series: schemas.TimeSlotSeriesBase, controller: BaseController = Depends(Controller)
+):
+    now = int(datetime.datetime.utcnow().timestamp())
+    try:
+        return controller.create_series(user_id, time_slot_series, now=now)
+    except errors.TimeOverlapError:
+        logger.warning(f"User {user_id} sent overlapped time range series")
+        raise HTTPException(status_code=400, detail="time range overlap")
+    except errors.TimeFormatError as e:
+        logger.warning(f"User {user_id} sent time format error {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.delete("/users/{user_id}/time-slot-series/{series_id}", status_code=204)
+def delete_user_time_slot_series(user_id: int, series_id: int, controller: BaseController = Depends(Controller)):
+    if not controller.delete_series(user_id, series_id):
+        raise HTTPException(status_code=404, detail="result not found")
+    return Response(status_code=204)
+
+
+@app.get(
+    "/async/users/{user_id}/time-slots", response_model=List[schemas.ListedTimeSlot], response_model_exclude_unset=True
+)
+async def async_get_user_time_slots(
+        user_id: int, before_timestamp: int = None, after_timestamp: int = None,
+        controller: BaseController = Depends(AsyncController)
+):
+    time_slots = await controller.list(user_id, before_timestamp=before_timestamp, after_timestamp=after_timestamp)
+    if not time_slots:
+        raise HTTPException(status_code=404, detail="result not found")
+    return time_slots
+
+
+@app.post("/async/users/{user_id}/time-slots", response_model=schemas.TimeSlot)
+async def async_create_user_time_slot(
+        user_id: int, time_slot: schemas.TimeSlotBase, controller: BaseController = Depends(AsyncController)
+):
+    now = int(datetime.datetime.utcnow().timestamp())
+    slot = schemas.TimeSlotCreate(
+        user_id=user_id,
+        start_at=time_slot.start_at,
+        end_at=time_slot.end_at
+    )
+    try:
+        obj = await controller.create(slot, now=now)
+    except errors.TimeOverlapError:
+        logger.warning(f"User {user_id} sent overlapped time range")
+        raise HTTPException(status_code=400, detail="time range overlap")
+    except errors.TimeFormatError as e:
+        logger.warning(f"User {user_id} sent time format error {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    return obj
+
+
+@app.delete("/async/users/{user_id}/time-slots/{time_slot_id}", status_code=204)
+async def async_delete_user_time_slot(
+        user_id: int, time_slot_id: int, controller: BaseController = Depends(AsyncController)
+):
+    if not await controller.delete(user_id, time_slot_id):
+        raise HTTPException(status_code=404, detail="result not found")
+    return Response(status_code=204)
@@ -0,0 +1,139 @@
+import functools
+import inspect
+import time
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import errors
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ["handler", "method"]
+)
+RESPONSES = Counter(
+    "http_responses_total", "HTTP responses by route and status code", ["handler", "method", "status"]
+)
+TIME_SLOT_REJECTIONS = Counter(
+    "time_slot_rejections_total", "Time slots rejected by the controllers", ["reason"]
+)
+POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection", ["engine"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+)
+
+
+POOL_CHECKOUTS = Counter(
+    "db_pool_checkouts_total", "Pooled connection checkouts", ["engine"]
+)
+ROUTED_READS = Counter(
+    "db_routed_reads_total", "Reads sent to the primary or a replica by the replica router", ["target"]
+)
+GROUP_COMMIT_BATCH_SIZE = Histogram(
+    "time_slot_group_commit_batch_size", "Time slots inserted per group commit",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+CHANGE_FEED_SUBSCRIBERS = Gauge(
+    "time_slot_change_feed_subscribers", "Clients subscribed to the change feed of this process"
+)
+CHANGE_FEED_RESYNCS = Counter(
+    "time_slot_change_feed_resyncs_total", "Subscribers told to reload after falling behind the change feed"
+)
+
+
+class PoolCollector:
+    def __init__(self):
+        self.engines = {}
+
+    def collect(self):
+        size = GaugeMetricFamily("db_pool_size", "Configured pool size", labels=["engine"])
+        checked_out = GaugeMetricFamily("db_pool_checked_out", "Connections in use", labels=["engine"])
+        overflow = GaugeMetricFamily("db_pool_overflow", "Connections opened beyond pool_size", labels=["engine"])
+        for name, engine in self.engines.items():
+            pool = engine.pool
+            if not hasattr(pool, "checkedout"):
+                continue
+            size.add_metric([name], pool.size())
+            checked_out.add_metric([name], pool.checkedout())
+            overflow.add_metric([name], max(pool.overflow(), 0))
+        yield size
+        yield checked_out
+        yield overflow
+
+
+pool_collector = PoolCollector()
+REGISTRY.register(pool_collector)
+
+
+def instrument_engine(name: str, engine: Engine):
+    checkouts = POOL_CHECKOUTS.labels(name)
+
+    @event.listens_for(engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        checkouts.inc()
+
+    listeners = getattr(engine.pool, "checkout_wait_listeners", None)
+    if listeners is not None:
+        listeners.append(POOL_CHECKOUT_WAIT.labels(name).observe)
+    pool_collector.engines[name] = engine
+
+
+def count_rejections(func):
+    def _count(e: Exception):
+        if isinstance(e, errors.TimeOverlapError):
+            TIME_SLOT_REJECTIONS.labels("overlap").inc()
+        elif isinstance(e, errors.TimeFormatError):
+            TIME_SLOT_REJECTIONS.labels("format").inc()
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except (errors.TimeOverlapError, errors.TimeFormatError) as e:
+                _count(e)
+                raise
+        return wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            result = func(*args, **kwargs)
+        except (errors.TimeOverlapError, errors.TimeFormatError) as e:
+            _count(e)
+            raise
+        # batch methods report rejections per item instead of raising
+        if isinstance(result, list):
+            for item in result:
+                _count(item)
+        return result
+    return wrapper
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        started = time.perf_counter()
+
+        async def _send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            # the router stores the matched endpoint in the shared scope
+            endpoint = scope.get("endpoint")
+            handler = endpoint.__name__ if endpoint is not None else "unmatched"
+            REQUEST_LATENCY.labels(handler, scope["method"]).observe(time.perf_counter() - started)
+            RESPONSES.labels(handler, scope["method"], str(status)).inc()
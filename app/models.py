@@ -1,9 +1,12 @@
-from sqlalchemy import Column, Integer, DateTime, Index
+from sqlalchemy import BigInteger, Column, Computed, Integer, DateTime, Index, literal_column
+from sqlalchemy.dialects.postgresql import ExcludeConstraint, INT8RANGE
 from sqlalchemy.sql import func
 
 from app.database import Base
 
 
+# The b84e1d07c2a5 migration partitions the table by start_at, with the exclusion constraint on every
+# partition and the primary key on (id, start_at). create_all builds the plain table described here.
 class TimeSlot(Base):
     __tablename__ = "time_slot"
 
@@ -12,8 +15,44 @@ class TimeSlot(Base):
     created_at = Column(DateTime, nullable=False, server_default=func.now())
     start_at = Column(Integer, nullable=False)
     end_at = Column(Integer, nullable=False)
+    time_range = Column(INT8RANGE, Computed("int8range(start_at, end_at)", persisted=True), nullable=False)
 
     __table_args__ = (
         Index("user_id__id", "user_id", "id"),
         Index("user_id__start_at__end_at", "user_id", "start_at", "end_at"),
+        # int4range(user_id, user_id, '[]') gives user_id a GiST equality operator without btree_gist
+        ExcludeConstraint(
+            (func.int4range(user_id, user_id, literal_column("'[]'")), "="),
+            (time_range, "&&"),
+            name="time_slot__user_id__time_range__excl",
+            using="gist",
+        ),
+    )
+
+
+# bumped in the transaction of every write to a user's time slots, backs the ETag of the list endpoint
+class TimeSlotVersion(Base):
+    __tablename__ = "time_slot_version"
+
+    user_id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False)
+
+
+# one row per recurring slot: occurrence k spans [start_at + k * every, end_at + k * every) for k < occurrences
+class TimeSlotSeries(Base):
+    __tablename__ = "time_slot_series"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    start_at = Column(Integer, nullable=False)
+    end_at = Column(Integer, nullable=False)
+    every = Column(Integer, nullable=False)
+    occurrences = Column(Integer, nullable=False)
+    last_end_at = Column(
+        BigInteger, Computed("end_at + (occurrences - 1)::bigint * every", persisted=True), nullable=False
+    )
+
+    __table_args__ = (
+        Index("time_slot_series__user_id__start_at", "user_id", "start_at"),
     )
@@ -0,0 +1,20 @@
+import base64
+from typing import Tuple
+
+from app import errors
+
+
+def encode_cursor(*key: int) -> str:
+    raw = ":".join(str(part) for part in key)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int = 2) -> Tuple[int, ...]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        key = tuple(int(part) for part in raw.split(":"))
+    except ValueError:
+        raise errors.InvalidCursorError(f"invalid cursor {cursor}")
+    if len(key) != size:
+        raise errors.InvalidCursorError(f"invalid cursor {cursor}")
+    return key
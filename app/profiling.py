@@ -0,0 +1,58 @@
+import logging
+import random
+from typing import Tuple, Union
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+
+# parameters are passed to the driver as they are, literal binds can not render ARRAY parameters.
+# They are wrapped in a list on execution, a tuple starting with a list would be taken for executemany.
+def _explain_sql(statement, dialect, params: dict = None) -> Tuple[str, Union[dict, tuple]]:
+    compiled = statement.compile(dialect=dialect)
+    params = compiled.construct_params(params)
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    return f"EXPLAIN (ANALYZE, BUFFERS) {compiled}", params
+
+
+class QueryPlanSampler:
+    def __init__(self, sample_rate: float = 0.0):
+        self.sample_rate = sample_rate
+
+    def should_sample(self) -> bool:
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _log(self, statement, plan: list):
+        plan = "\n".join(plan)
+        logger.info(f"query plan for {statement}\n{plan}")
+
+    # ANALYZE really runs the statement, so it is wrapped in a savepoint which is always rolled back
+    def explain(self, sess: Session, statement, params: dict = None):
+        savepoint = sess.begin_nested()
+        try:
+            conn = sess.connection()
+            sql, params = _explain_sql(statement, conn.dialect, params)
+            plan = conn.exec_driver_sql(sql, [params]).scalars().all()
+        except DBAPIError as e:
+            logger.warning(f"query plan sampling failed {e}")
+            return
+        finally:
+            savepoint.rollback()
+        self._log(statement, plan)
+
+    async def async_explain(self, sess, statement, params: dict = None):
+        savepoint = await sess.begin_nested()
+        try:
+            conn = await sess.connection()
+            sql, params = _explain_sql(statement, conn.dialect, params)
+            result = await conn.exec_driver_sql(sql, [params])
+            plan = result.scalars().all()
+        except DBAPIError as e:
+            logger.warning(f"query plan sampling failed {e}")
+            return
+        finally:
+            await savepoint.rollback()
+        self._log(statement, plan)
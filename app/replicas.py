@@ -0,0 +1,153 @@
+import itertools
+import logging
+import random
+import threading
+import time
+from typing import Callable, Iterable, List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker
+
+from app.metrics import ROUTED_READS
+
+logger = logging.getLogger(__name__)
+
+# a replica whose last completed lag check is older than this many check intervals is skipped, e.g. while
+# its check hangs on a replica which stopped responding
+STALE_CHECKS = 3
+
+# the replay timestamp only moves when the primary writes, a replica which replayed everything it received
+# is up to date however old that timestamp is
+LAG_QUERY = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+class Replica:
+    def __init__(self, name: str, db: sessionmaker):
+        self.name = name
+        self.db = db
+        self.lag = 0.0
+        self.checked_at = None
+
+    # a saturated replica pool raises TimeoutError, which is not a DBAPIError
+    def check_lag(self) -> float:
+        try:
+            with self.db() as sess:
+                self.lag = float(sess.execute(LAG_QUERY).scalar())
+        except SQLAlchemyError as e:
+            logger.warning(f"Replica {self.name} lag check failed: {e}")
+            self.lag = float("inf")
+        self.checked_at = time.monotonic()
+        return self.lag
+
+
+# policies pick one of the replicas which are within the lag threshold
+class RoundRobinPolicy:
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def __call__(self, replicas: List[Replica]) -> Replica:
+        return replicas[next(self._counter) % len(replicas)]
+
+
+def random_policy(replicas: List[Replica]) -> Replica:
+    return random.choice(replicas)
+
+
+def least_lag_policy(replicas: List[Replica]) -> Replica:
+    return min(replicas, key=lambda replica: replica.lag)
+
+
+# Sends reads to a replica chosen by policy and everything else to the primary. Users who wrote through
+# this process in the last read_after_write seconds read from the primary so they see their own writes,
+# and replicas lagging more than max_lag seconds are skipped until they catch up. Lag is polled every
+# lag_check_interval seconds by one thread per replica, reads only look at the last result.
+class ReplicaRouter:
+    def __init__(
+        self,
+        primary: sessionmaker,
+        replicas: List[Replica],
+        policy: Callable[[List[Replica]], Replica] = None,
+        max_lag: float = 5.0,
+        read_after_write: float = 5.0,
+        lag_check_interval: float = 1.0,
+    ):
+        self.primary = primary
+        self.replicas = replicas
+        self.policy = policy or RoundRobinPolicy()
+        self.max_lag = max_lag
+        self.read_after_write = read_after_write
+        self.lag_check_interval = lag_check_interval
+        self._written = {}
+        self._lock = threading.Lock()
+        self._pollers = []
+        self._stop = None
+
+    # checks the replicas not checked yet once, so the first reads know their lag, and starts the pollers
+    def start(self):
+        if self._pollers:
+            return
+        with self._lock:
+            if self._pollers:
+                return
+            for replica in self.replicas:
+                if replica.checked_at is None:
+                    replica.check_lag()
+            self._stop = threading.Event()
+            self._pollers = [
+                threading.Thread(
+                    target=self._poll, args=(replica, self._stop), name=f"lag-{replica.name}", daemon=True
+                )
+                for replica in self.replicas
+            ]
+            for poller in self._pollers:
+                poller.start()
+
+    # not joined, a poller may hang in the check of a replica which stopped responding
+    def close(self):
+        with self._lock:
+            if self._pollers:
+                self._stop.set()
+            self._pollers = []
+
+    def _poll(self, replica: Replica, stop: threading.Event):
+        while not stop.wait(self.lag_check_interval):
+            replica.check_lag()
+
+    def mark_write(self, user_id: int):
+        now = time.monotonic()
+        with self._lock:
+            self._written[user_id] = now + self.read_after_write
+            if len(self._written) > 10000:
+                self._written = {key: until for key, until in self._written.items() if until > now}
+
+    def recently_wrote(self, user_id: int) -> bool:
+        with self._lock:
+            until = self._written.get(user_id)
+        return until is not None and until > time.monotonic()
+
+    def _available(self) -> List[Replica]:
+        self.start()
+        stale_before = time.monotonic() - self.lag_check_interval * STALE_CHECKS
+        return [
+            replica for replica in self.replicas
+            if replica.checked_at is not None and replica.checked_at >= stale_before and replica.lag <= self.max_lag
+        ]
+
+    def choose(self, user_ids: Iterable[int] = ()) -> Optional[Replica]:
+        if any(self.recently_wrote(user_id) for user_id in user_ids):
+            return None
+        available = self._available()
+        return self.policy(available) if available else None
+
+    # sessionmaker for a read of the given users' slots
+    def for_read(self, *user_ids: int) -> sessionmaker:
+        replica = self.choose(user_ids)
+        if replica is None:
+            ROUTED_READS.labels("primary").inc()
+            return self.primary
+        ROUTED_READS.labels(replica.name).inc()
+        return replica.db
@@ -0,0 +1,163 @@
+"""Partition maintenance and retention of expired time slots.
+
+Meant to run from cron, e.g. once a day:
+
+    python -m app.retention --retention-days 30
+
+Creates the partitions for the coming weeks, drops partitions whose slots have all expired,
+deletes the remaining expired slots in small batches and then the series whose last occurrence
+expired. Works on an unpartitioned time_slot table as well, then only the deletes run.
+"""
+import argparse
+import logging
+import sys
+import time
+from typing import List
+
+from sqlalchemy import delete, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+
+from app import database, models
+from app.controllers.time_slot import MAX_SLOT_DURATION
+from app.settings import settings
+from app.versions import bump_statement
+
+logger = logging.getLogger(__name__)
+
+# keep in sync with the b84e1d07c2a5 migration which defines time_slot_create_partition
+PARTITION_WIDTH = 7 * 86400
+PARTITION_PREFIX = "time_slot_p"
+LOCK_NOT_AVAILABLE = "55P03"
+
+
+def is_partitioned(conn) -> bool:
+    return conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('time_slot'))"
+    )).scalar()
+
+
+# lower bounds of the range partitions, the default partition is not included
+def partition_bounds(conn) -> List[int]:
+    names = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'time_slot'::regclass"
+    )).scalars()
+    return sorted(int(name[len(PARTITION_PREFIX):]) for name in names if name.startswith(PARTITION_PREFIX))
+
+
+# DDL on a partition locks the parent table, give up instead of queueing every query behind the lock
+def _set_lock_timeout(conn, lock_timeout: float):
+    conn.execute(text(f"SET LOCAL lock_timeout = '{int(lock_timeout * 1000)}ms'"))
+
+
+def _is_lock_timeout(e: OperationalError) -> bool:
+    return getattr(e.orig, "pgcode", None) == LOCK_NOT_AVAILABLE
+
+
+def ensure_partitions(engine: Engine, until: int, lock_timeout: float = 2.0) -> int:
+    now = int(time.time())
+    created = 0
+    for lower in range(now // PARTITION_WIDTH * PARTITION_WIDTH, until, PARTITION_WIDTH):
+        try:
+            with engine.begin() as conn:
+                _set_lock_timeout(conn, lock_timeout)
+                created += conn.execute(text("SELECT time_slot_create_partition(:lower)"), {"lower": lower}).scalar()
+        except OperationalError as e:
+            if not _is_lock_timeout(e):
+                raise
+            logger.warning(f"Timed out creating partition {PARTITION_PREFIX}{lower}, retrying on the next run")
+    return created
+
+
+def drop_expired_partitions(engine: Engine, cutoff: int, lock_timeout: float = 2.0) -> List[str]:
+    with engine.connect() as conn:
+        lowers = partition_bounds(conn)
+    dropped = []
+    for lower in lowers:
+        # slots start before the upper bound, so all of them ended by upper bound + MAX_SLOT_DURATION
+        if lower + PARTITION_WIDTH + MAX_SLOT_DURATION > cutoff:
+            break
+        name = f"{PARTITION_PREFIX}{lower}"
+        try:
+            with engine.begin() as conn:
+                _set_lock_timeout(conn, lock_timeout)
+                user_ids = conn.execute(text(f"SELECT DISTINCT user_id FROM {name}")).scalars().all()
+                if user_ids:
+                    conn.execute(*bump_statement(user_ids))
+                conn.execute(text(f"ALTER TABLE time_slot DETACH PARTITION {name}"))
+                conn.execute(text(f"DROP TABLE {name}"))
+        except OperationalError as e:
+            if not _is_lock_timeout(e):
+                raise
+            logger.warning(f"Timed out dropping partition {name}, retrying on the next run")
+            continue
+        dropped.append(name)
+    return dropped
+
+
+# every batch is its own short transaction, so row locks and WAL are released as it goes
+def delete_expired(engine: Engine, cutoff: int, batch_size: int = 1000) -> int:
+    table = models.TimeSlot.__table__
+    # start_at < cutoff follows from end_at <= cutoff and lets the planner prune partitions
+    expired = select(table.c.id).where(
+        table.c.start_at < cutoff, table.c.end_at <= cutoff
+    ).limit(batch_size).scalar_subquery()
+    statement = delete(table).where(
+        table.c.start_at < cutoff, table.c.id.in_(expired)
+    ).returning(table.c.user_id)
+    deleted = 0
+    while True:
+        with engine.begin() as conn:
+            user_ids = conn.execute(statement).scalars().all()
+            if user_ids:
+                conn.execute(*bump_statement(user_ids))
+        count = len(user_ids)
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+# series are few rows each, they are removed once their last occurrence ended before the cutoff
+def delete_expired_series(engine: Engine, cutoff: int) -> int:
+    table = models.TimeSlotSeries.__table__
+    with engine.begin() as conn:
+        user_ids = conn.execute(
+            delete(table).where(table.c.last_end_at <= cutoff).returning(table.c.user_id)
+        ).scalars().all()
+        if user_ids:
+            conn.execute(*bump_statement(user_ids))
+    return len(user_ids)
+
+
+def run(engine: Engine, retention_days: int, batch_size: int, partitions_ahead_days: int, lock_timeout: float):
+    now = int(time.time())
+    cutoff = now - retention_days * 86400
+    with engine.connect() as conn:
+        partitioned = is_partitioned(conn)
+    if partitioned:
+        created = ensure_partitions(engine, now + partitions_ahead_days * 86400, lock_timeout)
+        logger.info(f"Created {created} partitions")
+        dropped = drop_expired_partitions(engine, cutoff, lock_timeout)
+        logger.info(f"Dropped {len(dropped)} expired partitions")
+    deleted = delete_expired(engine, cutoff, batch_size)
+    logger.info(f"Deleted {deleted} time slots ended before {cutoff}")
+    deleted = delete_expired_series(engine, cutoff)
+    logger.info(f"Deleted {deleted} time slot series ended before {cutoff}")
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--retention-days", type=int, default=settings.retention_days)
+    parser.add_argument("--batch-size", type=int, default=settings.retention_batch_size)
+    parser.add_argument("--partitions-ahead-days", type=int, default=settings.partitions_ahead_days)
+    parser.add_argument("--lock-timeout", type=float, default=2.0, help="seconds to wait for DDL locks")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    run(database.engine, args.retention_days, args.batch_size, args.partitions_ahead_days, args.lock_timeout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,6 @@
+from enum import Enum
+from typing import List, Optional
+
 from pydantic import BaseModel
 
 
@@ -15,3 +18,60 @@ class TimeSlot(TimeSlotBase):
 
     class Config:
         orm_mode = True
+
+
+# list entry, occurrences of a series have no id of their own and carry the series_id instead
+class ListedTimeSlot(TimeSlotBase):
+    id: Optional[int]
+    series_id: Optional[int] = None
+
+    class Config:
+        orm_mode = True
+
+
+class TimeSlotSeriesBase(TimeSlotBase):
+    # start_at and end_at are the first occurrence, the others follow every seconds
+    every: int
+    occurrences: int
+
+
+class TimeSlotSeries(TimeSlotSeriesBase):
+    id: int
+
+    class Config:
+        orm_mode = True
+
+
+class TimeSlotBatchResult(BaseModel):
+    index: int
+    time_slot: Optional[TimeSlot] = None
+    error: Optional[str] = None
+
+
+class DeleteResult(BaseModel):
+    deleted: int
+
+
+class ImportRejection(BaseModel):
+    line: int
+    reason: str
+
+
+class ImportReport(BaseModel):
+    imported: int
+    rejected: List[ImportRejection]
+
+
+class Interval(BaseModel):
+    start_at: int
+    end_at: int
+
+
+class FreeBusy(BaseModel):
+    busy: List[Interval]
+    free: List[Interval]
+
+
+class FileFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
@@ -0,0 +1,135 @@
+import heapq
+from collections import namedtuple
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import BigInteger, Integer, and_, bindparam, cast, exists, func, select
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from app import models, schemas
+
+MAX_OCCURRENCES = 1000
+
+# occurrences are listed next to stored slots, id stays None as they have no row of their own
+SeriesOccurrence = namedtuple("SeriesOccurrence", ["id", "start_at", "end_at", "series_id"])
+
+
+def last_end_at(series) -> int:
+    return series.end_at + (series.occurrences - 1) * series.every
+
+
+# first occurrence index k ending after start_at, occurrence k ends at end_at + k * every
+def _first_ending_after(series, start_at: int) -> int:
+    behind = start_at - series.end_at
+    return 0 if behind < 0 else behind // series.every + 1
+
+
+def overlaps(series, start_at: int, end_at: int) -> bool:
+    k = _first_ending_after(series, start_at)
+    return k < series.occurrences and series.start_at + k * series.every < end_at
+
+
+def series_overlap(first, second) -> bool:
+    # walk the occurrences of the sparser series inside the common span, each one checked in O(1)
+    if first.every < second.every:
+        first, second = second, first
+    lower = max(first.start_at, second.start_at)
+    upper = min(last_end_at(first), last_end_at(second))
+    if lower >= upper:
+        return False
+    for k in range(_first_ending_after(first, lower), first.occurrences):
+        start_at = first.start_at + k * first.every
+        if start_at >= upper:
+            return False
+        if overlaps(second, start_at, first.end_at + k * first.every):
+            return True
+    return False
+
+
+# lazily yields the occurrences with after_timestamp < end_at < before_timestamp, the filters of list
+def expand(series, before_timestamp: int = None, after_timestamp: int = None) -> Iterator[SeriesOccurrence]:
+    k = _first_ending_after(series, after_timestamp) if after_timestamp else 0
+    duration = series.end_at - series.start_at
+    for k in range(k, series.occurrences):
+        end_at = series.end_at + k * series.every
+        if before_timestamp and end_at >= before_timestamp:
+            return
+        yield SeriesOccurrence(None, end_at - duration, end_at, series.id)
+
+
+# Removes the occurrences with after_timestamp < end_at < before_timestamp, the filters of list and
+# delete_many. Returns the number removed and the series left before and after the window.
+def trim(
+        series, before_timestamp: int = None, after_timestamp: int = None
+) -> Tuple[int, List[schemas.TimeSlotSeriesBase]]:
+    first = _first_ending_after(series, after_timestamp) if after_timestamp else 0
+    end = series.occurrences
+    if before_timestamp:
+        # first occurrence ending at or after before_timestamp
+        end = min(end, max(0, -(-(before_timestamp - series.end_at) // series.every)))
+    if first >= end:
+        return 0, [series]
+    left = []
+    if first > 0:
+        left.append(schemas.TimeSlotSeriesBase(
+            start_at=series.start_at, end_at=series.end_at, every=series.every, occurrences=first
+        ))
+    if end < series.occurrences:
+        left.append(schemas.TimeSlotSeriesBase(
+            start_at=series.start_at + end * series.every, end_at=series.end_at + end * series.every,
+            every=series.every, occurrences=series.occurrences - end
+        ))
+    return end - first, left
+
+
+# rows sorted by start_at merged with the occurrences of all_series inside the same window, lazily
+def merge(rows: Iterable, all_series: Iterable, before_timestamp: int = None, after_timestamp: int = None) -> Iterator:
+    expansions = [expand(series, before_timestamp, after_timestamp) for series in all_series]
+    if not expansions:
+        return iter(rows)
+    return heapq.merge(rows, *expansions, key=lambda row: row.start_at)
+
+
+# SQL counterpart of overlaps: does a series of user_id overlap [start_at, end_at). Only the last occurrence
+# starting before end_at can end after start_at, start_at < end_at of the series keeps the division exact.
+def overlapping(user_id, start_at, end_at):
+    series = models.TimeSlotSeries
+    last = func.least(series.occurrences - 1, (cast(end_at, BigInteger) - 1 - series.start_at) / series.every)
+    return exists().where(and_(
+        series.user_id == user_id,
+        series.start_at < end_at,
+        series.last_end_at > start_at,
+        series.end_at + last * series.every > start_at,
+    ))
+
+
+def span_filter(before_timestamp: Optional[int] = None, after_timestamp: Optional[int] = None) -> list:
+    series = models.TimeSlotSeries
+    filters = []
+    if before_timestamp:
+        filters.append(series.end_at < before_timestamp)
+    if after_timestamp:
+        filters.append(series.last_end_at > after_timestamp)
+    return filters
+
+
+def _int_array(name: str):
+    # the cast keeps the type in the SQL text, asyncpg can not infer it for unnest
+    return cast(bindparam(name, type_=ARRAY(Integer)), ARRAY(Integer))
+
+
+# (user_id, start_at, end_at) of the new slots which overlap no series, to insert from. One array per
+# column keeps the statement text the same whatever the number of slots, their values come from
+# new_slot_params at execution.
+def without_series_overlap():
+    new_slot = func.unnest(
+        _int_array("new_user_ids"), _int_array("new_start_ats"), _int_array("new_end_ats")
+    ).table_valued("user_id", "start_at", "end_at").render_derived(name="new_slot")
+    return select(new_slot).where(~overlapping(new_slot.c.user_id, new_slot.c.start_at, new_slot.c.end_at))
+
+
+def new_slot_params(time_slots: List[schemas.TimeSlotCreate]) -> dict:
+    return {
+        "new_user_ids": [time_slot.user_id for time_slot in time_slots],
+        "new_start_ats": [time_slot.start_at for time_slot in time_slots],
+        "new_end_ats": [time_slot.end_at for time_slot in time_slots],
+    }
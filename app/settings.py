@@ -0,0 +1,55 @@
+from typing import List
+
+from pydantic import BaseSettings
+
+
+class Settings(BaseSettings):
+    database_url: str = "postgresql+psycopg2://postgres:example@db/db"
+    async_database_url: str = "postgresql+asyncpg://postgres:example@db/db"
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    # a request finding every connection checked out is answered with 503 right away, this many seconds
+    # are only waited for by requests racing for the last one
+    db_pool_timeout: float = 1.0
+    db_pool_recycle: int = -1
+    db_pool_pre_ping: bool = True
+    # connections opened at startup, capped at db_pool_size
+    db_pool_prewarm: int = 0
+    # behind a transaction-mode pooler such as pgbouncer: no local pool and no prepared statement caches
+    db_external_pooler: bool = False
+    # read replicas for list queries, e.g. REPLICA_DATABASE_URLS='["postgresql+psycopg2://..."]'
+    replica_database_urls: List[str] = []
+    # replicas lagging more than this many seconds are skipped
+    replica_max_lag: float = 5.0
+    # seconds a user reads from the primary after writing through this process
+    replica_read_after_write: float = 5.0
+    replica_lag_check_interval: float = 1.0
+    # seconds to connect to a replica, bounds a lag check of a replica which went away
+    replica_connect_timeout: int = 2
+
+    # fraction of controller queries that also run EXPLAIN (ANALYZE, BUFFERS), 0 disables sampling
+    query_plan_sample_rate: float = 0.0
+    # Server-Timing header with SQL time, query count and pool checkout wait of every request
+    server_timing: bool = False
+    # statements running at least this many seconds are logged with their parameters, 0 disables the log
+    slow_query_threshold: float = 0.0
+    # per-user interval cache of TimeSlotController, 0 disables it
+    interval_cache_max_intervals: int = 0
+    interval_cache_ttl: float = 60.0
+    # coalesce concurrent creates into one INSERT of up to this many slots, 0 disables group commit
+    group_commit_max_batch: int = 0
+    # seconds a batch waits for more slots after its first one
+    group_commit_max_delay: float = 0.005
+
+    # seconds between SSE comments keeping idle change feed streams open through proxies
+    change_feed_heartbeat: float = 15.0
+    # events queued per subscriber before it is told to resync
+    change_feed_queue_size: int = 100
+
+    # used by python -m app.retention, slots ended more than retention_days ago are removed
+    retention_days: int = 30
+    retention_batch_size: int = 1000
+    partitions_ahead_days: int = 56
+
+
+settings = Settings()
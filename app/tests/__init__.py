@@ -1,15 +1,27 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 
 from app.database import Base
 
 SQLALCHEMY_DATABASE_URL = "postgresql+psycopg2://postgres:example@db/postgres"
+ASYNC_SQLALCHEMY_DATABASE_URL = "postgresql+asyncpg://postgres:example@db/postgres"
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# every test drives its own event loop, so pooled asyncpg connections must not outlive it
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL,
+    poolclass=NullPool,
+)
+TestingAsyncSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=async_engine, class_=AsyncSession
+)
+
 
 def setup_function():
     Base.metadata.create_all(bind=engine)
@@ -0,0 +1,161 @@
+"""Micro-benchmarks for the TimeSlotController hot paths.
+
+Runs against the throwaway test database, the tables are created and dropped like in the tests.
+
+    python -m app.tests.bench_time_slot_controller --users 50 --slots 200
+    python -m app.tests.bench_time_slot_controller --save-baseline
+
+Exits with status 1 when the p95 latency of an operation is worse than the stored baseline
+for the same data size by more than --tolerance.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+from app import errors
+from app.controllers.time_slot import TimeSlotController
+from app.schemas import TimeSlotBase, TimeSlotCreate
+from app.tests import TestingSessionLocal, setup_function, teardown_function
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "benchmark_baseline.json")
+SLOT_LENGTH = 600
+
+
+def _percentile(samples: list, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def _report(samples: list, elapsed: float) -> dict:
+    return {
+        "p50": _percentile(samples, 0.50) * 1000,
+        "p95": _percentile(samples, 0.95) * 1000,
+        "p99": _percentile(samples, 0.99) * 1000,
+        "ops_per_sec": len(samples) / elapsed,
+    }
+
+
+def _measure(func, iterations: int) -> dict:
+    samples = []
+    started = time.perf_counter()
+    for idx in range(iterations):
+        before = time.perf_counter()
+        func(idx)
+        samples.append(time.perf_counter() - before)
+    return _report(samples, time.perf_counter() - started)
+
+
+def _seed(controller: TimeSlotController, users: int, slots: int, now: int):
+    for user_id in range(1, users + 1):
+        time_slots = [
+            TimeSlotBase(start_at=now + 1 + idx * SLOT_LENGTH * 2, end_at=now + 1 + idx * SLOT_LENGTH * 2 + SLOT_LENGTH)
+            for idx in range(slots)
+        ]
+        controller.create_many(user_id, time_slots, now)
+
+
+def run(users: int, slots: int, iterations: int, seed: int) -> dict:
+    rand = random.Random(seed)
+    controller = TimeSlotController(TestingSessionLocal)
+    now = int(datetime.datetime.utcnow().timestamp())
+    _seed(controller, users, slots, now)
+    # new slots go after the seeded ones so creates never overlap
+    free_start = now + 1 + slots * SLOT_LENGTH * 2
+    created = []
+
+    def check_basic(_):
+        slot = TimeSlotCreate(user_id=1, start_at=now + 10, end_at=now + 10 + SLOT_LENGTH)
+        controller._check_basic(slot, now)
+
+    def overlap(_):
+        start_at = now + 1 + rand.randrange(slots) * SLOT_LENGTH * 2
+        slot = TimeSlotCreate(user_id=rand.randint(1, users), start_at=start_at, end_at=start_at + SLOT_LENGTH)
+        try:
+            controller.create(slot, now)
+        except errors.TimeOverlapError:
+            return
+        raise AssertionError("seeded slot did not overlap")
+
+    def create(idx):
+        start_at = free_start + idx * SLOT_LENGTH
+        user_id = rand.randint(1, users)
+        created.append((user_id, controller.create(
+            TimeSlotCreate(user_id=user_id, start_at=start_at, end_at=start_at + SLOT_LENGTH), now
+        ).id))
+
+    def list_(_):
+        controller.list(rand.randint(1, users))
+
+    def delete(idx):
+        controller.delete(*created[idx])
+
+    return {
+        "_check_basic": _measure(check_basic, iterations),
+        "overlap": _measure(overlap, iterations),
+        "create": _measure(create, iterations),
+        "list": _measure(list_, iterations),
+        "delete": _measure(delete, iterations),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_delta: float) -> list:
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        # min_delta keeps sub-microsecond jitter of the pure python paths from failing the run
+        limit = max(baseline[name]["p95"] * (1 + tolerance), baseline[name]["p95"] + min_delta)
+        if stats["p95"] > limit:
+            regressions.append(f"{name}: p95 {stats['p95']:.3f}ms > {limit:.3f}ms")
+    return regressions
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--slots", type=int, default=100, help="slots per user")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p95 slowdown, 0.25 is 25%%")
+    parser.add_argument("--min-delta", type=float, default=0.05, help="ignored p95 slowdown in ms")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    setup_function()
+    try:
+        results = run(args.users, args.slots, args.iterations, args.seed)
+    finally:
+        teardown_function()
+
+    print(f"{'operation':<14}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ops/s':>12}")
+    for name, stats in results.items():
+        print(f"{name:<14}{stats['p50']:>10.3f}{stats['p95']:>10.3f}{stats['p99']:>10.3f}{stats['ops_per_sec']:>12.1f}")
+
+    size = f"{args.users}x{args.slots}"
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    if args.save_baseline:
+        baselines[size] = results
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"baseline for {size} saved to {args.baseline}")
+        return 0
+    if size not in baselines:
+        print(f"no baseline for {size}, run with --save-baseline to store one")
+        return 0
+
+    regressions = compare(results, baselines[size], args.tolerance, args.min_delta)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
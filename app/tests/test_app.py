@@ -1,10 +1,22 @@
+import asyncio
 import datetime
+import time
 
+import orjson
 from fastapi.testclient import TestClient
-
-from . import TestingSessionLocal, setup_function, teardown_function
-from app.main import app, Controller
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from . import (
+    ASYNC_SQLALCHEMY_DATABASE_URL, SQLALCHEMY_DATABASE_URL, TestingAsyncSessionLocal, TestingSessionLocal,
+    setup_function, teardown_function
+)
+from app import unit_of_work
+from app.main import app, AsyncController, Controller
+from app.controllers.async_time_slot import AsyncTimeSlotController
 from app.controllers.time_slot import TimeSlotController
+from app.database import TimedAsyncAdaptedQueuePool, TimedQueuePool, async_prewarm, prewarm
 
 
 # Dependency
@@ -20,10 +32,21 @@ class OverrideControllerMaker:
         yield controller
 
 
+class OverrideAsyncControllerMaker(OverrideControllerMaker):
+    async def __call__(self):
+        if self.type == "time_slot":
+            controller = AsyncTimeSlotController(TestingAsyncSessionLocal)
+        else:
+            raise Exception("Controller not exist")
+        yield controller
+
+
 override_controller = OverrideControllerMaker("time_slot")
+override_async_controller = OverrideAsyncControllerMaker("time_slot")
 
 
 app.dependency_overrides[Controller] = override_controller
+app.dependency_overrides[AsyncController] = override_async_controller
 client = TestClient(app)
 
 
@@ -190,6 +213,103 @@ def test_get_user_time_slots__query_filter():
     )
 
 
+def test_get_user_time_slots__page():
+    user_id = 1
+    start_at = int(datetime.datetime.utcnow().timestamp()) + 10
+    for i in range(3):
+        _create_user_time_slot(user_id, start_at + i * 100, start_at + i * 100 + 50)
+
+    resp = client.get(f"/users/{user_id}/time-slots?limit=2")
+    assert resp.status_code == 200
+    assert resp.json() == [
+        {"id": 1, "start_at": start_at, "end_at": start_at + 50},
+        {"id": 2, "start_at": start_at + 100, "end_at": start_at + 150},
+    ]
+    cursor = resp.headers["X-Next-Cursor"]
+
+    resp = client.get(f"/users/{user_id}/time-slots?limit=2&cursor={cursor}")
+    assert resp.status_code == 200
+    assert resp.json() == [{"id": 3, "start_at": start_at + 200, "end_at": start_at + 250}]
+    assert "X-Next-Cursor" not in resp.headers
+
+    # without limit the cursor still pages, with the default page size
+    resp = client.get(f"/users/{user_id}/time-slots?cursor={cursor}")
+    assert resp.status_code == 200
+    assert resp.json() == [{"id": 3, "start_at": start_at + 200, "end_at": start_at + 250}]
+
+    resp = client.get(f"/users/{user_id}/time-slots?limit=2&cursor=broken")
+    assert resp.status_code == 400
+    resp = client.get(f"/users/{user_id}/time-slots?cursor=broken")
+    assert resp.status_code == 400
+
+
+def test_get_user_time_slots__stream():
+    user_id = 1
+    _check_get_response(user_id, {"detail": "result not found"}, query_string="?stream=true", status=404)
+
+    start_at = int(datetime.datetime.utcnow().timestamp()) + 10
+    for i in range(3):
+        _create_user_time_slot(user_id, start_at + i * 100, start_at + i * 100 + 50)
+    _check_get_response(
+        user_id,
+        [{"id": i + 1, "start_at": start_at + i * 100, "end_at": start_at + i * 100 + 50} for i in range(3)],
+        query_string="?stream=true"
+    )
+
+
+def test_get_user_time_slots__etag():
+    user_id = 1
+    start_at = int(datetime.datetime.utcnow().timestamp()) + 10
+    created = _create_user_time_slot(user_id, start_at, start_at + 50).json()
+
+    resp = client.get(f"/users/{user_id}/time-slots")
+    assert resp.status_code == 200
+    etag = resp.headers["ETag"]
+    assert etag == '"1"'
+
+    resp = client.get(f"/users/{user_id}/time-slots", headers={"If-None-Match": f'"0", W/{etag}'})
+    assert resp.status_code == 304
+    assert resp.headers["ETag"] == etag
+    assert resp.content == b""
+
+    # other users keep their own version
+    _create_user_time_slot(user_id + 1, start_at, start_at + 50)
+    assert client.get(f"/users/{user_id}/time-slots", headers={"If-None-Match": etag}).status_code == 304
+
+    _create_user_time_slot(user_id, start_at + 100, start_at + 150)
+    resp = client.get(f"/users/{user_id}/time-slots?stream=true", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] == '"2"'
+    assert len(resp.json()) == 2
+
+    client.delete(f"/users/{user_id}/time-slots/{created['id']}")
+    resp = client.get(f"/users/{user_id}/time-slots?limit=1", headers={"If-None-Match": '"2"'})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] == '"3"'
+
+    # * matches any existing list, a user without slots stays a 404
+    assert client.get(f"/users/{user_id}/time-slots", headers={"If-None-Match": "*"}).status_code == 304
+    resp = client.get(f"/users/{user_id}/time-slots?stream=true", headers={"If-None-Match": "*"})
+    assert resp.status_code == 304
+    assert client.get("/users/99/time-slots", headers={"If-None-Match": "*"}).status_code == 404
+    assert client.get("/users/99/time-slots?stream=true", headers={"If-None-Match": "*"}).status_code == 404
+
+
+def test_request_rolled_back_on_error():
+    user_id = 1
+    start_at = int(datetime.datetime.utcnow().timestamp()) + 10
+    _create_user_time_slot(user_id, start_at, start_at + 100)
+    etag = client.get(f"/users/{user_id}/time-slots").headers["ETag"]
+
+    # the version bump taken before the overlap was found is rolled back with the rest of the request
+    resp = client.post(
+        f"/users/{user_id}/time-slot-series",
+        json={"start_at": start_at, "end_at": start_at + 100, "every": 1000, "occurrences": 2}
+    )
+    assert resp.status_code == 400
+    assert client.get(f"/users/{user_id}/time-slots").headers["ETag"] == etag
+
+
 def test_create_user_time_slot():
     user_id = 1
     start_at = int(datetime.datetime.utcnow().timestamp()) + 10
@@ -230,6 +350,196 @@ def test_create_user_time_slot__format_error():
     assert resp.json() == {"detail": "range start_at and end_at must in 24 hours"}
 
 
+def test_create_user_time_slots__batch():
+    user_id = 1
+    start_at = int(datetime.datetime.utcnow().timestamp()) + 10
+    end_at = start_at + 120
+    _create_user_time_slot(user_id, start_at, end_at)
+
+    resp = client.post(
+        f"/users/{user_id}/time-slots/batch",
+        json=[
+            {"start_at": end_at, "end_at": end_at + 100},
+            {"start_at": start_at, "end_at": end_at},
+            {"start_at": end_at + 300, "end_at": end_at + 200},
+        ]
+    )
+    assert resp.status_code == 200
+    assert resp.json() == [
+        {"index": 0, "time_slot": {"id": 2, "start_at": end_at, "end_at": end_at + 100}, "error": None},
+        {"index": 1, "time_slot": None, "error": "time range overlap"},
+        {"index": 2, "time_slot": None, "error": "start_at must less than end_at"},
+    ]
+
+
+def test_get_users_time_slots():
+    start_at = int(datetime.datetime.utcnow().timestamp()) + 10
+    _create_user_time_slot(1, start_at, start_at + 100)
+    _create_user_time_slot(2, start_at + 50, start_at + 200)
+
+    resp = client.get("/time-slots?user_ids=1&user_ids=2&user_ids=3")
+    assert resp.status_code == 200
+    assert resp.json() == {
+        "1": [{"id": 1, "start_at": start_at, "end_at": start_at + 100}],
+        "2": [{"id": 2, "start_at": start_at + 50, "end_at": start_at + 200}],
+        "3": [],
+    }
+
+    resp = client.get(f"/time-slots?user_ids=1&user_ids=2&before_timestamp={start_at + 150}")
+    assert resp.json() == {"1": [{"id": 1, "start_at": start_at, "end_at": start_at + 100}], "2": []}
+
+
+def test_user_time_slot_series():
+    user_id = 1
+    start_at = int(datetime.datetime.utcnow().timestamp()) + 10
+    _create_user_time_slot(user_id, start_at + 1000, start_at + 1100)
+
+    series = {"start_at": start_at, "end_at": start_at + 100, "every": 500, "occurrences": 2}
+    resp = client.post(f"/users/{user_id}/time-slot-series", json=series)
+    assert resp.status_code == 200
+    series_id = resp.json().pop("id")
+    assert resp.json() == {**series, "id": series_id}
+    resp = client.post(f"/users/{user_id}/time-slot-series", json={**series, "occurrences": 3})
+    assert resp.status_code == 400
+    assert resp.json() == {"detail": "time range overlap"}
+    resp = client.post(f"/users/{user_id}/time-slot-series", json={**series, "every": 50})
+    assert resp.status_code == 400
+
+    _check_get_response(user_id, [
+        {"id": None, "start_at": start_at, "end_at": start_at + 100, "series_id": series_id},
+        {"id": None, "start_at": start_at + 500, "end_at": start_at + 600, "series_id": series_id},
+        {"id": 1, "start_at": start_at + 1000, "end_at": start_at + 1100},
+    ])
+    resp = client.get(f"/time-slots?user_ids={user_id}&before_timestamp={start_at + 200}")
+    assert resp.json() == {
+        str(user_id): [{"id": None, "start_at": start_at, "end_at": start_at + 100, "series_id": series_id}]
+    }
+
+    # paged like the unpaged list, occurrences included
+    resp = client.get(f"/users/{user_id}/time-slots?limit=2")
+    assert resp.json() == [
+        {"id": None, "start_at": start_at, "end_at": start_at + 100, "series_id": series_id},
+        {"id": None, "start_at": start_at + 500, "end_at": start_at + 600, "series_id": series_id},
+    ]
+    resp = client.get(f"/users/{user_id}/time-slots?limit=2&cursor={resp.headers['X-Next-Cursor']}")
+    assert resp.json() == [{"id": 1, "start_at": start_at + 1000, "end_at": start_at + 1100}]
+    assert "X-Next-Cursor" not in resp.headers
+
+    assert client.delete(f"/users/{user_id}/time-slot-series/{series_id}").status_code == 204
+    assert client.delete(f"/users/{user_id}/time-slot-series/{series_id}").status_code == 404
+    _check_get_response(user_id, [{"id": 1, "start_at": start_at + 1000, "end_at": start_at + 1100}])
+
+
+def test_export_time_slots():
+    start_at = int(datetime.datetime.utcnow().timestamp()) + 10
+    ids = [
+        _create_user_time_slot(user_id, start_at + i * 100, start_at + i * 100 + 50).json()["id"]
+        for i, user_id in enumerate([1, 2, 1])
+    ]
+
+    series = {"start_at": start_at + 1000, "end_at": start_at + 1050, "every": 100, "occurrences": 2}
+    series_id = client.post("/users/2/time-slot-series", json=series).json()["id"]
+
+    resp = client.get("/time-slots/export")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "application/x-ndjson"
+    rows = [orjson.loads(line) for line in resp.content.splitlines()]
+    assert [(row["id"], row["user_id"], row["start_at"], row["series_id"]) for row in rows] == [
+        (None, 2, start_at + 1000, series_id), (None, 2, start_at + 1100, series_id),
+        (ids[0], 1, start_at, None), (ids[1], 2, start_at + 100, None), (ids[2], 1, start_at + 200, None)
+    ]
+
+    resp = client.get("/time-slots/export?format=csv&user_ids=2")
+    lines = resp.text.splitlines()
+    assert lines[0] == "id,user_id,start_at,end_at,created_at,series_id"
+    assert [line.split(",")[:4] + line.split(",")[5:] for line in lines[1:]] == [
+        ["", "2", str(start_at + 1000), str(start_at + 1050), str(series_id)],
+        ["", "2", str(start_at + 1100), str(start_at + 1150), str(series_id)],
+        [str(ids[1]), "2", str(start_at + 100), str(start_at + 150), ""],
+    ]
+
+    resp = client.get(f"/time-slots/export?format=csv&user_ids=1&checkpoint={ids[0]}&gzip=true")
+    assert resp.headers["content-encoding"] == "gzip"
+    lines = resp.text.splitlines()
+    assert lines[0] == "id,user_id,start_at,end_at,created_at,series_id"
+    assert [line.split(",")[:4] for line in lines[1:]] == [[str(ids[2]), "1", str(start_at + 200), str(start_at + 250)]]
+
+
+def test_export_time_slots__empty():
+    resp = client.get("/time-slots/export?format=csv")
+    assert resp.status_code == 200
+    assert resp.text == "id,user_id,start_at,end_at,created_at,series_id\n"
+    assert client.get("/time-slots/export").content == b""
+
+
+def test_import_time_slots():
+    start_at = int(datetime.datetime.utcnow().timestamp()) + 10
+    _create_user_time_slot(1, start_at, start_at + 100)
+
+    body = f"user_id,start_at,end_at\n1,{start_at + 50},{start_at + 150}\n1,{start_at + 200},{start_at + 300}\n"
+    resp = client.post("/time-slots/import?format=csv", data=body, headers={"Content-Type": "text/csv"})
+    assert resp.status_code == 200
+    assert resp.json() == {"imported": 1, "rejected": [{"line": 2, "reason": "time range overlap"}]}
+    assert len(client.get("/users/1/time-slots").json()) == 2
+
+
+def test_import_time_slots__chunked():
+    start_at = int(datetime.datetime.utcnow().timestamp()) + 10
+    body = (
+        f'{{"user_id": 1, "start_at": {start_at}, "end_at": {start_at + 100}}}\r\n'
+        f'{{"user_id": 1, "start_at": {start_at + 50}, "end_at": {start_at + 150}}}\r\n'
+        f'{{"user_id": 2, "start_at": {start_at}, "end_at": {start_at + 100}}}'
+    ).encode()
+
+    # records and line endings split across the chunks of the upload
+    def chunks():
+        for offset in range(0, len(body), 7):
+            yield body[offset:offset + 7]
+
+    resp = client.post("/time-slots/import", data=chunks())
+    assert resp.status_code == 200
+    assert resp.json() == {"imported": 1, "rejected": [
+        {"line": 1, "reason": "time range overlap"}, {"line": 2, "reason": "time range overlap"}
+    ]}
+    assert len(client.get("/users/2/time-slots").json()) == 1
+
+
+def test_get_free_busy():
+    start_at = int(datetime.datetime.utcnow().timestamp()) + 10
+    _create_user_time_slot(1, start_at, start_at + 100)
+    _create_user_time_slot(2, start_at + 50, start_at + 200)
+
+    resp = client.get(f"/time-slots/free-busy?user_ids=1&user_ids=2&start_at={start_at - 100}&end_at={start_at + 300}")
+    assert resp.status_code == 200
+    assert resp.json() == {
+        "busy": [{"start_at": start_at, "end_at": start_at + 200}],
+        "free": [
+            {"start_at": start_at - 100, "end_at": start_at},
+            {"start_at": start_at + 200, "end_at": start_at + 300},
+        ],
+    }
+
+    resp = client.get(f"/time-slots/free-busy?user_ids=1&start_at={start_at}&end_at={start_at}")
+    assert resp.status_code == 400
+
+
+def test_get_free_windows():
+    start_at = int(datetime.datetime.utcnow().timestamp()) + 10
+    _create_user_time_slot(1, start_at, start_at + 100)
+    _create_user_time_slot(2, start_at + 200, start_at + 300)
+
+    resp = client.get(
+        f"/time-slots/free-windows?user_ids=1&user_ids=2&start_at={start_at}&end_at={start_at + 1000}&duration=100"
+    )
+    assert resp.status_code == 200
+    assert resp.json() == [
+        {"start_at": start_at + 100, "end_at": start_at + 200},
+        {"start_at": start_at + 300, "end_at": start_at + 1000},
+    ]
+    resp = client.get(f"/time-slots/free-windows?user_ids=1&start_at={start_at}&end_at={start_at + 1000}&duration=0")
+    assert resp.status_code == 400
+
+
 def test_delete_user_time_slot():
     user_id = 1
     start_at = int(datetime.datetime.utcnow().timestamp()) + 10
@@ -240,4 +550,156 @@ def test_delete_user_time_slot():
     resp = client.delete(
         f"/users/{user_id}/time-slots/{resp_json['id']}"
     )
+    assert resp.status_code == 204
+    _check_get_response(user_id, {"detail": "result not found"}, status=404)
+
+    resp = client.delete(
+        f"/users/{user_id}/time-slots/{resp_json['id']}"
+    )
+    assert resp.status_code == 404
+    assert resp.json() == {"detail": "result not found"}
+
+
+def test_delete_user_time_slots():
+    user_id = 1
+    start_at = int(datetime.datetime.utcnow().timestamp()) + 10
+    ids = [
+        _create_user_time_slot(user_id, start_at + i * 100, start_at + i * 100 + 50).json()["id"] for i in range(4)
+    ]
+
+    resp = client.delete(f"/users/{user_id}/time-slots")
+    assert resp.status_code == 400
+    resp = client.delete(f"/users/{user_id}/time-slots?ids={ids[0]}&ids={ids[1]}")
+    assert resp.status_code == 200
+    assert resp.json() == {"deleted": 2}
+    resp = client.delete(f"/users/{user_id}/time-slots?before_timestamp={start_at + 300}")
+    assert resp.json() == {"deleted": 1}
+    resp = client.post(
+        f"/users/{user_id}/time-slot-series",
+        json={"start_at": start_at + 1000, "end_at": start_at + 1050, "every": 100, "occurrences": 3}
+    )
+    assert resp.status_code == 200
+    # all takes the series along, the account is empty afterwards
+    resp = client.delete(f"/users/{user_id}/time-slots?all=true")
+    assert resp.json() == {"deleted": 4}
+    _check_get_response(user_id, {"detail": "result not found"}, status=404)
+
+
+def test_async_user_time_slots():
+    user_id = 1
+    start_at = int(datetime.datetime.utcnow().timestamp()) + 10
+    end_at = start_at + 120
+
+    resp = client.get(f"/async/users/{user_id}/time-slots")
+    assert resp.status_code == 404
+
+    resp = client.post(f"/async/users/{user_id}/time-slots", json={"start_at": start_at, "end_at": end_at})
+    assert resp.status_code == 200
+    assert resp.json() == {"id": 1, "start_at": start_at, "end_at": end_at}
+
+    resp = client.post(f"/async/users/{user_id}/time-slots", json={"start_at": start_at, "end_at": end_at})
+    assert resp.status_code == 400
+    assert resp.json() == {"detail": "time range overlap"}
+
+    resp = client.post(f"/async/users/{user_id}/time-slots", json={"start_at": end_at, "end_at": start_at})
+    assert resp.status_code == 400
+    assert resp.json() == {"detail": "start_at must less than end_at"}
+
+    resp = client.get(f"/async/users/{user_id}/time-slots")
+    assert resp.status_code == 200
+    assert resp.json() == [{"id": 1, "start_at": start_at, "end_at": end_at}]
+
+    # occurrences of series are listed like on the sync route
+    resp = client.post(
+        f"/users/{user_id}/time-slot-series",
+        json={"start_at": end_at, "end_at": end_at + 60, "every": 120, "occurrences": 2}
+    )
+    series_id = resp.json()["id"]
+    resp = client.get(f"/async/users/{user_id}/time-slots")
+    assert resp.json() == [
+        {"id": 1, "start_at": start_at, "end_at": end_at},
+        {"id": None, "start_at": end_at, "end_at": end_at + 60, "series_id": series_id},
+        {"id": None, "start_at": end_at + 120, "end_at": end_at + 180, "series_id": series_id},
+    ]
+    assert client.delete(f"/users/{user_id}/time-slot-series/{series_id}").status_code == 204
+
+    resp = client.delete(f"/async/users/{user_id}/time-slots/1")
+    assert resp.status_code == 204
+    resp = client.delete(f"/async/users/{user_id}/time-slots/1")
+    assert resp.status_code == 404
+    _check_get_response(user_id, {"detail": "result not found"}, status=404)
+
+
+def test_unit_of_work_without_session(monkeypatch):
+    hops = []
+
+    async def counting_run_in_threadpool(func, *args):
+        hops.append(func.__name__)
+        return func(*args)
+
+    monkeypatch.setattr(unit_of_work, "run_in_threadpool", counting_run_in_threadpool)
+    # neither route opens a sync session, their unit of work is settled without a thread
+    assert client.get("/async/users/1/time-slots").status_code == 404
+    assert client.get("/metrics").status_code == 200
+    assert hops == []
+
+    assert client.get("/users/1/time-slots").status_code == 404
+    assert hops == ["rollback", "close"]
+
+
+def test_metrics():
+    user_id = 1
+    start_at = int(datetime.datetime.utcnow().timestamp()) + 10
+    _create_user_time_slot(user_id, start_at, start_at + 100)
+    _create_user_time_slot(user_id, start_at, start_at + 100)
+    _create_user_time_slot(user_id, start_at + 100, start_at)
+    client.get(f"/users/{user_id}/time-slots")
+
+    resp = client.get("/metrics")
     assert resp.status_code == 200
+    body = resp.text
+    assert 'http_request_duration_seconds_count{handler="create_user_time_slot",method="POST"}' in body
+    assert 'http_responses_total{handler="create_user_time_slot",method="POST",status="400"}' in body
+    assert 'http_responses_total{handler="get_user_time_slots",method="GET",status="200"}' in body
+    assert 'time_slot_rejections_total{reason="overlap"}' in body
+    assert 'time_slot_rejections_total{reason="format"}' in body
+    assert 'db_pool_size{engine="primary"}' in body
+
+
+def test_prewarm():
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, poolclass=TimedQueuePool, pool_size=3)
+    prewarm(engine, 10)
+    assert engine.pool.checkedin() == 3
+    engine.dispose()
+
+    async def _prewarm():
+        async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, poolclass=TimedAsyncAdaptedQueuePool, pool_size=2)
+        await async_prewarm(async_engine, 2)
+        checked_in = async_engine.sync_engine.pool.checkedin()
+        await async_engine.dispose()
+        return checked_in
+    assert asyncio.run(_prewarm()) == 2
+
+
+def test_pool_saturated():
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, poolclass=TimedQueuePool, pool_size=1, max_overflow=0, pool_timeout=5)
+    waits = []
+    engine.pool.checkout_wait_listeners.append(waits.append)
+
+    def _saturated_controller():
+        yield TimeSlotController(sessionmaker(bind=engine))
+
+    app.dependency_overrides[Controller] = _saturated_controller
+    try:
+        with engine.connect():
+            started = time.perf_counter()
+            resp = client.get("/users/1/time-slots")
+            elapsed = time.perf_counter() - started
+    finally:
+        app.dependency_overrides[Controller] = override_controller
+        engine.dispose()
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "1"
+    # rejected without waiting for pool_timeout
+    assert elapsed < 1
+    assert len(waits) == 1
@@ -0,0 +1,129 @@
+import asyncio
+import datetime
+import pytest
+
+from app.tests import TestingAsyncSessionLocal, TestingSessionLocal, setup_function, teardown_function
+
+from app.controllers.async_time_slot import AsyncTimeSlotController
+from app.controllers.time_slot import TimeSlotController
+from app.errors import TimeOverlapError, TimeFormatError
+from app.models import TimeSlot
+from app.profiling import QueryPlanSampler
+from app.schemas import TimeSlotCreate, TimeSlotSeriesBase
+
+
+def _get_controller():
+    return AsyncTimeSlotController(TestingAsyncSessionLocal)
+
+
+def test_create_timeslot():
+    controller = _get_controller()
+
+    expected_user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    expected_start_at = now + 1
+    expected_end_at = expected_start_at + 600
+    new_slot = TimeSlotCreate(user_id=expected_user_id, start_at=expected_start_at, end_at=expected_end_at)
+    new_item = asyncio.run(controller.create(new_slot, now))
+
+    with TestingSessionLocal() as sess:
+        obj = sess.query(TimeSlot).filter_by(user_id=expected_user_id).one()
+        assert obj.id == new_item.id
+        assert obj.start_at == expected_start_at
+        assert obj.end_at == expected_end_at
+
+
+def test_create_timeslot__errors():
+    controller = _get_controller()
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    start_at = now + 1
+    end_at = start_at + 600
+
+    new_slot = TimeSlotCreate(user_id=user_id, start_at=start_at, end_at=start_at)
+    with pytest.raises(TimeFormatError):
+        asyncio.run(controller.create(new_slot, now))
+
+    new_slot = TimeSlotCreate(user_id=user_id, start_at=start_at, end_at=end_at)
+    asyncio.run(controller.create(new_slot, now))
+    new_slot = TimeSlotCreate(user_id=user_id, start_at=start_at + 1, end_at=end_at + 1)
+    with pytest.raises(TimeOverlapError):
+        asyncio.run(controller.create(new_slot, now))
+
+    # adjacent slot is not an overlap
+    new_slot = TimeSlotCreate(user_id=user_id, start_at=end_at, end_at=end_at + 1)
+    asyncio.run(controller.create(new_slot, now))
+
+
+def test_get_user_time_slots__filter():
+    controller = _get_controller()
+
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    user_id = 1
+    expected_slots = [
+        (now + 1, now + 601),
+        (now + 1201, now + 1801),
+        (now + 2401, now + 3001),
+    ]
+    for slot in expected_slots:
+        new_slot = TimeSlotCreate(user_id=user_id, start_at=slot[0], end_at=slot[1])
+        asyncio.run(controller.create(new_slot, now))
+
+    slots = asyncio.run(controller.list(user_id))
+    assert [(slot.start_at, slot.end_at) for slot in slots] == expected_slots
+
+    slots = asyncio.run(controller.list(user_id, before_timestamp=expected_slots[2][1], after_timestamp=expected_slots[0][1]))
+    assert [(slot.start_at, slot.end_at) for slot in slots] == expected_slots[1:2]
+
+    assert asyncio.run(controller.list(2)) == []
+
+
+def test_get_user_time_slots__series():
+    controller = _get_controller()
+
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    user_id = 1
+    TimeSlotController(TestingSessionLocal).create_series(
+        user_id, TimeSlotSeriesBase(start_at=now + 100, end_at=now + 200, every=1000, occurrences=3), now
+    )
+    asyncio.run(controller.create(TimeSlotCreate(user_id=user_id, start_at=now + 300, end_at=now + 400), now))
+
+    slots = asyncio.run(controller.list(user_id))
+    assert [(slot.start_at, slot.end_at, slot.id is None) for slot in slots] == [
+        (now + 100, now + 200, True), (now + 300, now + 400, False),
+        (now + 1100, now + 1200, True), (now + 2100, now + 2200, True),
+    ]
+    slots = asyncio.run(controller.list(user_id, before_timestamp=now + 2200, after_timestamp=now + 200))
+    assert [slot.start_at for slot in slots] == [now + 300, now + 1100]
+
+
+def test_delete_user_time_slot():
+    controller = _get_controller()
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    new_slot = TimeSlotCreate(user_id=user_id, start_at=now + 1, end_at=now + 601)
+    new_item = asyncio.run(controller.create(new_slot, now))
+
+    asyncio.run(controller.delete(user_id, new_item.id))
+
+    with TestingSessionLocal() as sess:
+        assert sess.query(TimeSlot).filter_by(user_id=user_id, id=new_item.id).first() is None
+
+
+def test_query_plan_sampling(caplog):
+    controller = AsyncTimeSlotController(TestingAsyncSessionLocal, plan_sampler=QueryPlanSampler(1.0))
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    new_slot = TimeSlotCreate(user_id=user_id, start_at=now + 1, end_at=now + 601)
+    with caplog.at_level("INFO", logger="app.profiling"):
+        new_item = asyncio.run(controller.create(new_slot, now))
+        slots = asyncio.run(controller.list(user_id))
+
+    assert [slot.id for slot in slots] == [new_item.id]
+    plans = [r.getMessage() for r in caplog.records if r.getMessage().startswith("query plan for")]
+    # the insert with its version bump in one statement, and the list
+    assert len(plans) == 2
+    assert any("Insert on time_slot_version" in plan for plan in plans)
@@ -0,0 +1,18 @@
+from app.tests import setup_function, teardown_function
+from app.tests.bench_time_slot_controller import compare, run
+
+
+def test_run():
+    results = run(users=2, slots=5, iterations=5, seed=0)
+    assert set(results) == {"_check_basic", "overlap", "create", "list", "delete"}
+    for stats in results.values():
+        assert stats["p50"] <= stats["p95"] <= stats["p99"]
+        assert stats["ops_per_sec"] > 0
+
+
+def test_compare():
+    baseline = {"create": {"p95": 1.0}, "_check_basic": {"p95": 0.001}}
+    assert compare({"create": {"p95": 1.2}, "_check_basic": {"p95": 0.01}}, baseline, 0.25, 0.05) == []
+    assert compare({"create": {"p95": 1.3}, "list": {"p95": 9.0}}, baseline, 0.25, 0.05) == [
+        "create: p95 1.300ms > 1.250ms"
+    ]
@@ -0,0 +1,74 @@
+from app.cache import IntervalCache, UserIntervals
+
+
+def _put(cache: IntervalCache, user_id: int, rows: list):
+    cache.put(user_id, UserIntervals(rows), cache.begin_load(user_id))
+
+
+def test_user_intervals():
+    intervals = UserIntervals([(2, 300, 400), (1, 100, 200)])
+    assert not intervals.overlaps(200, 300)
+    assert intervals.overlaps(150, 250)
+    assert intervals.overlaps(0, 1000)
+    assert not intervals.overlaps(400, 500)
+
+    intervals.add(3, 200, 300)
+    assert intervals.overlaps(250, 260)
+    assert [slot.id for slot in intervals.list()] == [1, 3, 2]
+    assert [slot.id for slot in intervals.list(before_timestamp=400, after_timestamp=200)] == [3]
+
+    assert intervals.remove(3)
+    assert not intervals.remove(3)
+    assert not intervals.overlaps(250, 260)
+
+
+def test_interval_cache__counters_and_eviction():
+    cache = IntervalCache(max_intervals=3)
+    assert cache.overlaps(1, 0, 10) is None
+
+    _put(cache, 1, [(1, 100, 200), (2, 300, 400)])
+    _put(cache, 2, [(3, 100, 200)])
+    assert cache.overlaps(1, 150, 160) is True
+    assert cache.list(2) is not None
+
+    # user 1 is least recently used and gets evicted
+    cache.add(2, 4, 300, 400, 1)
+    assert cache.overlaps(1, 150, 160) is None
+    assert [slot.id for slot in cache.list(2)] == [3, 4]
+
+    assert cache.stats() == {"hits": 3, "misses": 2, "evictions": 1, "users": 1, "intervals": 2}
+
+
+def test_interval_cache__write_during_load():
+    cache = IntervalCache(max_intervals=10)
+    token = cache.begin_load(1)
+    cache.add(1, 2, 300, 400, 1)
+    cache.put(1, UserIntervals([(1, 100, 200)]), token)
+    assert cache.list(1) is None
+
+
+def test_interval_cache__versions():
+    cache = IntervalCache(max_intervals=10)
+    cache.put(1, UserIntervals([(1, 100, 200)], version=3), cache.begin_load(1))
+    assert cache.version(1) == 3
+
+    cache.add_many(1, [(2, 300, 400), (3, 500, 600)], 4)
+    cache.remove(1, 1, 5)
+    assert cache.version(1) == 5
+    assert [slot.id for slot in cache.list(1)] == [2, 3]
+
+    # already part of the loaded entry
+    cache.remove(1, 2, 5)
+    assert [slot.id for slot in cache.list(1)] == [2, 3]
+
+    # version 6 was written by another worker
+    cache.add(1, 4, 700, 800, 7)
+    assert cache.version(1) is None
+    assert cache.stats()["intervals"] == 0
+
+
+def test_interval_cache__ttl():
+    cache = IntervalCache(max_intervals=10, ttl=0)
+    _put(cache, 1, [(1, 100, 200)])
+    assert cache.list(1) is None
+    assert cache.stats()["intervals"] == 0
@@ -0,0 +1,59 @@
+import asyncio
+import datetime
+
+from app.tests import TestingSessionLocal, engine, setup_function, teardown_function
+
+from app.changes import RESYNC, ChangeFeed, Subscription
+from app.controllers.time_slot import TimeSlotController
+from app.schemas import TimeSlotBase, TimeSlotCreate
+
+
+def test_change_feed():
+    controller = TimeSlotController(TestingSessionLocal)
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+
+    async def run():
+        feed = ChangeFeed(engine)
+        subscription = await feed.subscribe(1)
+        other = await feed.subscribe(2)
+        loop = asyncio.get_running_loop()
+        try:
+            slot = await loop.run_in_executor(
+                None, controller.create, TimeSlotCreate(user_id=1, start_at=now + 100, end_at=now + 200), now
+            )
+            await loop.run_in_executor(
+                None, controller.create_many, 1,
+                [TimeSlotBase(start_at=now + 300 + i * 10, end_at=now + 305 + i * 10) for i in range(150)], now
+            )
+            await loop.run_in_executor(None, controller.delete, 1, slot.id)
+
+            created = await asyncio.wait_for(subscription.get(), 5)
+            assert created == {
+                "user_id": 1, "event": "created",
+                "data": [{"id": slot.id, "start_at": now + 100, "end_at": now + 200}],
+            }
+            # bulk changes arrive in events of at most 100 slots
+            sizes = [len((await asyncio.wait_for(subscription.get(), 5))["data"]) for _ in range(2)]
+            assert sizes == [100, 50]
+            deleted = await asyncio.wait_for(subscription.get(), 5)
+            assert deleted == {"user_id": 1, "event": "deleted", "data": [{"id": slot.id}]}
+            assert other.queue.empty()
+
+            feed.unsubscribe(other)
+            assert feed.subscribers == 1
+        finally:
+            await feed.close()
+
+    asyncio.run(run())
+
+
+def test_subscription_overflow():
+    async def run():
+        subscription = Subscription(1, queue_size=2)
+        for idx in range(3):
+            subscription.put({"user_id": 1, "event": "deleted", "data": [{"id": idx}]})
+        # the queued events are dropped for one resync
+        assert await subscription.get() is RESYNC
+        assert subscription.queue.empty()
+
+    asyncio.run(run())
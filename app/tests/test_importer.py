@@ -0,0 +1,77 @@
+import datetime
+
+from app.tests import TestingSessionLocal, setup_function, teardown_function
+
+from app.controllers.time_slot import TimeSlotController
+from app.importer import MALFORMED, decode_lines, import_lines
+from app.models import TimeSlot
+from app.schemas import FileFormat, TimeSlotCreate, TimeSlotSeriesBase
+
+
+def _rejections(report) -> list:
+    return [(rejection.line, rejection.reason) for rejection in report.rejected]
+
+
+def test_import_csv():
+    controller = TimeSlotController(TestingSessionLocal)
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    start = now + 1000
+    controller.create(TimeSlotCreate(user_id=1, start_at=start, end_at=start + 100), now)
+    controller.create_series(2, TimeSlotSeriesBase(start_at=start, end_at=start + 100, every=1000, occurrences=3), now)
+
+    lines = [
+        "user_id,start_at,end_at\n",
+        f"1,{start + 200},{start + 300}\n",
+        f"1,{start + 50},{start + 150}\n",
+        f"1,{start + 400},{start + 300}\n",
+        f"1,{now - 10},{now + 10}\n",
+        f"1,{start + 500},{start + 500 + 86401}\n",
+        "1,soon,later\n",
+        f"2,{start + 2050},{start + 2060}\n",
+        f"2,{start + 3000},{start + 3100}\n",
+        # the next three overlap each other
+        f"3,{start},{start + 100}\n",
+        f"3,{start + 90},{start + 200}\n",
+        f"3,{start + 150},{start + 160}\n",
+        f"3,{start + 200},{start + 300}\n",
+    ]
+    report = import_lines(controller, lines, FileFormat.csv, now)
+
+    assert report.imported == 3
+    assert _rejections(report) == [
+        (3, "time range overlap"),
+        (4, "start_at must less than end_at"),
+        (5, "start_at must greater than now"),
+        (6, "range start_at and end_at must in 24 hours"),
+        (7, MALFORMED),
+        (8, "time range overlap"),
+        (10, "time range overlap"),
+        (11, "time range overlap"),
+        (12, "time range overlap"),
+    ]
+    with TestingSessionLocal() as sess:
+        assert sorted((slot.user_id, slot.start_at - start) for slot in sess.query(TimeSlot)) == [
+            (1, 0), (1, 200), (2, 3000), (3, 200)
+        ]
+
+
+def test_import_ndjson():
+    controller = TimeSlotController(TestingSessionLocal)
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    lines = [
+        f'{{"id": 7, "user_id": 1, "start_at": {now + 100}, "end_at": {now + 200}}}\n',
+        "\n",
+        '{"user_id": 1}\n',
+        f'{{"user_id": 2, "start_at": {now + 100}, "end_at": {2 ** 31}}}\n',
+    ]
+    report = import_lines(controller, lines, FileFormat.ndjson, now)
+    assert report.imported == 1
+    assert _rejections(report) == [(3, MALFORMED), (4, MALFORMED)]
+
+
+def test_decode_lines():
+    body = "a,1\r\nä,2\n\nlast".encode()
+    for size in range(1, len(body) + 1):
+        chunks = [body[offset:offset + size] for offset in range(0, len(body), size)]
+        assert list(decode_lines(chunks)) == body.decode().splitlines(keepends=True)
+    assert list(decode_lines([])) == []
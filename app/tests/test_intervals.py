@@ -0,0 +1,22 @@
+import numpy as np
+
+from app.intervals import free_gaps, merge_intervals
+
+
+def test_merge_intervals():
+    starts = np.array([50, 0, 10, 100, 30, 200])
+    ends = np.array([60, 20, 15, 200, 40, 210])
+    busy_starts, busy_ends = merge_intervals(starts, ends)
+    assert busy_starts.tolist() == [0, 30, 50, 100]
+    assert busy_ends.tolist() == [20, 40, 60, 210]
+
+    busy_starts, busy_ends = merge_intervals(np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+    assert busy_starts.tolist() == [] and busy_ends.tolist() == []
+
+
+def test_free_gaps():
+    gap_starts, gap_ends = free_gaps(np.array([0, 30, 50]), np.array([20, 40, 60]), 0, 100)
+    assert list(zip(gap_starts.tolist(), gap_ends.tolist())) == [(20, 30), (40, 50), (60, 100)]
+
+    gap_starts, gap_ends = free_gaps(np.array([], dtype=np.int64), np.array([], dtype=np.int64), 0, 100)
+    assert list(zip(gap_starts.tolist(), gap_ends.tolist())) == [(0, 100)]
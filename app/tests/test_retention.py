@@ -0,0 +1,48 @@
+import time
+
+from app.models import TimeSlot, TimeSlotSeries
+from app.retention import delete_expired, delete_expired_series, is_partitioned, run
+from app.tests import TestingSessionLocal, engine, setup_function, teardown_function
+
+
+def _add_slots(user_id: int, starts: list):
+    with TestingSessionLocal() as sess:
+        sess.add_all([TimeSlot(user_id=user_id, start_at=start_at, end_at=start_at + 600) for start_at in starts])
+        sess.commit()
+
+
+def test_delete_expired():
+    now = int(time.time())
+    _add_slots(1, [now - 86400 * 3 + idx * 1000 for idx in range(25)])
+    _add_slots(2, [now - 86400, now - 300, now + 600])
+
+    # the slot of user 2 still running at the cutoff is kept
+    assert delete_expired(engine, now - 600, batch_size=10) == 26
+    with TestingSessionLocal() as sess:
+        assert sorted(slot.start_at for slot in sess.query(TimeSlot)) == [now - 300, now + 600]
+
+
+def test_run__unpartitioned():
+    now = int(time.time())
+    _add_slots(1, [now - 86400 * 40, now - 86400 * 10])
+
+    with engine.connect() as conn:
+        assert not is_partitioned(conn)
+    run(engine, retention_days=30, batch_size=100, partitions_ahead_days=56, lock_timeout=1.0)
+    with TestingSessionLocal() as sess:
+        assert [slot.start_at for slot in sess.query(TimeSlot)] == [now - 86400 * 10]
+
+
+def test_delete_expired_series():
+    now = int(time.time())
+    start_at = now - 86400 * 3
+    with TestingSessionLocal() as sess:
+        sess.add_all([
+            TimeSlotSeries(user_id=1, start_at=start_at, end_at=start_at + 600, every=86400, occurrences=occurrences)
+            for occurrences in (2, 4)
+        ])
+        sess.commit()
+
+    assert delete_expired_series(engine, now - 3600) == 1
+    with TestingSessionLocal() as sess:
+        assert [series.occurrences for series in sess.query(TimeSlotSeries)] == [4]
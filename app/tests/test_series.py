@@ -0,0 +1,53 @@
+from app import series
+from app.schemas import TimeSlotSeries
+
+
+def _series(start_at: int, end_at: int, every: int, occurrences: int, series_id: int = 1):
+    return TimeSlotSeries(id=series_id, start_at=start_at, end_at=end_at, every=every, occurrences=occurrences)
+
+
+def test_overlaps():
+    # [100, 200), [1100, 1200), [2100, 2200)
+    weekly = _series(100, 200, 1000, 3)
+    assert series.last_end_at(weekly) == 2200
+    assert series.overlaps(weekly, 150, 160)
+    assert series.overlaps(weekly, 1199, 1300)
+    assert series.overlaps(weekly, 0, 2101)
+    assert not series.overlaps(weekly, 200, 1100)
+    assert not series.overlaps(weekly, 0, 100)
+    assert not series.overlaps(weekly, 2200, 3200)
+    assert not series.overlaps(weekly, 3100, 3200)
+
+
+def test_series_overlap():
+    weekly = _series(100, 200, 1000, 3)
+    assert series.series_overlap(weekly, _series(2150, 2160, 10, 100))
+    assert series.series_overlap(_series(1150, 1160, 500, 2), weekly)
+    assert not series.series_overlap(weekly, _series(200, 600, 500, 5))
+    assert not series.series_overlap(weekly, _series(2200, 2300, 100, 10))
+
+
+def test_expand():
+    weekly = _series(100, 200, 1000, 3, series_id=7)
+    assert list(series.expand(weekly)) == [(None, 100, 200, 7), (None, 1100, 1200, 7), (None, 2100, 2200, 7)]
+    assert list(series.expand(weekly, before_timestamp=2200, after_timestamp=200)) == [(None, 1100, 1200, 7)]
+
+    # rows come already filtered, only the occurrences are
+    rows = [series.SeriesOccurrence(1, 1000, 1050, None), series.SeriesOccurrence(2, 1300, 1400, None)]
+    merged = series.merge(rows, [weekly], after_timestamp=1000)
+    assert [(row.start_at, row.series_id) for row in merged] == [(1000, None), (1100, 7), (1300, None), (2100, 7)]
+
+
+def test_trim():
+    weekly = _series(100, 200, 1000, 4)
+    assert series.trim(weekly) == (4, [])
+    assert series.trim(weekly, before_timestamp=200) == (0, [weekly])
+    # occurrences ending at 1200 and 2200 are inside (200, 3200), the filters of list
+    removed, left = series.trim(weekly, before_timestamp=3200, after_timestamp=200)
+    assert removed == 2
+    assert [(rest.start_at, rest.end_at, rest.every, rest.occurrences) for rest in left] == [
+        (100, 200, 1000, 1), (3100, 3200, 1000, 1)
+    ]
+    removed, left = series.trim(weekly, after_timestamp=1200)
+    assert removed == 2
+    assert [(rest.start_at, rest.occurrences) for rest in left] == [(100, 2)]
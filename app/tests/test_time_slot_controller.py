@@ -1,14 +1,22 @@
 import datetime
+import time
+
 import pytest
 
+from concurrent.futures import ThreadPoolExecutor
+
 from sqlalchemy.orm.exc import NoResultFound
 
 from app.tests import TestingSessionLocal, setup_function, teardown_function
 
+from app.cache import IntervalCache
 from app.controllers.time_slot import TimeSlotController
 from app.errors import TimeOverlapError, TimeFormatError
+from app.group_commit import GroupCommitWriter
 from app.models import TimeSlot
-from app.schemas import TimeSlotCreate
+from app.profiling import QueryPlanSampler
+from app.schemas import TimeSlotBase, TimeSlotCreate, TimeSlotSeriesBase
+from app.unit_of_work import unit_of_work
 
 
 def _get_controller():
@@ -122,6 +130,90 @@ def test_create_timeslot__overlap():
         assert objs[0].end_at == expected_end_at
 
 
+def test_create_timeslot__concurrent_overlap():
+    controller = _get_controller()
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    new_slot = TimeSlotCreate(user_id=user_id, start_at=now + 1, end_at=now + 601)
+
+    def _create(_):
+        try:
+            return controller.create(new_slot, now)
+        except TimeOverlapError as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(_create, range(8)))
+
+    assert len([r for r in results if isinstance(r, TimeOverlapError)]) == 7
+    with TestingSessionLocal() as sess:
+        assert sess.query(TimeSlot).filter_by(user_id=user_id).count() == 1
+
+
+def test_create_timeslot__group_commit():
+    writer = GroupCommitWriter(TestingSessionLocal, max_batch=50, max_delay=0.05)
+    controller = TimeSlotController(TestingSessionLocal, writer=writer)
+
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    # every user asks for the same slot twice and for one that does not overlap
+    slots = [
+        TimeSlotCreate(user_id=user_id, start_at=now + start, end_at=now + start + 600)
+        for user_id in range(1, 5) for start in (1, 1, 601)
+    ]
+
+    def _create(slot):
+        try:
+            return controller.create(slot, now)
+        except TimeOverlapError as e:
+            return e
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(slots)) as executor:
+            results = list(executor.map(_create, slots))
+        with pytest.raises(TimeFormatError):
+            controller.create(TimeSlotCreate(user_id=1, start_at=now - 1, end_at=now + 10), now)
+    finally:
+        writer.close()
+
+    assert len([r for r in results if isinstance(r, TimeOverlapError)]) == 4
+    created = [r for r in results if not isinstance(r, TimeOverlapError)]
+    assert sorted((r.user_id, r.start_at) for r in created) == sorted(
+        (user_id, now + start) for user_id in range(1, 5) for start in (1, 601)
+    )
+    with TestingSessionLocal() as sess:
+        assert sess.query(TimeSlot).count() == 8
+
+
+def test_create_many_timeslots():
+    controller = _get_controller()
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    start = now + 100
+    controller.create(TimeSlotCreate(user_id=user_id, start_at=start, end_at=start + 600), now)
+
+    time_slots = [
+        TimeSlotBase(start_at=start + 1200, end_at=start + 1800),
+        # overlaps the stored slot
+        TimeSlotBase(start_at=start + 300, end_at=start + 500),
+        # format error
+        TimeSlotBase(start_at=start + 3000, end_at=start + 3000),
+        # these two overlap each other inside the batch
+        TimeSlotBase(start_at=start + 2400, end_at=start + 3000),
+        TimeSlotBase(start_at=start + 2900, end_at=start + 3600),
+        TimeSlotBase(start_at=start + 600, end_at=start + 1200),
+    ]
+    results = controller.create_many(user_id, time_slots, now)
+
+    assert [type(r) for r in results[1:5]] == [TimeOverlapError, TimeFormatError, TimeOverlapError, TimeOverlapError]
+    assert (results[0].start_at, results[0].end_at) == (start + 1200, start + 1800)
+    assert (results[5].start_at, results[5].end_at) == (start + 600, start + 1200)
+    assert [slot.id for slot in controller.list(user_id)] == [1, results[5].id, results[0].id]
+
+    assert controller.create_many(user_id, [time_slots[1]], now)[0].__class__ is TimeOverlapError
+
+
 def test_get_user_time_slots():
     controller = _get_controller()
 
@@ -199,6 +291,267 @@ def test_get_user_time_slots__filter():
     assert slots[0].end_at == end2
 
 
+def test_list_rows():
+    controller = _get_controller()
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    expected_slots = [(now + 1 + i * 100, now + 51 + i * 100) for i in range(3)]
+    controller.create_many(user_id, [TimeSlotBase(start_at=s, end_at=e) for s, e in expected_slots], now)
+
+    rows = controller.list_rows(user_id)
+    assert [tuple(row) for row in rows] == [(i + 1, s, e) for i, (s, e) in enumerate(expected_slots)]
+    rows = controller.list_rows(user_id, before_timestamp=expected_slots[2][1], after_timestamp=expected_slots[0][1])
+    assert [tuple(row) for row in rows] == [(2, *expected_slots[1])]
+
+    cached = TimeSlotController(TestingSessionLocal, cache=IntervalCache(max_intervals=100))
+    assert [tuple(row) for row in cached.list_rows(user_id)] == [tuple(row) for row in controller.list_rows(user_id)]
+
+
+def test_get_user_time_slots__page():
+    controller = _get_controller()
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    expected_slots = [(now + 1 + i * 100, now + 51 + i * 100) for i in range(7)]
+    controller.create_many(user_id, [TimeSlotBase(start_at=s, end_at=e) for s, e in expected_slots], now)
+
+    slots, cursor, pages = [], None, 0
+    while True:
+        page, cursor = controller.list_page(user_id, 3, cursor=cursor)
+        slots.extend((slot.start_at, slot.end_at) for slot in page)
+        pages += 1
+        if cursor is None:
+            break
+    assert slots == expected_slots
+    assert pages == 3
+
+    page, cursor = controller.list_page(user_id, 7)
+    assert len(page) == 7
+    assert cursor is None
+
+    page, cursor = controller.list_page(user_id, 2, after_timestamp=expected_slots[4][1])
+    assert [(slot.start_at, slot.end_at) for slot in page] == expected_slots[5:]
+    assert cursor is None
+
+
+def test_get_user_time_slots__page_series():
+    controller = _get_controller()
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    start = now + 100
+    controller.create_series(
+        user_id, TimeSlotSeriesBase(start_at=start, end_at=start + 100, every=1000, occurrences=4), now
+    )
+    for i in range(3):
+        slot_start = start + 500 + i * 1000
+        controller.create(TimeSlotCreate(user_id=user_id, start_at=slot_start, end_at=slot_start + 100), now)
+    expected = [(row.start_at, row.id, getattr(row, "series_id", None)) for row in controller.list_rows(user_id)]
+    assert len(expected) == 7
+
+    # pages end on occurrences and on slots alike
+    for limit in range(1, 8):
+        listed, cursor = [], None
+        while True:
+            page, cursor = controller.list_page(user_id, limit, cursor=cursor)
+            listed.extend((row.start_at, row.id, getattr(row, "series_id", None)) for row in page)
+            if cursor is None:
+                break
+        assert listed == expected
+
+    page, cursor = controller.list_page(user_id, 2, after_timestamp=start + 1100, before_timestamp=start + 3000)
+    assert [row.start_at for row in page] == [start + 1500, start + 2000]
+    page, cursor = controller.list_page(
+        user_id, 2, cursor=cursor, after_timestamp=start + 1100, before_timestamp=start + 3000
+    )
+    assert [row.start_at for row in page] == [start + 2500]
+    assert cursor is None
+
+
+def test_iter_user_time_slots():
+    controller = _get_controller()
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    expected_slots = [(now + 1 + i * 100, now + 51 + i * 100) for i in range(5)]
+    controller.create_many(user_id, [TimeSlotBase(start_at=s, end_at=e) for s, e in expected_slots], now)
+
+    chunks = list(controller.iter_list(user_id, chunk_size=2))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert [(row.start_at, row.end_at) for chunk in chunks for row in chunk] == expected_slots
+    assert list(controller.iter_list(2)) == []
+
+
+def test_iter_export():
+    controller = _get_controller()
+
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    for user_id in (1, 2):
+        controller.create_many(
+            user_id, [TimeSlotBase(start_at=now + 1 + i * 100, end_at=now + 51 + i * 100) for i in range(3)], now
+        )
+
+    db_series = controller.create_series(
+        3, TimeSlotSeriesBase(start_at=now + 1, end_at=now + 51, every=100, occurrences=2), now
+    )
+
+    chunks = list(controller.iter_export(chunk_size=4))
+    assert [len(chunk) for chunk in chunks] == [2, 4, 2]
+    # the occurrences of the series come first, without an id of their own
+    assert [(row.id, row.user_id, row.start_at, row.end_at, row.series_id) for row in chunks[0]] == [
+        (None, 3, now + 1, now + 51, db_series.id), (None, 3, now + 101, now + 151, db_series.id)
+    ]
+    rows = [row for chunk in chunks[1:] for row in chunk]
+    assert [row.id for row in rows] == sorted(row.id for row in rows)
+    assert all(row.series_id is None for row in rows)
+    assert [row.user_id for row in next(controller.iter_export([2]))] == [2, 2, 2]
+    assert [row.id for chunk in controller.iter_export(checkpoint=rows[3].id) for row in chunk] == [
+        row.id for row in rows[4:]
+    ]
+
+
+def test_list_many():
+    controller = _get_controller()
+
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    start = now + 100
+    users_and_slots = {
+        1: [(start + 1200, start + 1800), (start, start + 600)],
+        2: [(start + 300, start + 900)],
+        3: [(start + 5000, start + 5100)],
+    }
+    for user_id, slots in users_and_slots.items():
+        controller.create_many(user_id, [TimeSlotBase(start_at=s, end_at=e) for s, e in slots], now)
+
+    time_slots = controller.list_many([1, 2, 4])
+    assert {user_id: [(slot.start_at, slot.end_at) for slot in slots] for user_id, slots in time_slots.items()} == {
+        1: [(start, start + 600), (start + 1200, start + 1800)],
+        2: [(start + 300, start + 900)],
+        4: [],
+    }
+
+    time_slots = controller.list_many([1, 2, 3], before_timestamp=start + 1800, after_timestamp=start + 600)
+    assert {user_id: [slot.start_at for slot in slots] for user_id, slots in time_slots.items()} == {
+        1: [], 2: [start + 300], 3: [],
+    }
+
+
+def test_free_busy():
+    controller = _get_controller()
+
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    start = now + 100
+    users_and_slots = {
+        1: [(start, start + 600), (start + 1200, start + 1800)],
+        2: [(start + 300, start + 900), (start + 1800, start + 2000)],
+        3: [(start + 5000, start + 5100)],
+    }
+    for user_id, slots in users_and_slots.items():
+        controller.create_many(user_id, [TimeSlotBase(start_at=s, end_at=e) for s, e in slots], now)
+
+    busy, free = controller.free_busy([1, 2], start + 100, start + 3000)
+    assert busy.tolist() == [[start + 100, start + 900], [start + 1200, start + 2000]]
+    assert free.tolist() == [[start + 900, start + 1200], [start + 2000, start + 3000]]
+
+    busy, free = controller.free_busy([3, 4], start, start + 3000)
+    assert busy.tolist() == []
+    assert free.tolist() == [[start, start + 3000]]
+
+
+def test_time_slot_series():
+    controller = _get_controller()
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    start = now + 100
+    controller.create(TimeSlotCreate(user_id=user_id, start_at=start + 2000, end_at=start + 2100), now)
+    with pytest.raises(TimeFormatError):
+        controller.create_series(
+            user_id, TimeSlotSeriesBase(start_at=start, end_at=start + 600, every=300, occurrences=2), now
+        )
+    # the third occurrence would overlap the stored slot
+    with pytest.raises(TimeOverlapError):
+        controller.create_series(
+            user_id, TimeSlotSeriesBase(start_at=start, end_at=start + 100, every=1000, occurrences=3), now
+        )
+    db_series = controller.create_series(
+        user_id, TimeSlotSeriesBase(start_at=start, end_at=start + 100, every=1000, occurrences=2), now
+    )
+    with pytest.raises(TimeOverlapError):
+        controller.create_series(
+            user_id, TimeSlotSeriesBase(start_at=start + 850, end_at=start + 950, every=100, occurrences=2), now
+        )
+    with pytest.raises(TimeOverlapError):
+        controller.create(TimeSlotCreate(user_id=user_id, start_at=start + 1050, end_at=start + 1200), now)
+    # another user is not blocked by the series
+    controller.create(TimeSlotCreate(user_id=2, start_at=start + 1050, end_at=start + 1200), now)
+
+    time_slots = controller.list(user_id)
+    assert [(slot.start_at, slot.series_id if slot.id is None else None) for slot in time_slots] == [
+        (start, db_series.id), (start + 1000, db_series.id), (start + 2000, None)
+    ]
+    assert [(slot.start_at, slot.id) for slot in controller.list(user_id, after_timestamp=start + 1100)] == [
+        (start + 2000, time_slots[2].id)
+    ]
+    busy, free = controller.free_busy([user_id], start + 50, start + 3000)
+    assert busy.tolist() == [[start + 50, start + 100], [start + 1000, start + 1100], [start + 2000, start + 2100]]
+
+    assert controller.delete_series(user_id, db_series.id) is True
+    assert controller.delete_series(user_id, db_series.id) is False
+    assert len(controller.list(user_id)) == 1
+    controller.create(TimeSlotCreate(user_id=user_id, start_at=start + 1050, end_at=start + 1200), now)
+
+
+def test_create__concurrent_series():
+    controller = _get_controller()
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    start = now + 100
+    with unit_of_work() as uow, ThreadPoolExecutor(max_workers=1) as pool:
+        controller.create_series(
+            user_id, TimeSlotSeriesBase(start_at=start, end_at=start + 100, every=1000, occurrences=3), now
+        )
+        # the create waits for the version row lock held by the uncommitted series, the snapshot of its
+        # statement does not see the series once it may go on
+        created = pool.submit(
+            controller.create, TimeSlotCreate(user_id=user_id, start_at=start + 1050, end_at=start + 1150), now
+        )
+        time.sleep(0.2)
+        assert not created.done()
+        uow.commit()
+        with pytest.raises(TimeOverlapError):
+            created.result()
+    assert [slot.id for slot in controller.list(user_id)] == [None] * 3
+
+
+def test_free_windows():
+    controller = _get_controller()
+
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    start = now + 1000
+    controller.create(TimeSlotCreate(user_id=1, start_at=start, end_at=start + 100), now)
+    controller.create(TimeSlotCreate(user_id=2, start_at=start + 50, end_at=start + 300), now)
+    controller.create(TimeSlotCreate(user_id=2, start_at=start + 60 + 86400, end_at=start + 70 + 86400), now)
+    controller.create_series(
+        1, TimeSlotSeriesBase(start_at=start + 500, end_at=start + 600, every=1000, occurrences=5), now
+    )
+
+    windows = controller.free_windows([1, 2], start - 200, start + 3000, 100, now=now)
+    assert [(s - start, e - start) for s, e in windows] == [
+        (-200, 0), (300, 500), (600, 1500), (1600, 2500), (2600, 3000)
+    ]
+    windows = controller.free_windows([1, 2], start - 200, start + 3000, 500, limit=2, now=now)
+    assert [(s - start, e - start) for s, e in windows] == [(600, 1500), (1600, 2500)]
+    # the window is cut at now, nothing before it can be booked
+    windows = controller.free_windows([1, 2], start, start + 3000, 100, now=start + 2550)
+    assert [(s - start, e - start) for s, e in windows] == [(2600, 3000)]
+    assert controller.free_windows([3], start, start + 50, 100, now=now) == []
+    with pytest.raises(TimeFormatError):
+        controller.free_windows([1], start, start + 3000, 86401, now=now)
+
+
 def test_delete_user_time_slot():
     controller = _get_controller()
 
@@ -209,8 +562,147 @@ def test_delete_user_time_slot():
     new_slot = TimeSlotCreate(user_id=user_id, start_at=start_at, end_at=end_at)
     new_item = controller.create(new_slot, now)
 
-    controller.delete(user_id, new_item.id)
+    assert controller.delete(user_id, new_item.id) is True
+    assert controller.delete(user_id, new_item.id) is False
+    # another user's slot is never deleted
+    other_item = controller.create(TimeSlotCreate(user_id=2, start_at=start_at, end_at=end_at), now)
+    assert controller.delete(user_id, other_item.id) is False
 
     with TestingSessionLocal() as sess:
         with pytest.raises(NoResultFound):
             obj = sess.query(TimeSlot).filter_by(user_id=user_id, id=new_item.id).one()
+
+
+def test_delete_many():
+    controller = _get_controller()
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    start = now + 100
+    time_slots = [TimeSlotBase(start_at=start + i * 100, end_at=start + i * 100 + 50) for i in range(10)]
+    controller.create_many(user_id, time_slots, now)
+    other = controller.create(TimeSlotCreate(user_id=2, start_at=start, end_at=start + 50), now)
+    ids = [slot.id for slot in controller.list(user_id)]
+
+    assert controller.delete_many(user_id, ids=ids[:2] + [other.id], chunk_size=1) == 2
+    # slots ending inside (start + 450, start + 800), chunked
+    deleted = controller.delete_many(user_id, before_timestamp=start + 800, after_timestamp=start + 450, chunk_size=2)
+    assert deleted == 3
+    assert controller.delete_many(user_id, ids=ids[:6], after_timestamp=start + 450) == 0
+    assert [slot.start_at for slot in controller.list(user_id)] == [start + i * 100 for i in (2, 3, 4, 8, 9)]
+    assert controller.delete_many(user_id) == 5
+    assert controller.list(user_id) == []
+    assert len(controller.list(2)) == 1
+
+
+def test_delete_many__series():
+    controller = _get_controller()
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    start = now + 100
+    controller.create_series(
+        user_id, TimeSlotSeriesBase(start_at=start, end_at=start + 50, every=100, occurrences=5), now
+    )
+    slot = controller.create(TimeSlotCreate(user_id=user_id, start_at=start + 1000, end_at=start + 1050), now)
+
+    # by ids only slots go, occurrences have no id
+    assert controller.delete_many(user_id, ids=[slot.id]) == 1
+    assert len(controller.list(user_id)) == 5
+    # occurrences ending inside (start + 100, start + 350) are cut out of the series
+    assert controller.delete_many(user_id, before_timestamp=start + 350, after_timestamp=start + 100) == 2
+    assert [row.start_at for row in controller.list(user_id)] == [start, start + 300, start + 400]
+    assert controller.delete_many(user_id) == 3
+    assert controller.list(user_id) == []
+
+
+def test_query_plan_sampling(caplog):
+    controller = TimeSlotController(TestingSessionLocal, plan_sampler=QueryPlanSampler(1.0))
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    new_slot = TimeSlotCreate(user_id=user_id, start_at=now + 1, end_at=now + 601)
+    with caplog.at_level("INFO", logger="app.profiling"):
+        new_item = controller.create(new_slot, now)
+        with pytest.raises(TimeOverlapError):
+            controller.create(new_slot, now)
+        slots = controller.list(user_id)
+
+    # the sampled EXPLAIN ANALYZE of the insert must not leave a row behind
+    assert [slot.id for slot in slots] == [new_item.id]
+    plans = [r.getMessage() for r in caplog.records if r.getMessage().startswith("query plan for")]
+    assert any("Insert on time_slot" in plan for plan in plans)
+    assert any("Buffers" in plan or "Scan" in plan for plan in plans)
+
+    controller.delete(user_id, new_item.id)
+    assert controller.list(user_id) == []
+
+
+def test_interval_cache():
+    cache = IntervalCache(max_intervals=100)
+    controller = TimeSlotController(TestingSessionLocal, cache=cache)
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    # a miss on create is not loaded
+    controller.create(TimeSlotCreate(user_id=user_id, start_at=now + 1000, end_at=now + 1100), now)
+    assert cache.stats() == {"hits": 0, "misses": 1, "evictions": 0, "users": 0, "intervals": 0}
+    assert controller.version(user_id) == 1
+    assert cache.stats()["misses"] == 2
+
+    first = controller.create(TimeSlotCreate(user_id=user_id, start_at=now + 1, end_at=now + 601), now)
+    # a cached overlap is checked against the database before rejecting
+    with pytest.raises(TimeOverlapError):
+        controller.create(TimeSlotCreate(user_id=user_id, start_at=now + 100, end_at=now + 200), now)
+    second = controller.create(TimeSlotCreate(user_id=user_id, start_at=now + 601, end_at=now + 700), now)
+    results = controller.create_many(user_id, [TimeSlotBase(start_at=now + 700, end_at=now + 800)], now)
+    listed = [slot.id for slot in controller.list(user_id)]
+    assert listed[:3] == [first.id, second.id, results[0].id]
+    assert [slot.id for slot in controller.list(user_id, after_timestamp=now + 601)] == listed[1:]
+
+    controller.delete(user_id, second.id)
+    assert [slot.id for slot in controller.list(user_id)] == [first.id, results[0].id, listed[3]]
+    # the cached version tags the cached list, it follows the writes made through the cache
+    assert controller.version(user_id) == TimeSlotController(TestingSessionLocal).version(user_id) == 5
+    assert cache.stats()["hits"] == 7
+    assert cache.stats()["misses"] == 2
+
+    with TestingSessionLocal() as sess:
+        assert sess.query(TimeSlot).filter_by(user_id=user_id).count() == 3
+
+
+def test_interval_cache__stale_overlap():
+    cache = IntervalCache(max_intervals=100)
+    controller = TimeSlotController(TestingSessionLocal, cache=cache)
+    other_worker = TimeSlotController(TestingSessionLocal, cache=IntervalCache(max_intervals=100))
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    first = controller.create(TimeSlotCreate(user_id=user_id, start_at=now + 1, end_at=now + 601), now)
+    # deleted behind the back of controller's cache, which still holds the slot
+    assert other_worker.delete(user_id, first.id)
+    second = controller.create(TimeSlotCreate(user_id=user_id, start_at=now + 100, end_at=now + 200), now)
+    assert [slot.id for slot in controller.list(user_id)] == [second.id]
+
+
+def test_unit_of_work():
+    cache = IntervalCache(max_intervals=100)
+    controller = TimeSlotController(TestingSessionLocal, cache=cache)
+
+    user_id = 1
+    now = int(datetime.datetime.utcnow().replace(microsecond=0).timestamp())
+    with unit_of_work() as uow:
+        controller.create(TimeSlotCreate(user_id=user_id, start_at=now + 100, end_at=now + 200), now)
+        controller.create(TimeSlotCreate(user_id=user_id, start_at=now + 300, end_at=now + 400), now)
+        # both creates share one uncommitted transaction, the cache only learns about them on commit
+        assert len(controller.list_rows(user_id)) == 0
+        with TestingSessionLocal() as sess:
+            assert sess.query(TimeSlot).count() == 0
+        uow.commit()
+    assert [row.start_at for row in controller.list_rows(user_id)] == [now + 100, now + 300]
+
+    with unit_of_work():
+        controller.create(TimeSlotCreate(user_id=user_id, start_at=now + 500, end_at=now + 600), now)
+    assert len(controller.list_rows(user_id)) == 2
+    with TestingSessionLocal() as sess:
+        assert sess.query(TimeSlot).count() == 2
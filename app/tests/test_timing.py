@@ -0,0 +1,67 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DataError
+
+from app.tests import SQLALCHEMY_DATABASE_URL
+
+from app.timing import TimingMiddleware, current_timing, instrument_timing
+
+
+def _app(header: bool = True):
+    timed_engine = create_engine(SQLALCHEMY_DATABASE_URL)
+    instrument_timing(timed_engine, slow_query_threshold=0.05)
+    app = FastAPI()
+    app.add_middleware(TimingMiddleware, header=header)
+
+    @app.get("/queries")
+    def queries(sleep: float = 0.0):
+        with timed_engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            conn.execute(text("SELECT pg_sleep(:sleep)"), {"sleep": sleep})
+        return {"queries": current_timing().queries}
+
+    @app.get("/failing")
+    def failing():
+        with timed_engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            try:
+                conn.execute(text("SELECT 1 / 0"))
+            except DataError:
+                pass
+            return {"queries": current_timing().queries, "info": sorted(conn.info)}
+
+    return app
+
+
+def test_server_timing_header():
+    client = TestClient(_app())
+    response = client.get("/queries")
+    assert response.status_code == 200
+    # the queries of the connection's first checkout are counted too
+    assert response.json()["queries"] >= 2
+    timing = dict(part.strip().split(";", 1) for part in response.headers["server-timing"].split(","))
+    assert set(timing) == {"db", "pool", "app", "total"}
+    assert f'desc="{response.json()["queries"]} queries"' in timing["db"]
+
+    assert "server-timing" not in TestClient(_app(header=False)).get("/queries").headers
+
+
+def test_slow_query_log(caplog):
+    client = TestClient(_app(header=False))
+    with caplog.at_level("WARNING", logger="app.timing"):
+        client.get("/queries", params={"sleep": 0.0})
+        assert not caplog.records
+        client.get("/queries", params={"sleep": 0.1})
+    [record] = caplog.records
+    assert "on GET /queries: SELECT pg_sleep(%(sleep)s)" in record.getMessage()
+    assert "'sleep': 0.1" in record.getMessage()
+
+
+def test_failed_query_timed():
+    client = TestClient(_app())
+    client.get("/queries")
+    response = client.get("/failing")
+    assert response.status_code == 200
+    # the failed statement is counted and nothing of it is left on the pooled connection
+    assert response.json() == {"queries": 2, "info": []}
@@ -0,0 +1,109 @@
+import contextvars
+import logging
+import time
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("request_timing", default=None)
+
+
+class RequestTiming:
+    __slots__ = ("route", "started", "queries", "sql", "checkout")
+
+    def __init__(self, route: str):
+        self.route = route
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql = 0.0
+        self.checkout = 0.0
+
+    # Server-Timing header value in milliseconds, app is what is left besides SQL and checkout waits,
+    # mostly validation and serialization
+    def server_timing(self) -> str:
+        total = (time.perf_counter() - self.started) * 1000
+        sql = self.sql * 1000
+        checkout = self.checkout * 1000
+        app = max(total - sql - checkout, 0.0)
+        return (
+            f'db;dur={sql:.2f};desc="{self.queries} queries", pool;dur={checkout:.2f}, '
+            f"app;dur={app:.2f}, total;dur={total:.2f}"
+        )
+
+
+def current_timing() -> Optional[RequestTiming]:
+    return _current.get()
+
+
+# Adds the SQL time, query count and pool checkout wait of every statement to the timing of the request
+# running it and logs statements slower than slow_query_threshold seconds, 0 disables the log. Engines
+# which are not instrumented pay nothing, so this is only called when one of both is switched on.
+def instrument_timing(engine: Engine, slow_query_threshold: float = 0.0):
+    def _record(statement, parameters, started: float):
+        elapsed = time.perf_counter() - started
+        timing = _current.get()
+        if timing is not None:
+            timing.queries += 1
+            timing.sql += elapsed
+        if slow_query_threshold and elapsed >= slow_query_threshold:
+            route = timing.route if timing is not None else "-"
+            logger.warning(f"Slow query {elapsed * 1000:.1f}ms on {route}: {statement} parameters={parameters!r}")
+
+    # the start is kept on the execution context, which lives as long as the statement, not on the pooled
+    # connection, so a failing statement leaves nothing behind
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.query_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "query_started", None)
+        if started is not None:
+            _record(statement, parameters, started)
+
+    # failed statements, e.g. creates rejected by the exclusion constraint, took their time as well
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(exception_context):
+        started = getattr(exception_context.execution_context, "query_started", None)
+        if started is not None:
+            _record(exception_context.statement, exception_context.parameters, started)
+
+    def _on_checkout_wait(waited: float):
+        timing = _current.get()
+        if timing is not None:
+            timing.checkout += waited
+
+    listeners = getattr(engine.pool, "checkout_wait_listeners", None)
+    if listeners is not None:
+        listeners.append(_on_checkout_wait)
+
+
+# Times every HTTP request for instrument_timing and, with header set, reports it as Server-Timing
+class TimingMiddleware:
+    def __init__(self, app, header: bool = True):
+        self.app = app
+        self.header = header
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timing = RequestTiming(f"{scope['method']} {scope['path']}")
+        token = _current.set(timing)
+
+        async def _send(message):
+            if self.header and message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timing.server_timing().encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            _current.reset(token)
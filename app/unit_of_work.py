@@ -0,0 +1,131 @@
+import contextvars
+import logging
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+import orjson
+from sqlalchemy.orm import Session, sessionmaker
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("unit_of_work", default=None)
+
+
+def current_unit_of_work() -> Optional["UnitOfWork"]:
+    return _current.get()
+
+
+# One session per database shared by every controller call of a request, committed once at its end.
+# Callbacks registered with after_commit, e.g. cache updates, only run once the commit went through.
+class UnitOfWork:
+    def __init__(self):
+        self._sessions: Dict[sessionmaker, Session] = {}
+        self._after_commit: List[Callable[[], None]] = []
+        # request-scoped state of the controllers, e.g. the database chosen for a user's reads and the
+        # versions of users read from the primary
+        self.read_dbs = {}
+        self.versions = {}
+
+    def session(self, db: sessionmaker) -> Session:
+        sess = self._sessions.get(db)
+        if sess is None:
+            sess = self._sessions[db] = db()
+        return sess
+
+    def after_commit(self, callback: Callable[[], None]):
+        self._after_commit.append(callback)
+
+    # whether a session was opened, settling a unit of work without one does no database work
+    @property
+    def active(self) -> bool:
+        return bool(self._sessions)
+
+    def commit(self):
+        for sess in self._sessions.values():
+            sess.commit()
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            callback()
+
+    def rollback(self):
+        self._after_commit = []
+        for sess in self._sessions.values():
+            sess.rollback()
+
+    # rolls back whatever was not committed and returns the connections to their pools
+    def close(self):
+        self._after_commit = []
+        for sess in self._sessions.values():
+            sess.close()
+        self._sessions = {}
+
+
+# a unit of work outside of a request, e.g. for a script making several controller calls in one transaction
+@contextmanager
+def unit_of_work() -> Iterator[UnitOfWork]:
+    uow = UnitOfWork()
+    token = _current.set(uow)
+    try:
+        yield uow
+    finally:
+        _current.reset(token)
+        uow.close()
+
+
+# Opens a unit of work per HTTP request and settles it right before the response starts, commit below
+# status 400 and rollback otherwise, so a client never sees a success that was not committed. A failed
+# commit turns the response into a 500.
+class UnitOfWorkMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        uow = UnitOfWork()
+        token = _current.set(uow)
+        settled = False
+        failed = False
+
+        async def _send(message):
+            nonlocal settled, failed
+            if failed:
+                # the body of the response replaced below
+                return
+            if message["type"] == "http.response.start" and not settled:
+                settled = True
+                if message["status"] < 400:
+                    try:
+                        # without a session there is nothing to commit, only after_commit callbacks to run
+                        if uow.active:
+                            await run_in_threadpool(uow.commit)
+                        else:
+                            uow.commit()
+                    except Exception as e:
+                        logger.error(f"Commit of {scope['path']} failed: {e}")
+                        failed = True
+                        await send({
+                            "type": "http.response.start",
+                            "status": 500,
+                            "headers": [(b"content-type", b"application/json")],
+                        })
+                        await send({"type": "http.response.body", "body": orjson.dumps({"detail": "commit failed"})})
+                        return
+                elif uow.active:
+                    await run_in_threadpool(uow.rollback)
+                else:
+                    uow.rollback()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            _current.reset(token)
+            # requests on the async routes, the change feed or metrics never open a session and skip the hop
+            if uow.active:
+                await run_in_threadpool(uow.close)
+            else:
+                uow.close()
@@ -0,0 +1,80 @@
+from typing import Iterable, Tuple
+
+from sqlalchemy import BigInteger, Integer, and_, bindparam, column, exists, func, literal, select, text
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+
+from app import models
+
+
+# The dialect's insert ... on_conflict_do_update has no cache key and was compiled again on every write.
+# As text the bump is compiled once, the user ids are one array parameter whatever their number.
+_BUMP_SQL = (
+    "INSERT INTO time_slot_version (user_id, version) "
+    "SELECT user_id, 1 FROM unnest(CAST(:bump_user_ids AS INTEGER[])) AS user_id "
+    "ON CONFLICT (user_id) DO UPDATE SET version = time_slot_version.version + excluded.version"
+)
+_BUMP_USERS = text(_BUMP_SQL).bindparams(bindparam("bump_user_ids", type_=ARRAY(Integer)))
+
+# the bump as a CTE of a write, executed with it in one statement and joined to its rows for their new version
+BUMPED = text(f"{_BUMP_SQL} RETURNING user_id, version").bindparams(
+    bindparam("bump_user_ids", type_=ARRAY(Integer))
+).columns(column("user_id", Integer), column("version", BigInteger)).cte("bumped")
+
+
+def bump_params(user_ids: Iterable[int]) -> dict:
+    return {"bump_user_ids": sorted(set(user_ids))}
+
+
+# (statement, parameters) bumping the version of user_ids, sorted so concurrent bumps of several users lock
+# the version rows in the same order
+def bump_statement(user_ids: Iterable[int]) -> Tuple:
+    return _BUMP_USERS, bump_params(user_ids)
+
+
+# All parts of a statement read the snapshot taken at its start, also after BUMPED waited for the version
+# row lock. True when no write of user_id committed in between, i.e. what the statement read of the user is
+# still current. Otherwise it is run again, holding the lock by then.
+def bumped_from_snapshot(user_id):
+    stored = select(models.TimeSlotVersion.version).filter(
+        models.TimeSlotVersion.user_id == user_id
+    ).correlate_except(models.TimeSlotVersion).scalar_subquery()
+    return exists().where(and_(BUMPED.c.user_id == user_id, BUMPED.c.version == func.coalesce(stored, 0) + 1))
+
+
+# bump_statement for the users of a subquery with a user_id column, e.g. a staging table
+def bump_select_statement(users):
+    table = models.TimeSlotVersion.__table__
+    user_ids = select(users.c.user_id).distinct().subquery()
+    statement = insert(table).from_select(
+        ["user_id", "version"], select(user_ids.c.user_id, literal(1)).order_by(user_ids.c.user_id)
+    )
+    # excluded.version is the 1 inserted above, adding it keeps the statement free of binds in SET
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.user_id], set_={"version": table.c.version + statement.excluded.version}
+    )
+
+
+def version_query(user_id: int):
+    return select(models.TimeSlotVersion.version).filter_by(user_id=user_id)
+
+
+# (user_id, version) of the users which wrote at least once
+def versions_query(user_ids: Iterable[int]):
+    return select(models.TimeSlotVersion.user_id, models.TimeSlotVersion.version).filter(
+        models.TimeSlotVersion.user_id == func.any(bindparam("version_user_ids", list(user_ids), type_=ARRAY(Integer)))
+    )
+
+
+def format_etag(version: int) -> str:
+    return f'"{version}"'
+
+
+# "*" only matches a list that exists, the caller tells whether it does
+def etag_matches(if_none_match: str, etag: str, exists: bool = False) -> bool:
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag or (exists and candidate == "*"):
+            return True
+    return False